@@ -0,0 +1,86 @@
+"""
+End-to-end latency of `AsrWsClient` against the local mock ASR server.
+
+Starts `dev/mock_servers/zijie_asr_server.py` in a background thread with an
+injected round trip time, then transcribes the same synthetic WAV with
+different segment sizes and in-flight limits. `max_in_flight=1` is the old
+send-one-wait-for-its-ACK behaviour; larger values pipeline the upload.
+
+    python dev/benchmarks/bench_asr_pipeline.py --rtt 0.08 --seconds 6
+"""
+import os
+import sys
+import math
+import time
+import wave
+import asyncio
+import argparse
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(ROOT, "src"))
+sys.path.append(os.path.join(ROOT, "dev", "mock_servers"))
+
+import zijie_asr_server
+from zijie_stt import AsrWsClient, extract_text
+
+# (seg_duration ms, max_in_flight)
+CONFIGS = [
+    (15000, 1),
+    (200, 1),
+    (200, 4),
+    (200, 16),
+    (100, 16),
+]
+
+
+def write_wav(path, seconds, rate=16000):
+    with wave.open(path, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(rate)
+        wf.writeframes(b"".join(
+            int(6000 * math.sin(2 * math.pi * 220 * i / rate)).to_bytes(2, "little", signed=True)
+            for i in range(int(seconds * rate))
+        ))
+
+
+def start_server(args):
+    ready = threading.Event()
+    server_args = zijie_asr_server.build_parser().parse_args(["--port", str(args.port), "--rtt", str(args.rtt)])
+    threading.Thread(target=lambda: asyncio.run(zijie_asr_server.serve(server_args, ready)), daemon=True).start()
+    ready.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--rtt", type=float, default=0.08)
+    parser.add_argument("--seconds", type=float, default=6)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    start_server(args)
+    path = os.path.join(tempfile.mkdtemp(), "bench.wav")
+    write_wav(path, args.seconds)
+
+    print(f"{args.seconds:.0f}s of audio, injected rtt {args.rtt * 1000:.0f} ms")
+    for seg_duration, max_in_flight in CONFIGS:
+        timings = []
+        for _ in range(args.repeat):
+            client = AsrWsClient(
+                path, "mock",
+                ws_url=f"ws://127.0.0.1:{args.port}/api/v2/asr",
+                seg_duration=seg_duration,
+                max_in_flight=max_in_flight,
+            )
+            start = time.perf_counter()
+            result = asyncio.run(client.execute())
+            timings.append(time.perf_counter() - start)
+        print(f"seg_duration={seg_duration:>5} ms max_in_flight={max_in_flight:>2}: "
+              f"{min(timings) * 1000:7.1f} ms  ({extract_text(result)})")
+
+
+if __name__ == "__main__":
+    main()
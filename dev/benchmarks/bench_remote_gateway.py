@@ -0,0 +1,121 @@
+"""
+Hundreds of idle dev boards against one `RemoteGateway` process.
+
+Starts the gateway in-process, creates `--clients` sessions (as their
+pipelines would), opens one long-polling `GET /sessions/<i>/audio` request per
+session that waits for audio, and while they are all
+waiting measures the thread count of the process and the latency of
+`POST /heartbeat` from one more board. Finally every session is handed its
+end-of-turn marker and each waiting client must receive `204`.
+
+    python dev/benchmarks/bench_remote_gateway.py --clients 500
+    python dev/benchmarks/bench_remote_gateway.py --clients 500 --server flask
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import threading
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(ROOT, "src"))
+
+from remote_gateway import RemoteGateway
+
+
+def raise_fd_limit(clients):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, max(soft, clients * 3 + 256))
+    if wanted > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def wait_listening(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"gateway did not start on port {port}")
+
+
+async def request(port, method, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+    return reader, writer
+
+
+async def read_status(reader, writer):
+    status_line = await reader.readline()
+    await reader.read()
+    writer.close()
+    return int(status_line.split()[1])
+
+
+async def run(args, gateway):
+    # 每个开发板的会话由它的对话流水线创建，GET /audio只查找已有的会话
+    for i in range(args.clients):
+        gateway.session(f"board-{i}")
+    gateway.session("probe")
+    sessions = [gateway.find_session(f"board-{i}") for i in range(args.clients)]
+    # 所有开发板同时等待音频
+    sent = time.time()
+    connections = await asyncio.gather(*(
+        request(args.port, "GET", f"/sessions/board-{i}/audio") for i in range(args.clients)
+    ))
+    # 网关收到请求时会更新会话的last_active
+    deadline = time.monotonic() + 30
+    while any(session.last_active < sent for session in sessions) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.5)
+    idle_threads = threading.active_count()
+    idle_sessions = len(gateway.sessions())
+
+    latencies = []
+    for _ in range(args.heartbeats):
+        start = time.perf_counter()
+        status = await read_status(*await request(args.port, "POST", "/sessions/probe/heartbeat"))
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert status == 200, status
+
+    for i in range(args.clients):
+        sessions[i].offer(None)
+    start = time.perf_counter()
+    statuses = await asyncio.gather(*(read_status(*conn) for conn in connections))
+    release = (time.perf_counter() - start) * 1000
+
+    latencies.sort()
+    print(f"server={args.server} clients={args.clients}")
+    print(f"  sessions open while idle : {idle_sessions}")
+    print(f"  threads while idle       : {idle_threads}")
+    print(f"  heartbeat p50 / p99      : {statistics.median(latencies):.2f} / {latencies[int(len(latencies) * 0.99) - 1]:.2f} ms")
+    print(f"  release all clients      : {release:.0f} ms, {statuses.count(204)}/{args.clients} got 204")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--heartbeats", type=int, default=200)
+    parser.add_argument("--server", choices=["asgi", "flask"], default="asgi")
+    parser.add_argument("--port", type=int, default=5099)
+    args = parser.parse_args()
+
+    raise_fd_limit(args.clients)
+    print(f"threads before start     : {threading.active_count()}")
+    gateway = RemoteGateway(host="127.0.0.1", port=args.port, server=args.server, max_sessions=args.clients + 1).start()
+    wait_listening(args.port)
+    asyncio.run(run(args, gateway))
+
+
+if __name__ == "__main__":
+    main()
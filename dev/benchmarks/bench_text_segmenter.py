@@ -0,0 +1,115 @@
+"""
+Microbenchmark for the streaming sentence segmenter used by `LLM.__run2_ollama`.
+
+Feeds synthetic multi-thousand-token streams through the old
+`__remove_first_match` based loop and through `SentenceSegmenter`, and prints the
+mean per-token cost for each quarter of the stream. A constant per-token cost
+shows up as (roughly) equal numbers across the quarters.
+
+    python dev/benchmarks/bench_text_segmenter.py --tokens 2000 8000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "src")
+)
+
+from text_segmenter import SentenceSegmenter
+
+PUNCTUATIONS = [',', '，', '。', '！', '？', '!', '?']
+
+
+def make_stream(n_tokens, seed=0):
+    rng = random.Random(seed)
+    words = ["今天", "天气", "很好", "我们", "可以", "出去", "走走", "hello", " world", " the", " model"]
+    stream = []
+    for _ in range(n_tokens):
+        token = rng.choice(words)
+        if rng.random() < 0.08:
+            token += rng.choice(PUNCTUATIONS)
+        stream.append(token)
+    return stream
+
+
+def legacy_segmenter(tokens, emit):
+    '''The pre-`SentenceSegmenter` implementation, kept here for comparison.'''
+    old_total_response = ""
+    current_total_response = ""
+    response_delta = ""
+    for response_token in tokens:
+        current_total_response += response_token
+        if old_total_response in current_total_response:
+            response_delta = current_total_response.replace(old_total_response, '', 1)
+        else:
+            response_delta = current_total_response
+        while response_delta:
+            punctuation_index = next((i for i, char in enumerate(response_delta) if char in PUNCTUATIONS), -1)
+            if punctuation_index != -1:
+                text = response_delta[:punctuation_index + 1]
+                old_total_response += text
+                emit(text)
+                response_delta = response_delta[punctuation_index + 1:]
+            if punctuation_index == -1:
+                break
+        yield
+    if response_delta:
+        emit(response_delta)
+
+
+def segmenter_loop(tokens, emit):
+    segmenter = SentenceSegmenter()
+    for token in tokens:
+        for sentence in segmenter.feed(token):
+            emit(sentence)
+        yield
+    last = segmenter.flush()
+    if last:
+        emit(last)
+
+
+def per_token_costs(loop, tokens):
+    sentences = []
+    costs = []
+    steps = loop(tokens, sentences.append)
+    while True:
+        start = time.perf_counter()
+        try:
+            next(steps)
+        except StopIteration:
+            break
+        costs.append(time.perf_counter() - start)
+    return costs, sentences
+
+
+def quartiles(costs):
+    size = len(costs) // 4
+    return [sum(costs[i * size:(i + 1) * size]) / size * 1e6 for i in range(4)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, nargs="+", default=[2000, 8000, 32000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'impl':<10}{'tokens':>8}  mean us/token per quarter (Q1 .. Q4)")
+    for n_tokens in args.tokens:
+        tokens = make_stream(n_tokens)
+        results = {}
+        for name, loop in (("legacy", legacy_segmenter), ("segmenter", segmenter_loop)):
+            best = None
+            for _ in range(args.repeat):
+                costs, sentences = per_token_costs(loop, tokens)
+                q = quartiles(costs)
+                best = q if best is None else [min(a, b) for a, b in zip(best, q)]
+            results[name] = sentences
+            print(f"{name:<10}{n_tokens:>8}  " + "  ".join(f"{v:8.2f}" for v in best))
+        assert results["legacy"] == results["segmenter"], "segmenters disagree"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Local stand-in for the Volcano Engine streaming ASR websocket (`/api/v2/asr`).
+
+It speaks the same binary protocol as the real service: one gzip'd JSON
+full-client request, then audio-only requests, the last one flagged with a
+negative sequence. Every request is answered with a full server response that
+carries a running `sequence` (negative for the final one) and a fake transcript
+describing how much audio arrived. Each response is delayed by `--rtt` seconds
+to stand in for the network round trip; responses to back-to-back requests are
+delayed concurrently, as they would be on a real link.
+
+    python dev/mock_servers/zijie_asr_server.py --port 8766 --rtt 0.08
+"""
+import gzip
+import json
+import asyncio
+import argparse
+
+import websockets
+
+CLIENT_FULL_REQUEST = 0b0001
+CLIENT_AUDIO_ONLY_REQUEST = 0b0010
+NEG_SEQUENCE = 0b0010
+SERVER_FULL_RESPONSE = 0b1001
+SERVER_ERROR_RESPONSE = 0b1111
+
+
+def full_response(payload):
+    body = gzip.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+    message = bytearray([0x11, SERVER_FULL_RESPONSE << 4, 0x11, 0x00])
+    message.extend(len(body).to_bytes(4, "big"))
+    message.extend(body)
+    return bytes(message)
+
+
+def error_response(code, text):
+    body = gzip.compress(json.dumps({"code": code, "message": text}).encode("utf-8"))
+    message = bytearray([0x11, SERVER_ERROR_RESPONSE << 4, 0x11, 0x00])
+    message.extend(code.to_bytes(4, "big"))
+    message.extend(len(body).to_bytes(4, "big"))
+    message.extend(body)
+    return bytes(message)
+
+
+def parse_request(message):
+    header_size = message[0] & 0x0f
+    message_type = message[1] >> 4
+    flags = message[1] & 0x0f
+    payload = message[header_size * 4:]
+    payload_size = int.from_bytes(payload[:4], "big")
+    return message_type, flags, gzip.decompress(payload[4:4 + payload_size])
+
+
+def make_handler(args):
+    async def handler(ws):
+        state = {"sequence": 0, "bytes": 0, "reqid": None, "rate": 16000}
+        # 按接收顺序依次发送响应，每个响应都延迟rtt秒，但不同的请求的延迟互相重叠
+        replies = asyncio.Queue()
+
+        async def reply_loop():
+            while True:
+                due, message = await replies.get()
+                delay = due - asyncio.get_running_loop().time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await ws.send(message)
+
+        replier = asyncio.ensure_future(reply_loop())
+        try:
+            async for message in ws:
+                message_type, flags, body = parse_request(message)
+                if message_type == CLIENT_FULL_REQUEST:
+                    request = json.loads(body)
+                    state["reqid"] = request["request"]["reqid"]
+                    state["rate"] = int(request["audio"].get("rate", 16000))
+                elif message_type != CLIENT_AUDIO_ONLY_REQUEST:
+                    await ws.send(error_response(1001, "unexpected message type"))
+                    break
+                else:
+                    state["bytes"] += len(body)
+                state["sequence"] += 1
+                last = message_type == CLIENT_AUDIO_ONLY_REQUEST and flags == NEG_SEQUENCE
+                seconds = state["bytes"] / (state["rate"] * 2)
+                payload = {
+                    "reqid": state["reqid"],
+                    "code": 1000,
+                    "message": "Success",
+                    "sequence": -state["sequence"] if last else state["sequence"],
+                    "result": [{"text": f"收到{state['sequence'] - 1}包，共{seconds:.1f}秒音频"}],
+                }
+                replies.put_nowait((asyncio.get_running_loop().time() + args.rtt, full_response(payload)))
+        finally:
+            replier.cancel()
+    return handler
+
+
+async def serve(args, ready=None):
+    async with websockets.serve(make_handler(args), args.host, args.port, max_size=None):
+        print(f"mock zijie asr listening on ws://{args.host}:{args.port}/api/v2/asr (rtt {args.rtt * 1000:.0f} ms)")
+        if ready is not None:
+            ready.set()
+        await asyncio.Future()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--rtt", type=float, default=0.08, help="seconds added before every response")
+    return parser
+
+
+def main():
+    asyncio.run(serve(build_parser().parse_args()))
+
+
+if __name__ == "__main__":
+    main()
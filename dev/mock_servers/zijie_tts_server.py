@@ -0,0 +1,129 @@
+"""
+Local stand-in for the Volcano Engine streaming TTS websocket (`/api/v1/tts/ws_binary`).
+
+It speaks the same binary protocol as the real service: it accepts one gzip'd
+JSON full-client request with `operation: submit` and answers with a stream of
+audio-only responses carrying a sine tone as 16 bit mono PCM, the last one
+flagged with a negative sequence number. The tone length follows the text
+length so longer sentences stream more chunks.
+
+    python dev/mock_servers/zijie_tts_server.py --port 8765 --first-chunk-delay 0.3
+    export zijie_tts_ws_url=ws://127.0.0.1:8765/api/v1/tts/ws_binary
+
+    # measure time-to-first-audio through src/zijie_tts.tts_stream
+    python dev/mock_servers/zijie_tts_server.py --client "你好，今天天气怎么样？"
+"""
+import os
+import sys
+import gzip
+import json
+import math
+import time
+import asyncio
+import argparse
+
+import websockets
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "src")
+)
+
+SERVER_AUDIO_ONLY_RESPONSE = 0b1011
+SERVER_ERROR_RESPONSE = 0b1111
+SECONDS_PER_CHAR = 0.2
+
+
+def sine_pcm(seconds, rate, freq=440.0):
+    n = int(seconds * rate)
+    return b"".join(
+        int(8000 * math.sin(2 * math.pi * freq * i / rate)).to_bytes(2, "little", signed=True)
+        for i in range(n)
+    )
+
+
+def audio_response(sequence, payload):
+    message = bytearray([0x11, (SERVER_AUDIO_ONLY_RESPONSE << 4) | (0b0010 if sequence < 0 else 0b0001), 0x00, 0x00])
+    message.extend(sequence.to_bytes(4, "big", signed=True))
+    message.extend(len(payload).to_bytes(4, "big"))
+    message.extend(payload)
+    return bytes(message)
+
+
+def error_response(code, text):
+    payload = text.encode("utf-8")
+    message = bytearray([0x11, SERVER_ERROR_RESPONSE << 4, 0x10, 0x00])
+    message.extend(code.to_bytes(4, "big"))
+    message.extend(len(payload).to_bytes(4, "big"))
+    message.extend(payload)
+    return bytes(message)
+
+
+def make_handler(args):
+    async def handler(ws):
+        # 与真实服务一样，一个连接上可以依次处理多个合成请求。
+        async for res in ws:
+            await synthesize(ws, res)
+
+    async def synthesize(ws, res):
+        header_size = res[0] & 0x0f
+        payload = res[header_size * 4:]
+        payload_size = int.from_bytes(payload[:4], "big")
+        request = json.loads(gzip.decompress(payload[4:4 + payload_size]))
+        if request["request"].get("operation") != "submit":
+            await ws.send(error_response(3001, "only operation=submit is supported"))
+            return
+        text = request["request"]["text"]
+        rate = int(request["audio"].get("rate", 24000))
+        pcm = sine_pcm(max(len(text), 1) * SECONDS_PER_CHAR, rate)
+        chunk_size = int(rate * 2 * args.chunk_ms / 1000)
+
+        await asyncio.sleep(args.first_chunk_delay)
+        chunks = [pcm[i:i + chunk_size] for i in range(0, len(pcm), chunk_size)]
+        for sequence, chunk in enumerate(chunks, 1):
+            last = sequence == len(chunks)
+            await ws.send(audio_response(-sequence if last else sequence, chunk))
+            if not last:
+                await asyncio.sleep(args.chunk_interval)
+    return handler
+
+
+async def serve(args):
+    async with websockets.serve(make_handler(args), args.host, args.port, max_size=None):
+        print(f"mock zijie tts listening on ws://{args.host}:{args.port}/api/v1/tts/ws_binary")
+        await asyncio.Future()
+
+
+def run_client(args):
+    from zijie_tts import tts_stream
+
+    url = f"ws://{args.host}:{args.port}/api/v1/tts/ws_binary"
+    # 第二次请求复用第一次请求建立的连接
+    for attempt in range(2):
+        start = time.perf_counter()
+        first = None
+        total = 0
+        for chunk in tts_stream(args.client, ws_url=url):
+            if first is None:
+                first = time.perf_counter() - start
+            total += len(chunk)
+        print(f"request {attempt + 1}: first chunk after {first * 1000:.0f} ms, {total} bytes in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--chunk-ms", type=int, default=100, help="audio duration carried by each chunk")
+    parser.add_argument("--chunk-interval", type=float, default=0.05, help="seconds between chunks")
+    parser.add_argument("--first-chunk-delay", type=float, default=0.2, help="seconds before the first chunk")
+    parser.add_argument("--client", metavar="TEXT", help="run as a client against a running server instead")
+    args = parser.parse_args()
+
+    if args.client:
+        run_client(args)
+    else:
+        asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,14 +14,18 @@ sys.path.append(
 )
 
 from typing import List
-from pygame import mixer
-from zijie_tts import tts
+from zijie_tts import tts, read_audio, remove_audio
+from playback import get_playback_engine
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 from ali_tts import AliTTSSpeaker
+from text_segmenter import SentenceSegmenter
+from connections import CONNECTIONS
+from app_config import CONFIG, ConfigError, get_config
+from moderation import get_moderator
 from zijie_stt import zijie_stt_gradio
 from langchain_ollama import ChatOllama 
 from ali.realtime_speech_recognition import ali_rstt
-from flask import Flask, request,send_file, make_response,after_this_request
 
 
 from aliyunsdkcore.client import AcsClient
@@ -31,18 +35,20 @@ from aliyunsdknlp_automl.request.v20191111 import RunPreTrainServiceRequest
 
 
 # Aliyun Machine Translation
-from alibabacloud_tea_util import models as util_models
-from alibabacloud_tea_util.client import Client as UtilClient
-from alibabacloud_tea_openapi import models as open_api_models
-from alibabacloud_alimt20181012.models import TranslateGeneralResponse
-from alibabacloud_alimt20181012 import models as alimt_20181012_models
 from alibabacloud_alimt20181012.client import Client as alimt20181012Client
+from translation import get_translation_service
+from language_id import get_translation_router
+from speculation import PartialTranscriptSpeculator
+from signals import TurnState
+from remote_gateway import DEFAULT_SESSION, RemoteGateway, UploadStream, get_gateway
+from scheduler import get_scheduler
 
 
 
 # from ali_stt_voice_awake import lingji_stt_gradio_va
 END = None  # 使用None表示结束标识符
 OUTPUT_LOG_DEBUG = True # 是否输出日志
+TTS_MAX_WORKERS = 3 # TTS模块同时合成的句子数量上限，可以通过Backend的tts_workers参数修改
 PREPARED_TEXT = "你好，此次输入不合规，顾不做回答（此次对话不会记录到聊天记录中）。" # 内容审核模块，如果输入不合规，则输出默认回复
 
 def get_logger():
@@ -70,24 +76,16 @@ def get_logger():
 
 def load_config():
     """
-    检测当前文件的目录下是否有"config.json"文件，如果有的话，则解析，并放到环境变量中。
+    解析当前文件目录下的"config.json"文件（同时同步到环境变量）。
+    之后通过app_config.get_config()读取配置，文件修改后会自动重新加载，不需要重启进程。
     """
-    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
-    if os.path.exists(config_path):
-        try:
-            with open(config_path, 'r') as f:
-                config = json.load(f)
-                for key, value in config.items():
-                    os.environ[key] = str(value)
-                LOGGER.info(f"Loaded config from {config_path}")
-        except Exception as e:
-            LOGGER.error(f"Error loading config from {config_path}: {e}")
-    else:
-        LOGGER.warning(f"Config file not found at {config_path}")
+    try:
+        return CONFIG.get()
+    except ConfigError as e:
+        LOGGER.error(e)
 
 LOGGER = get_logger()
 load_config()
-app = Flask(__name__)
 
 
 
@@ -121,43 +119,57 @@ class STT4AliRSTT(STT):
         self.stt_api(*(self.args_for_run), **(self.kwargs_for_run))
 
 class RemoteSTT(STT):
-    def __init__(self, stt_api_for_1file, text, *args, **kwargs):
+    def __init__(self, stt_api_for_1file, text, *args, in_memory: bool = False, stream_api=None, session_id: str = DEFAULT_SESSION, gateway: RemoteGateway = None, **kwargs):
         '''
         stt_api_for_1file: 一个函数，接收一个音频文件路径，返回一个字符串。
+        in_memory: 为True时，上传的音频数据（bytes）直接交给stt_api_for_1file，不再写入临时文件，
+                   要求stt_api_for_1file也能接收内存中的音频，例如zijie_stt._zijie_stt_gradio。
+        stream_api: 识别流式上传（/upload/stream）的音频，接收UploadStream以及format、sample_rate参数，返回一个字符串；
+                    音频一边上传一边识别，上传结束后很快就能拿到结果，例如zijie_stt.zijie_stt_stream（需要与stt_api_for_1file使用同一家的识别服务）。
+                    默认为None：等上传结束后按stt_api_for_1file处理，不会把音频发送给其他的识别服务。
+        session_id: 开发板的会话ID，只处理这个会话上传的音频；旧固件没有会话ID，属于DEFAULT_SESSION。
+        gateway: 接收上传的RemoteGateway，默认使用进程内共享的网关。
         '''
         STT.__init__(self, stt_api_for_1file, text, *args, **kwargs)
-        self.audio_queue = multiprocessing.Queue()
+        self.gateway = gateway or get_gateway()
+        self.session = self.gateway.session(session_id)
+        self.audio_queue = self.session.uploads
+        self.in_memory = in_memory
+        self.stream_api = stream_api
 
     def run(self):
-        # Start Flask server in a separate thread
-        server_thread = Thread(target=self.start_flask, daemon=True)
-        server_thread.start()
+        # 网关在进程内只启动一次，路由也只注册一次
+        self.gateway.start()
         
         # Process audio data from the queue
-        while True:
-            if not self.audio_queue.empty():
-                audio_data = self.audio_queue.get()
-                random_name = self.generate_random_name()
-                audio_file = f"{random_name}.wav"
-                with open(audio_file, 'wb') as f:
-                    f.write(audio_data)
-                self.text['text'] = self.stt_api(audio_file)
-                LOGGER.info(f"Transcribed Text: {self.text['text']}")
-                # delete audio file with its absolute path
-                os.remove(audio_file)
-                break
-            else:
-                time.sleep(1)
-                LOGGER.info("Waiting for audio data...")
-
-    def start_flask(self):
-        @app.route('/upload', methods=['POST'])
-        def receive_audio():
-            audio_data = request.data
-            self.audio_queue.put(audio_data)
-            return 'Audio data received', 200
-
-        app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
+        # 阻塞等待上传的音频，音频到达时立即被唤醒，等待期间不占用CPU
+        LOGGER.info(f"Waiting for audio data of session {self.session.session_id}...")
+        audio_data = self.audio_queue.get()
+        if isinstance(audio_data, UploadStream):
+            # 开发板在上传中途断开时，迭代UploadStream会抛出异常；这里给出默认的文本，避免等待这一轮文本的阶段永远阻塞
+            try:
+                if self.stream_api is not None:
+                    audio_data.ready.wait()
+                    self.text['text'] = self.stream_api(audio_data, format=audio_data.format, sample_rate=audio_data.sample_rate)
+                    LOGGER.info(f"Transcribed Text: {self.text['text']}")
+                    return
+                audio_data = audio_data.read()
+            except Exception as e:
+                LOGGER.error(f"RemoteSTT: streamed upload of session {self.session.session_id} failed: {e}")
+                self.text['text'] = "你说的什么？"
+                return
+        if self.in_memory:
+            self.text['text'] = self.stt_api(audio_data)
+            LOGGER.info(f"Transcribed Text: {self.text['text']}")
+            return
+        random_name = self.generate_random_name()
+        audio_file = f"{random_name}.wav"
+        with open(audio_file, 'wb') as f:
+            f.write(audio_data)
+        self.text['text'] = self.stt_api(audio_file)
+        LOGGER.info(f"Transcribed Text: {self.text['text']}")
+        # delete audio file with its absolute path
+        os.remove(audio_file)
 
     def generate_random_name(self, length=8):
         parent_path = '/'
@@ -182,6 +194,60 @@ class InputProcess(threading.Thread):
         LOGGER.debug("Prompt is \n\n{}\n\n".format(final_input))
         return final_input
 
+class GatedQueue:
+    '''
+    放在text_queue前面的"闸门"：闸门打开之前，放入的内容先缓存起来；
+    open()时把缓存的内容按顺序转交给text_queue，之后直接转交；discard()时丢弃缓存，之后放入的内容也全部丢弃。
+    用于在内容审核的结果返回之前，提前运行LLM（推测执行）。
+    link(other_queue)返回一个与它同时打开、同时丢弃的闸门，例如前端用来显示token的队列。
+    '''
+    def __init__(self, text_queue: queue.Queue):
+        self.text_queue = text_queue
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._state = None  # None: 等待审核结果，True: 已打开，False: 已丢弃
+        self._linked = []
+
+    def put(self, item, *args, **kwargs):
+        with self._lock:
+            if self._state is None:
+                self._buffer.append(item)
+                return
+            if not self._state:
+                return
+        self.text_queue.put(item, *args, **kwargs)
+
+    def link(self, other_queue) -> "GatedQueue":
+        with self._lock:
+            gate = GatedQueue(other_queue)
+            self._linked.append(gate)
+            state = self._state
+        # 审核结果已经返回时，新的闸门直接处于相同的状态
+        if state is True:
+            gate.open()
+        elif state is False:
+            gate.discard()
+        return gate
+
+    def open(self):
+        with self._lock:
+            # 持有锁转交缓存，保证缓存的内容排在之后放入的内容前面
+            for item in self._buffer:
+                self.text_queue.put(item)
+            self._buffer.clear()
+            self._state = True
+            linked = list(self._linked)
+        for gate in linked:
+            gate.open()
+
+    def discard(self):
+        with self._lock:
+            self._buffer.clear()
+            self._state = False
+            linked = list(self._linked)
+        for gate in linked:
+            gate.discard()
+
 class LLM(threading.Thread):
     def __init__(
             self, 
@@ -194,6 +260,10 @@ class LLM(threading.Thread):
         super().__init__(daemon=True)
         self.text_queue = text_queue
         self.text = text
+        # 可以传入自定义的分句器（截断符号、句子长度），默认与原先的切分规则一致。
+        self.segmenter: SentenceSegmenter = kwargs_for_run.pop("segmenter", None) or SentenceSegmenter()
+        # 设置后，推理在下一个token到达时停止
+        self.cancel_event = threading.Event()
         
         self.args_for_run = args_for_run
         self.kwargs_for_run = kwargs_for_run
@@ -207,61 +277,59 @@ class LLM(threading.Thread):
             ('system', "You are a helpful assistant and only can speak English and Chinese."),
             ("human", query)
         ]
-        self.model = ChatOllama(
-            model=ollama_model_name,
-            base_url=ollama_base_url
-        )
+        self.model = LLM.get_model(ollama_model_name, ollama_base_url)
         return self.model.stream(messages, *args, **kwargs)
 
+    _models = {}
+    _models_lock = threading.Lock()
+
+    @staticmethod
+    def get_model(ollama_model_name, ollama_base_url) -> ChatOllama:
+        '''同一个模型在进程内只创建一次ChatOllama，后续的对话复用它的HTTP连接。'''
+        with LLM._models_lock:
+            key = (ollama_model_name, ollama_base_url)
+            if key not in LLM._models:
+                LLM._models[key] = ChatOllama(
+                    model=ollama_model_name,
+                    base_url=ollama_base_url
+                )
+            return LLM._models[key]
+
+    def cancel(self) -> None:
+        '''取消推理：不再读取后续的token，也不再往text_queue中放入内容。'''
+        self.cancel_event.set()
+
     def _run2(self, llm_iterator, *args, **kwargs) -> None:
         '''对LLM的输出做实时处理：若输出了完整的一句话，则把这个句子放入到一个Text queue队列中。如果LLM推理结束，则往Text queue队列中放入一个结束标志符号END。'''
         self.__run2_ollama(llm_iterator, *args, **kwargs)
 
     def __run2_ollama(self, llm_iterator, *args, **kwargs):
-        old_total_response = ""
-        current_total_response = ""
+        # 分句器只扫描新到的token，每个token的开销与已生成的回复长度无关。
+        self.segmenter.reset()
+        sentences = []
         for response_token in llm_iterator:
-            response_token = response_token.content
-            # 每次拿到reponse时，使用新的response去掉old_total_response，得到response_delta，这个就是在当前时间点得到的response。
-            current_total_response += response_token
-            response_delta = self.__remove_first_match(current_total_response, old_total_response)
-
-            # 我们对response_delta进行这样的操作，从左到右，判断其是否有有'，。！？'等符号，如果有的话，就从左到右，从开头到这个符号为止，截取这段文本，然后把这段文本放入到text队列中，以及拼接到old_total_response对象右侧。如果没有，则不做操作。
-            while response_delta:
-                # 找到第一个标点符号的位置
-                ## i for i in xxx, 叫做生成器表达式，使用圆括号包裹生成器表达式，表示这是一个generator，而使用[]或{}的话，则表示是一个列表或集合表达式，
-                ## 前者不会把for表达式执行完，然后返回结果，而是返回一个generator对象，只有在遍历这个对象（比如使用next方法）的时候才会执行for表达式，然后返回结果。
-                ## 而列表或集合表达式会立即执行for表达式，然后返回结果。
-                ## 返回generator的方式称为惰性计算，只有在需要的时候才把值放到内存中。每次迭代时，生成器都会返回一个值，然后记住当前位置，下次遍历这个生成器时，则会从之前记住的位置的下一个位置开始便利。
-                ## 不把英文的'.'算入截断标点符号中，因为大模型生成的文本中，标题会用到'.'，比如'6.'
-                punctuation_index = next((i for i, char in enumerate(response_delta) if char in [',' , '，', '。', '！', '？', '!', '?']), -1)
-                if punctuation_index != -1:                          # 如果生成器表达式不是空的，即找的到第一个标点符号
-                    text = response_delta[:punctuation_index + 1]    # 截取这段文本
-                    old_total_response += text                  # 拼接到old_total_response对象右侧
-                    self.text_queue.put(text)               # 把这段文本放入到text队列中
-                    LOGGER.debug("LLM: new sentence: {}".format(old_total_response))
-                    
-                    # 如果response_delta中存在不止一个符号，那么我们在做完第一个符号对应的工作后，把response_delta更新为去掉第一段文本的剩下文本，然后进行同样的操作。
-                    response_delta = response_delta[punctuation_index + 1:]
-                
-                # 如果response_delta没有'，。！？'等符号了，则不做操作。
-                if punctuation_index==-1:
-                    break
-        
+            if self.cancel_event.is_set():
+                LOGGER.debug("LLM: generation cancelled.")
+                # 关闭迭代器，停止从Ollama接收后续的token
+                if hasattr(llm_iterator, "close"):
+                    llm_iterator.close()
+                return
+            for sentence in self.segmenter.feed(response_token.content):
+                self.text_queue.put(sentence)               # 把这段文本放入到text队列中
+                sentences.append(sentence)
+                LOGGER.debug("LLM: new sentence: {}".format(sentence))
+
         # 最后一个句子可能会没有标点符号，所以需要特殊处理。
-        if response_delta:  # 如果最后一个句子确实没有标点。
-            self.text_queue.put(response_delta)
-        
+        last_sentence = self.segmenter.flush()
+        if last_sentence:
+            self.text_queue.put(last_sentence)
+            sentences.append(last_sentence)
+        # 完整的回复，用于记录对话历史
+        self.response = "".join(sentences)
+
         # 生成完成后，往队列中放入一个END结束标识符。
-        self.text_queue.put(END)     
+        self.text_queue.put(END)
 
-    def __remove_first_match(self, s:str, sub_s:str):
-        '''从s中删除第一次出现的sub_s'''
-        if sub_s in s:
-            return s.replace(sub_s, '', 1)
-        else:
-            return s
-        
     def run(self) -> None:
         self.query = self.text['text']
         response_iterator = self._run(self.query, *(self.args_for_run), **(self.kwargs_for_run))
@@ -271,13 +339,21 @@ class LLM(threading.Thread):
 class LLM4AliTTSSpeaker(LLM):
     
     def _LLM__run2_ollama(self, llm_iterator, *args, **kwargs):
+        # dashscope的streaming_call接收流式输入，自己决定何时合成；每个token都直接交给它，不需要先分句。
+        tokens = []
         for response_token in llm_iterator:
+            if self.cancel_event.is_set():
+                if hasattr(llm_iterator, "close"):
+                    llm_iterator.close()
+                return
             response_token = response_token.content
+            tokens.append(response_token)
             
             self.text_queue.put({
                 "type": "message",
                 "content": response_token
             })
+        self.response = "".join(tokens)
         
         # 生成完成后，往队列中放入一个END结束标识符。
         self.text_queue.put({
@@ -286,12 +362,18 @@ class LLM4AliTTSSpeaker(LLM):
         })
 
 class TTS(threading.Thread):
-    def __init__(self, text_queue: queue.Queue, audio_queue: queue.Queue, *args, **kwargs):
-        """从Text queue队列中依次拿出sentence，并把其转换成音频，然后存储在一个Audio queue队列中。如果拿到结束标志符号END，则把这个符号放到Audio queue队列中。"""
+    def __init__(self, text_queue: queue.Queue, audio_queue: queue.Queue, *args, max_workers: int = 1, persistent: bool = False, **kwargs):
+        """从Text queue队列中依次拿出sentence，并把其转换成音频，然后存储在一个Audio queue队列中。如果拿到结束标志符号END，则把这个符号放到Audio queue队列中。
+        ----
+        max_workers: 同时进行语音合成的句子数量上限。合成是并行的，但音频仍然按照句子的原始顺序放入Audio queue队列。
+        persistent: 为True时，END只表示一轮对话结束，线程继续处理下一轮对话（供Session使用）。
+        """
         super().__init__(daemon=True)
 
         self.text_queue = text_queue
         self.audio_queue = audio_queue
+        self.max_workers = max(1, int(max_workers))
+        self.persistent = persistent
 
         self.args_for_run = args
         self.kwargs_for_run = kwargs
@@ -301,156 +383,218 @@ class TTS(threading.Thread):
         return tts(text, *self.args_for_run, **self.kwargs_for_run)
     
     def run(self, *args, **kwargs):
+        if self.max_workers == 1:
+            while True:
+                # block if necessary until an item is available
+                sentence = self.text_queue.get()
+                if sentence is None:
+                    self.audio_queue.put(None)
+                    if self.persistent:
+                        continue
+                    break
+                try:
+                    audio = self._run(sentence, *self.args_for_run, **self.kwargs_for_run)
+                except Exception as e:
+                    LOGGER.error("TTS: Error in synthesis: {}".format(e))
+                    continue
+                # 合成失败的句子直接跳过，避免None被Speaker当作END。
+                if audio is not None:
+                    self.audio_queue.put(audio)
+            return
+
+        # 按提交顺序保存future，队列的容量限制了同时在合成中的句子数量。
+        # 收集线程手上还有一个正在等待的future，所以容量为max_workers - 1。
+        pending: queue.Queue = queue.Queue(maxsize=self.max_workers - 1)
+        collector = Thread(target=self._collect, args=(pending,), daemon=True)
+        collector.start()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tts") as executor:
+            while True:
+                sentence = self.text_queue.get()
+                if sentence is None:
+                    pending.put(END)
+                    if self.persistent:
+                        continue
+                    break
+                pending.put(executor.submit(self._run, sentence, *self.args_for_run, **self.kwargs_for_run))
+            collector.join()
+
+    def _collect(self, pending: queue.Queue):
+        '''按照句子的原始顺序等待合成结果，并放入Audio queue队列。'''
         while True:
-            # block if necessary until an item is available
-            sentence = self.text_queue.get()
-            if sentence is None:
-                self.audio_queue.put(None)
+            future = pending.get()
+            if future is END:
+                self.audio_queue.put(END)
+                if self.persistent:
+                    continue
                 break
-            self.audio_queue.put(self._run(sentence, *self.args_for_run, **self.kwargs_for_run))
+            try:
+                audio = future.result()
+            except Exception as e:
+                LOGGER.error("TTS: Error in synthesis: {}".format(e))
+                continue
+            # 合成失败的句子直接跳过，避免None被Speaker当作END。
+            if audio is not None:
+                self.audio_queue.put(audio)
 
 class Speaker(threading.Thread):
-    def __init__(self, audio_queue: queue.Queue):
-        """Audio queue队列被不停的拿出音频，进行播放，直到拿到结束标志符号END"""
+    def __init__(self, audio_queue: queue.Queue, persistent: bool = False):
+        """Audio queue队列被不停的拿出音频，进行播放，直到拿到结束标志符号END
+        ----
+        persistent: 为True时，拿到END并播放完毕后，设置turn_finished，然后继续播放下一轮对话的音频（供Session使用）。
+        """
         super().__init__(daemon=True)
 
         self.audio_queue = audio_queue
+        self.persistent = persistent
+        self.turn_finished = threading.Event()
     
     def _run(self, *args, **kwargs):
-        # 使用mixer类进行播放         
+        # 使用进程内共享的播放引擎：音频依次排队，首尾相接地播放，播放完成通过事件通知。
+        engine = get_playback_engine()
+        last_handle = None
+        while True:
+            audio = self.audio_queue.get()
+            # LOGGER.debug("Speaker: Received audio: {}".format(audio))
+            if audio is None:
+                if last_handle is not None:
+                    last_handle.wait()
+                    last_handle = None
+                self.turn_finished.set()
+                if self.persistent:
+                    continue
+                break
+
+            # 一段音频播放失败时只跳过这一段，persistent的Speaker继续播放后面的音频和之后的对话。
+            try:
+                # 流式合成的音频，在第一个数据块到达时就开始播放。
+                last_handle = engine.play(audio)
+            except Exception as e:
+                LOGGER.error("Speaker: Error in playing {}: {}".format(audio, e))
+            finally:
+                # 音频在排队时已经被读入内存，临时文件可以直接删除。
+                remove_audio(audio)
+    
+    def run(self, *args, **kwargs):
         try:
-            mixer.init()
-            while True:
-                audio = self.audio_queue.get()
-                # LOGGER.debug("Speaker: Received audio: {}".format(audio))
-                if audio is None:
-                    break
-                
-                mixer.music.load(audio)
-                mixer.music.play()
-                while mixer.music.get_busy():
-                    time.sleep(0.001)
-                
-                mixer.music.unload()
-                os.remove(audio)
-            mixer.quit()
+            self._run(*args, **kwargs)
         except Exception as e:
             LOGGER.error("Speaker: Error in _run: {}".format(e))
-    
-    def run(self, *args, **kwargs):
-        self._run(*args, **kwargs)
+        finally:
+            # 线程退出时（包括出错时）唤醒等待这一轮结束的调用方，避免其永远阻塞。
+            self.turn_finished.set()
         LOGGER.debug("Speaker: Speaker thread exited.")
 
 class RemoteSpeaker(Speaker):
-    def __init__(self, audio_queue: queue.Queue):
-        """Initialize RemoteSpeaker with an audio queue and set up Flask endpoints"""
-        super().__init__(audio_queue)
-        self.current_audio = None
-        self.audio_ready = threading.Event()
-        self.end_of_audio = False
-        self.final_request_received = threading.Event()
+    def __init__(self, audio_queue: queue.Queue, persistent: bool = False, session_id: str = DEFAULT_SESSION, gateway: RemoteGateway = None):
+        """
+        把音频交给开发板：开发板通过RemoteGateway的/audio（或/sessions/<session_id>/audio）接口逐段取走音频，
+        或者通过/audio/stream接口在一个响应中接收整轮的音频。
+        ----
+        session_id: 开发板的会话ID，多个开发板各自使用自己的RemoteSpeaker，互不影响。
+        persistent: 为True时，开发板确认一轮结束后设置turn_finished，然后继续处理下一轮的音频（供Session和AsyncPipeline使用）。
+        gateway: 默认使用进程内共享的网关，路由只在网关创建时注册一次。
+        心跳超时和等待开发板取走END的超时都注册到进程共享的调度器（scheduler.get_scheduler()）中，不为每个开发板创建监控线程。
+        """
+        super().__init__(audio_queue, persistent=persistent)
+        self.gateway = gateway or get_gateway()
+        self.session = self.gateway.session(session_id)
+        self.scheduler = get_scheduler()
         self.workflow_started = threading.Event()  # New event for workflow control
         self.heartbeat_timeout = 10  # 25 second timeout
+        self.end_timeout = 30  # 等待开发板取走END的超时
         self.should_terminate = threading.Event()  # New event for graceful termination
-        
-        app.url_map._rules.clear()
-        app.url_map._rules_by_endpoint.clear()
-
-        # @app.route('/start', methods=['POST'])
-        # def receive_start_signal():
-        #     """Endpoint to receive the initial greeting message"""
-        #     self.workflow_started.set()
-        #     # regarded as a heartbeat
-        #     self.last_heartbeat = time.time()
-        #     LOGGER.debug("RemoteSpeaker: Received start signal")
-        #     return 'Workflow started', 200
-
-
-        # I may receive a heartbeat from client before the class' start method is called 
-        # because this method is registered when the class is instantiated.
-        # so I can receive a heartbeat when the RemoteSTT thread is running.
-        @app.route('/heartbeat', methods=['POST', 'GET'])
-        def heartbeat():
-            """Endpoint to receive heartbeat from client"""
-            self.last_heartbeat = time.time()
-            LOGGER.debug("RemoteSpeaker: Heartbeat received")
-            return 'Heartbeat received', 200
-
-        @app.route('/audio', methods=['GET'])
-        def serve_audio():
-            # # Only serve audio after receiving start signal
-            # if not self.workflow_started.is_set():
-            #     return 'Workflow not started', 403
-            
-            if self.audio_ready.wait(timeout=300):
-
-                if self.current_audio:
-                    with open(self.current_audio, 'rb') as f:
-                        audio_data = f.read()
-                    self.current_audio = None
-                    self.audio_ready.clear()
-                    return audio_data, 200
-                elif self.end_of_audio:
-                    @after_this_request
-                    def set_final_received(response):
-                        # This return is for Flask's middleware chain
-                        # Not for sending to client (already sent)
-                        # to confirm that the code after the response to client is worked
-
-                        self.final_request_received.set()   # Do task after serving client
-                        return response  # Tell Flask "Yes, I did my after-serving task"
-                    return 'END', 204
-                
-            return 'No audio available', 404
+        self._heartbeat_deadline = None
+        self._heartbeat_lock = threading.Lock()
+
+    @property
+    def current_audio(self):
+        return self.session.current_audio
+
+    @property
+    def last_heartbeat(self):
+        # I may receive a heartbeat from client before the class' start method is called,
+        # the gateway records it in the session.
+        return self.session.last_heartbeat
+
+    def terminate(self):
+        """停止服务，并唤醒正在等待客户端取走音频（或者END）的_run"""
+        self.should_terminate.set()
+        self.session.terminate()
+        self.session.final_request_received.set()
 
     def _run(self, *args, **kwargs):
-        server_thread = Thread(target=lambda: app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False, threaded=True), daemon=True)
-        server_thread.start()
+        self.gateway.start()
+        self.session.new_turn()
 
         flag_first_audio = True
 
-        while not self.should_terminate.is_set():
-            audio = self.audio_queue.get()
+        try:
+            while not self.should_terminate.is_set():
+                audio = self.audio_queue.get()
 
-            # we can't start heartbeat monitor thread before the first audio is received,
-            # because the first audio may be available for a long time at the first time because of the LLM loading time.
-            if flag_first_audio:
-                # Start heartbeat monitor thread
-                heartbeat_thread = Thread(target=self._monitor_heartbeat, daemon=True)
-                heartbeat_thread.start()
-                LOGGER.debug("RemoteSpeaker: Heartbeat monitor thread started")
+                # we can't start heartbeat monitor before the first audio is received,
+                # because the first audio may be available for a long time at the first time because of the LLM loading time.
+                if flag_first_audio:
+                    # Reset last_heartbeat when starting the monitor
+                    self.session.heartbeat()
+                    with self._heartbeat_lock:
+                        self._arm_heartbeat()
+                    LOGGER.debug("RemoteSpeaker: Heartbeat monitor started")
 
-                flag_first_audio = False
+                    flag_first_audio = False
 
-            self.current_audio = audio
-            self.audio_ready.set()
+                self.session.offer(audio)
 
-            if audio is None:
-                self.end_of_audio = True
-                # Wait for final request with timeout
-                if self.final_request_received.wait(timeout=30):
-                    LOGGER.debug("RemoteSpeaker: Final END status sent to client")
-                else:
-                    LOGGER.warning("RemoteSpeaker: Timeout waiting for final request")
-                break
-            
-            while self.current_audio and not self.should_terminate.is_set():
+                if audio is None:
+                    if self._wait_final_request():
+                        LOGGER.debug("RemoteSpeaker: Final END status sent to client")
+                    else:
+                        LOGGER.warning("RemoteSpeaker: Timeout waiting for final request")
+                    self.turn_finished.set()
+                    if self.persistent:
+                        self.session.new_turn()
+                        continue
+                    break
+                
                 LOGGER.debug(f"RemoteSpeaker: Audio file {audio} ready for serving")
-                time.sleep(0.5)
+                self.session.wait_taken()
+        finally:
+            with self._heartbeat_lock:
+                if self._heartbeat_deadline is not None:
+                    self._heartbeat_deadline.cancel()
+                    self._heartbeat_deadline = None
         
         LOGGER.debug("RemoteSpeaker: All audio files processed")
 
-    def _monitor_heartbeat(self):
-        """Monitor heartbeat and terminate if client is unresponsive"""
-        # Reset last_heartbeat when starting the monitor
-        self.last_heartbeat = time.time()
-
-        while not self.should_terminate.is_set():
-            time.sleep(1)
-            if time.time() - self.last_heartbeat > self.heartbeat_timeout:
-                LOGGER.error("RemoteSpeaker: Client heartbeat timeout, terminating thread")
-                self.should_terminate.set()
-                break
+    def _wait_final_request(self) -> bool:
+        """等待开发板取走END，end_timeout秒内没有取走（或者心跳超时）时返回False"""
+        timed_out = threading.Event()
+
+        def on_timeout():
+            timed_out.set()
+            self.session.final_request_received.set()
+        deadline = self.scheduler.call_later(self.end_timeout, on_timeout)
+        self.session.final_request_received.wait()
+        deadline.cancel()
+        return not timed_out.is_set() and not self.should_terminate.is_set()
+
+    def _arm_heartbeat(self):
+        # 在心跳可能超时的时刻检查一次，期间收到的心跳只更新last_heartbeat，不需要重新注册
+        self._heartbeat_deadline = self.scheduler.call_later(self.last_heartbeat + self.heartbeat_timeout - time.time(), self._check_heartbeat)
+
+    def _check_heartbeat(self):
+        """Terminate if client is unresponsive"""
+        with self._heartbeat_lock:
+            # _run已经结束（或者已经终止）时不再检查
+            if self.should_terminate.is_set() or self._heartbeat_deadline is None:
+                return
+            if time.time() - self.last_heartbeat < self.heartbeat_timeout:
+                self._arm_heartbeat()
+                return
+        LOGGER.error("RemoteSpeaker: Client heartbeat timeout, terminating")
+        self.terminate()
+        # 开发板已经离线，从网关中移除它的会话；重新连接的开发板会得到新的会话
+        self.gateway.close_session(self.session.session_id, self.session)
 
 
 class ContextMonitor(threading.Thread):
@@ -475,18 +619,19 @@ class ContextMonitor(threading.Thread):
             self.text_queue.put(END)
 
     def _run(self, text, *args, **kwargs):
-        return self.__run_alibaba_cloud(text, *args, **kwargs)
+        # 本地黑名单和审核结果缓存无法判断的输入，才会请求云端审核
+        return get_moderator().check(text, lambda text: self.__run_alibaba_cloud(text, *args, **kwargs))
     def __run_alibaba_cloud(self, text:str, *args, **kwargs):
         assert type(text)==str
         
-        access_key_id = os.environ.get("context_checking_access_key_id")
-        access_key_secret = os.environ.get("context_checking_access_key_secret")
-
-        # Initialize AcsClient instance
-        client = AcsClient(
-        access_key_id,
-        access_key_secret,
-        "cn-hangzhou"
+        config = get_config()
+        access_key_id = config.context_checking_access_key_id
+        access_key_secret = config.context_checking_access_key_secret
+
+        # AcsClient实例在进程内只创建一次
+        client = CONNECTIONS.client(
+            ("acs", access_key_id, "cn-hangzhou"),
+            lambda: AcsClient(access_key_id, access_key_secret, "cn-hangzhou"),
         )
         content = {"session_id": 0, "text": text}
         # Initialize a request and set parameters
@@ -503,105 +648,74 @@ class ContextMonitor(threading.Thread):
             return True
 
 class MT(threading.Thread):
-    def __init__(self, text):
+    def __init__(self, text, source_language='zh', target_language='en'):
         '''Module of Machine Translation'''
         super().__init__(daemon=True)
         self.text = text
+        self.source_language = source_language
+        self.target_language = target_language
 
     @staticmethod
     def create_client() -> alimt20181012Client:
         """
-        使用AK&SK初始化账号Client
+        使用AK&SK初始化账号Client，client在进程内只创建一次。
         @return: Client
         @throws Exception
         """
-        # 工程代码泄露可能会导致 AccessKey 泄露，并威胁账号下所有资源的安全性。以下代码示例仅供参考。
-        # 建议使用更安全的 STS 方式，更多鉴权访问方式请参见：https://help.aliyun.com/document_detail/378659.html。
-        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')) as F:
-            args = json.load(F)
-            config = open_api_models.Config(
-                # 必填，请确保代码运行环境设置了环境变量 ALIBABA_CLOUD_ACCESS_KEY_ID。,
-                access_key_id=args['machine_translation_key_id'],
-                # 必填，请确保代码运行环境设置了环境变量 ALIBABA_CLOUD_ACCESS_KEY_SECRET。,
-                access_key_secret=args['machine_translation_secret_key']
-            )
-        # Endpoint 请参考 https://api.aliyun.com/product/alimt
-        config.endpoint = f'mt.cn-hangzhou.aliyuncs.com'
-        return alimt20181012Client(config)
+        return get_translation_service().client()
 
     def run(self):          
-        self.text['text'] = self.main(self.text['text'])
+        self.text['text'] = self.main(self.text['text'], self.source_language, self.target_language)
 
     @staticmethod
     def main(
         source_text,
+        source_language='zh',
+        target_language='en',
         *args,
         **kwargs
-    ) -> None:
-        client = MT.create_client()
-        translate_general_request = alimt_20181012_models.TranslateGeneralRequest(
-            format_type='text',
-            source_language='zh',
-            target_language='en',
-            source_text=source_text,
-            scene='general'
-        )
-        runtime = util_models.RuntimeOptions()
-        try:
-            result:TranslateGeneralResponse = client.translate_general_with_options(translate_general_request, runtime)
-            return result.body.data.translated
-        except Exception as error:
-            # 此处仅做打印展示，请谨慎对待异常处理，在工程项目中切勿直接忽略异常。
-            # 错误 message
-            print(error.message)
-            # 诊断地址
-            print(error.data.get("Recommend"))
-            UtilClient.assert_as_string(error.message)
+    ) -> str:
+        # 相同的文本只翻译一次，失败时返回原文
+        return get_translation_service().translate(source_text, source_language, target_language)
 
     @staticmethod
     async def main_async(
-        args: List[str],
-    ) -> None:
-        client = MT.create_client()
-        translate_general_request = alimt_20181012_models.TranslateGeneralRequest(
-            format_type='text',
-            source_language='zh',
-            target_language='en',
-            source_text='你好',
-            scene='general'
-        )
-        runtime = util_models.RuntimeOptions()
-        try:
-            # 复制代码运行请自行打印 API 的返回值
-            await client.translate_general_with_options_async(translate_general_request, runtime)
-        except Exception as error:
-            # 此处仅做打印展示，请谨慎对待异常处理，在工程项目中切勿直接忽略异常。
-            # 错误 message
-            print(error.message)
-            # 诊断地址
-            print(error.data.get("Recommend"))
-            UtilClient.assert_as_string(error.message)
+        source_text,
+        source_language='zh',
+        target_language='en',
+        *args,
+        **kwargs
+    ) -> str:
+        return await get_translation_service().translate_async(source_text, source_language, target_language)
 
 
 class Backend(threading.Thread):
     def __init__(self, *args, **kwargs):
         """把整个异步对话模块整合成一个线程。"""
         super().__init__(daemon=True)
-        self.text = kwargs.get("text", {"text": None})
+        self.text = kwargs.get("text", None)
+        if self.text is None:
+            # STT写入文本时会唤醒等待的阶段
+            self.text = TurnState(text=None)
         self.text_queue = queue.Queue()
         self.audio_queue = queue.Queue()
 
-        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')) as F:
-            _args = json.load(F)
-            self._ollama_model_name = _args['model_name']
-            self._ollama_base_url = _args['llm_url']
-            for key,value in _args.items():
-                os.environ[key] = value
+        # 缺少必填的配置项时在创建时就报错，而不是在对话进行到一半时抛出KeyError
+        _args = CONFIG.require('model_name', 'llm_url')
+        self._ollama_model_name = _args.model_name
+        self._ollama_base_url = _args.llm_url
+        # 在后台预先连接各个云服务，用户说完话时第一句话不需要再等待TCP+TLS握手；进程内只生效一次
+        CONNECTIONS.prewarm()
                 
         self.stt_thread = STT(zijie_stt_gradio, self.text)
         self.input_preprocessing_thread = InputProcess(self.text, kwargs.get("history", None))
         self.llm_thread = LLM(self.text, self.text_queue, ollama_model_name=self._ollama_model_name, ollama_base_url=self._ollama_base_url)
-        self.audio_thread = TTS(self.text_queue, self.audio_queue)
+        self.tts_workers = kwargs.get("tts_workers", TTS_MAX_WORKERS)
+        # 合成的音频保存在内存中，经由audio_queue直接交给Speaker播放，不经过文件系统。
+        self.in_memory_audio = kwargs.get("in_memory_audio", True)
+        # 流式合成：Speaker在第一个音频数据块到达时就开始播放。
+        self.streaming_tts = kwargs.get("streaming_tts", False)
+        self.audio_thread = TTS(self.text_queue, self.audio_queue, max_workers=self.tts_workers, in_memory=self.in_memory_audio, streaming=self.streaming_tts)
         self.speaker_thread = Speaker(self.audio_queue)
 
     def run(self,):
@@ -626,15 +740,18 @@ class Backend4AliTTSSpeaker(threading.Thread):
     def __init__(self, *args, **kwargs):
         """把整个异步对话模块整合成一个线程。"""
         super().__init__(daemon=True)
-        self.text = kwargs.get("text", {"text": None})
+        self.text = kwargs.get("text", None)
+        if self.text is None:
+            # STT写入文本时会唤醒等待的阶段
+            self.text = TurnState(text=None)
         self.text_queue = queue.Queue()
 
-        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')) as F:
-            _args = json.load(F)
-            self._ollama_model_name = _args['model_name']
-            self._ollama_base_url = _args['llm_url']
-            for key,value in _args.items():
-                os.environ[key] = value
+        # 缺少必填的配置项时在创建时就报错，而不是在对话进行到一半时抛出KeyError
+        _args = CONFIG.require('model_name', 'llm_url')
+        self._ollama_model_name = _args.model_name
+        self._ollama_base_url = _args.llm_url
+        # 在后台预先连接各个云服务，用户说完话时第一句话不需要再等待TCP+TLS握手；进程内只生效一次
+        CONNECTIONS.prewarm()
                 
         self.stt_thread = STT(zijie_stt_gradio, self.text)
         self.input_preprocessing_thread = InputProcess(self.text, kwargs.get("history", None))
@@ -662,10 +779,30 @@ class Backend4AliTTSSpeaker(threading.Thread):
 
 class Backend4AliRSTTAliTTSSpeaker(Backend4AliTTSSpeaker):
     def __init__(self, *args, **kwargs):
+        """
+        speculative: 为True时，根据实时语音识别稳定的中间结果提前启动LLM，输出先缓存在GatedQueue中；
+        最终结果与中间结果一致时直接使用这次推理的输出，不一致时取消并按最终结果重新推理。
+        stable_ms: 中间结果保持多长时间不变才认为是稳定的。
+        text: 如果传入，需要是TurnState，run()依靠它在识别出文本时被唤醒。
+        """
         super().__init__(*args, **kwargs)
+        self.history = kwargs.get("history", None)
+        self.speculative = kwargs.get("speculative", False)
 
         # wrap self.text to ali_rstt
-        self.stt_thread = STT4AliRSTT(ali_rstt, self.text, stt_text=self.text)
+        stt_kwargs = {"stt_text": self.text}
+        if self.speculative:
+            self.speculator = PartialTranscriptSpeculator(self._start_speculation, stable_ms=kwargs.get("stable_ms", 300))
+            stt_kwargs["on_partial"] = self.speculator.on_partial
+        self.stt_thread = STT4AliRSTT(ali_rstt, self.text, **stt_kwargs)
+
+    def _start_speculation(self, partial_text):
+        text = {"text": partial_text}
+        InputProcess(text, self.history).run()
+        gate = GatedQueue(self.text_queue)
+        llm_thread = LLM4AliTTSSpeaker(text, gate, ollama_model_name=self._ollama_model_name, ollama_base_url=self._ollama_base_url)
+        llm_thread.start()
+        return llm_thread, gate
 
     def run(self,):
         '''
@@ -675,15 +812,19 @@ class Backend4AliRSTTAliTTSSpeaker(Backend4AliTTSSpeaker):
             self.stt_thread.start()
 
             # 等待进入realtime_speech_recognition.py中的name == "SentenceEnd"分支。
-            # 当进入该分支时，self.text['text']被赋值。
+            # 当进入该分支时，self.text['text']被赋值，TurnState随即唤醒这里。
             # 在此之后可以直接进行后面的处理，因为在此之后，ali_rstt还需要运行几秒钟。
-            while self.text['text'] == None:
-                time.sleep(0.01)
-            
-            self.input_preprocessing_thread.start()
-            self.input_preprocessing_thread.join()
+            self.text.wait_for('text')
             
-            self.llm_thread.start()
+            # 推测执行命中时，LLM已经在运行，直接使用它的输出
+            speculative_llm = self.speculator.resolve(self.text['text']) if self.speculative else None
+            if speculative_llm is not None:
+                self.llm_thread = speculative_llm
+            else:
+                self.input_preprocessing_thread.start()
+                self.input_preprocessing_thread.join()
+                
+                self.llm_thread.start()
             self.ali_tts_thread.start()
 
             self.llm_thread.join()
@@ -696,12 +837,20 @@ class Backend4AliRSTTAliTTSSpeaker(Backend4AliTTSSpeaker):
 
 class ContextMonitorBackend(Backend):
     def __init__(self, prepared_text:str=PREPARED_TEXT, *args, **kwargs):
+        """
+        speculative: 为True时，内容审核与LLM推理同时开始，LLM的输出在审核通过前被GatedQueue缓存，不会被合成和播放；
+        审核不通过时取消推理并丢弃缓存，播放prepared_text。这样首句音频不需要再等待一次内容审核的往返时间。
+        """
         super().__init__(*args, **kwargs)
+        CONFIG.require('context_checking_access_key_id', 'context_checking_access_key_secret')
+        self.speculative = kwargs.get("speculative", False)
         
         self.flag_is_valid = {"value": False}
         self.context_monitor = ContextMonitor(self.text, self.flag_is_valid, self.text_queue, prepared_text)
 
     def run(self,):
+        if self.speculative:
+            return self._run_speculative()
         try:
             self.stt_thread.start()
             self.stt_thread.join()
@@ -730,18 +879,63 @@ class ContextMonitorBackend(Backend):
         except:
             pass
 
+    def _run_speculative(self):
+        try:
+            self.stt_thread.start()
+            self.stt_thread.join()
+
+            # InputProcess会把对话历史拼接到self.text中，审核的只是用户这一次的输入
+            self.context_monitor.text = dict(self.text)
+            self.context_monitor.start()
+
+            # 子类可能替换了llm_thread，所以在启动前才接上闸门
+            gate = GatedQueue(self.text_queue)
+            self.llm_thread.text_queue = gate
+            self.input_preprocessing_thread.start()
+            self.input_preprocessing_thread.join()
+            self.llm_thread.start()
+            self.audio_thread.start()
+            self.speaker_thread.start()
+
+            self.context_monitor.join()
+            if self.flag_is_valid['value']:
+                gate.open()
+                self.llm_thread.join()
+            else:
+                # ContextMonitor已经把prepared_text和END放入text_queue
+                LOGGER.warning("Invalid context, cancelling llm")
+                self.llm_thread.cancel()
+                gate.discard()
+
+            self.audio_thread.join()
+            self.speaker_thread.join()
+        except:
+            pass
+
 class PureEnglishChatBackend(Backend):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.machine_translation_thrad = MT(text=self.text)
-        self.audio_thread = TTS(self.text_queue, self.audio_queue, voice_type=kwargs.get("voice_type", "BV503_streaming"))
+        self.audio_thread = TTS(self.text_queue, self.audio_queue, max_workers=self.tts_workers, in_memory=self.in_memory_audio, streaming=self.streaming_tts, voice_type=kwargs.get("voice_type", "BV503_streaming"))
+        # en（默认）: 从不翻译；zh: 总是翻译；auto: 根据每句话的内容判断是否需要翻译
         self.input_type = kwargs.get("input_type", "en")
+        self.translation_router = get_translation_router("en")
+        # auto和zh都可能请求机器翻译，需要显式选择；缺少密钥时在创建时就报错，而不是在翻译失败后把中文原文交给只懂英文的流程
+        if self.input_type in ("auto", "zh"):
+            CONFIG.require('machine_translation_key_id', 'machine_translation_secret_key')
     
     def run(self):
         self.stt_thread.start()
         self.stt_thread.join()
         
-        if self.input_type == "zh":
+        if self.input_type == "auto":
+            # 本地识别语言，纯英文的输入不再请求机器翻译
+            source_language = self.translation_router.source_language(self.text['text'] or "")
+            LOGGER.debug("PureEnglishChatBackend: translation {}, {}".format(source_language or "skipped", self.translation_router.stats()))
+        else:
+            source_language = "zh" if self.input_type == "zh" else None
+        if source_language is not None:
+            self.machine_translation_thrad.source_language = source_language
             self.machine_translation_thrad.start()
             self.machine_translation_thrad.join()
         
@@ -754,103 +948,114 @@ class PureEnglishChatBackend(Backend):
         self.speaker_thread.join()
 
 
-class VoiceAwakeBackend(multiprocessing.Process):
-    global LOCK
-    LOCK = threading.Lock()
-    
-    class Monitor(threading.Thread):
-        global LOCK
-        def __init__(self, text:dict, flag_kill_dida:dict, flag_kill_monitor:dict) -> None:
-            super().__init__(daemon=True)
-            self.text = text
-            self.flag_kill_dida = flag_kill_dida
-            self.flag_kill_monitor = flag_kill_monitor
-        
-        def run(self):
-            while True:
-                # If there is any text, kill dida and itself.
-                if self.text['text']:
-                    # set the value as True, and then the dida thread will suicide.
-                    with LOCK:
-                        self.flag_kill_dida['value'] = True
-                    LOGGER.debug(f"monitor is exit.") if OUTPUT_LOG_DEBUG else None
-                    break
-                elif self.flag_kill_monitor['value']:
-                    LOGGER.debug(f"monitor is exit.") if OUTPUT_LOG_DEBUG else None
-                    break
-                else:
-                    time.sleep(0.01)
-    
-    class Dida(threading.Thread):
-        global LOCK
-        def __init__(self,flag_kill_dida:dict, flag_kill_monitor:dict, flag_kill_mfw:dict,  main_work_flow:multiprocessing.Process, dida_time:float=30):
-            super().__init__(daemon=True)
-            self.flag_kill_dida = flag_kill_dida
-            self.dida_time = dida_time
-            self.flag_kill_monitor = flag_kill_monitor
-            self.mwf = main_work_flow
-            self.flag_kill_mfw = flag_kill_mfw
-            
-            def _kill_dida(flag_dida, flag_monitor, flag_kill_mfw):
-                with LOCK:
-                    # 如果就在刚刚，monitor检测到输入了，而此时dida也刚好触发了这个函数（还没来得及kill掉self.dida），那么就要停止这个函数的运行，否则会kill掉main work flow
-                    if flag_dida['value']:
-                        return
-                    else:
-                        LOGGER.debug(f"I will kill main work flow soon") if OUTPUT_LOG_DEBUG else None
-                        LOGGER.debug(f"I will kill monitor soon") if OUTPUT_LOG_DEBUG else None
-                        LOGGER.debug(f"I will kill dida soon") if OUTPUT_LOG_DEBUG else None
-                        flag_dida['value'] = True
-                        flag_monitor['value'] = True
-                        flag_kill_mfw['value'] = True
-                        
-            self.dida = threading.Timer(self.dida_time, _kill_dida, args=[self.flag_kill_dida, self.flag_kill_monitor, self.flag_kill_mfw])
-            self.dida.start()
-        
-        def run(self,):
-            while True:
-                # If monitor thread set the flag to True, then kill dida.
-                if self.flag_kill_dida['value'] and not self.flag_kill_mfw['value']:
-                    LOGGER.debug(f"Dida is killed but main workflow is still running.") if OUTPUT_LOG_DEBUG else None
-                    self.dida.cancel()
-                    break
-                # or if itself did so(be silent more than dida_time), 
-                elif self.flag_kill_dida['value'] and self.flag_kill_mfw['value']:
-                    LOGGER.debug(f"Dida and main work flow are killed.") if OUTPUT_LOG_DEBUG else None
-                    if self.mwf.is_alive():
-                        self.mwf.terminate()
-                    break
-                else:
-                    time.sleep(0.01)
+class Session(threading.Thread):
+    def __init__(self, stt_api=zijie_stt_gradio, history=None, max_turns=None, *args, **kwargs):
+        """
+        多轮对话引擎：与每轮对话都重新创建的Backend不同，Session在创建时只初始化一次配置、模型、连接以及TTS和Speaker线程，
+        之后一轮接一轮地运行对话，并在内部维护对话历史。
+        ----
+        - stt_api: 每轮对话调用一次，返回用户输入的文本。
+        - max_turns: 最多运行的对话轮数，None表示一直运行，直到调用stop()。
+        - 其余参数与Backend相同：tts_workers、in_memory_audio、streaming_tts、voice_type。
+        """
+        super().__init__(daemon=True)
+        self.stt_api = stt_api
+        self.history = list(history) if history else []
+        self.max_turns = max_turns
+        self.stop_event = threading.Event()
+
+        _args = CONFIG.require('model_name', 'llm_url')
+        self._ollama_model_name = _args.model_name
+        self._ollama_base_url = _args.llm_url
+        self.segmenter = SentenceSegmenter()
 
+        self.text_queue = queue.Queue()
+        self.audio_queue = queue.Queue()
+        tts_kwargs = {"in_memory": kwargs.get("in_memory_audio", True), "streaming": kwargs.get("streaming_tts", False)}
+        if kwargs.get("voice_type"):
+            tts_kwargs["voice_type"] = kwargs["voice_type"]
+        self.audio_thread = TTS(self.text_queue, self.audio_queue, max_workers=kwargs.get("tts_workers", TTS_MAX_WORKERS), persistent=True, **tts_kwargs)
+        self.speaker_thread = Speaker(self.audio_queue, persistent=True)
+
+        # 连接、模型和播放设备都在这里一次性准备好，第一轮对话不需要再等待。
+        CONNECTIONS.prewarm()
+        LLM.get_model(self._ollama_model_name, self._ollama_base_url)
+        get_playback_engine().start()
+
+    def run(self):
+        self.audio_thread.start()
+        self.speaker_thread.start()
+        turns = 0
+        while not self.stop_event.is_set() and (self.max_turns is None or turns < self.max_turns):
+            try:
+                self.run_turn()
+            except Exception as e:
+                LOGGER.error("Session: Error in turn: {}".format(e))
+            turns += 1
+
+    def stop(self):
+        '''当前这一轮对话结束后停止。'''
+        self.stop_event.set()
+
+    def run_turn(self):
+        '''运行一轮对话：STT -> 拼接历史 -> LLM -> TTS -> Speaker，返回(用户输入, 回复)。'''
+        text = {"text": self.stt_api()}
+        if not text['text']:
+            return None
+        user_input = text['text']
+        InputProcess(text, self.history).run()
+
+        # 每轮对话开始时读取一次配置，config.json中修改的模型在下一轮对话生效
+        _args = get_config()
+        self._ollama_model_name = _args.model_name or self._ollama_model_name
+        self._ollama_base_url = _args.llm_url or self._ollama_base_url
+
+        self.speaker_thread.turn_finished.clear()
+        llm = LLM(text, self.text_queue, ollama_model_name=self._ollama_model_name, ollama_base_url=self._ollama_base_url, segmenter=self.segmenter)
+        # 直接在当前线程中运行，不需要为每轮对话创建新的线程
+        try:
+            llm.run()
+        except Exception:
+            # 推理中途失败时补上END，让TTS和Speaker结束这一轮，不影响下一轮对话。
+            self.text_queue.put(END)
+            self._wait_turn_finished()
+            raise
+        self._wait_turn_finished()
+
+        self.history.append((user_input, llm.response))
+        return user_input, llm.response
+
+    def _wait_turn_finished(self, poll_interval: float = 1.0):
+        '''等待Speaker播放完这一轮；Speaker线程已经退出时抛出异常，而不是永远等待。'''
+        while not self.speaker_thread.turn_finished.wait(poll_interval):
+            if not self.speaker_thread.is_alive():
+                raise RuntimeError("Session: speaker thread exited before the turn finished")
+
+class VoiceAwakeBackend(multiprocessing.Process):
     def __init__(self, awake_words:str, time_to_sleep:float=30, *args, **kwargs):
         """
         语音唤醒
         """
         super().__init__()
-        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')) as F:
-            _args = json.load(F)
-            self._ollama_model_name = _args['model_name']
-            self._ollama_base_url = _args['llm_url']
-            for key,value in _args.items():
-                os.environ[key] = value
+        # 缺少必填的配置项时在创建时就报错，而不是在对话进行到一半时抛出KeyError
+        _args = CONFIG.require('model_name', 'llm_url')
+        self._ollama_model_name = _args.model_name
+        self._ollama_base_url = _args.llm_url
         
         self.manager = multiprocessing.Manager()
         # for key words
         self.key_word = awake_words
         self.key_word_text = self.manager.dict({"text":""})
-        # for monitor: create an area of shared memory for {"text": None}
-        self.text_main_work_flow = self.manager.dict({"text":None})
+        # main work flow中的STT给出结果时设置这个事件，在此之前主进程阻塞等待，不需要轮询
+        self.speech_detected = multiprocessing.Event()
         
         self.time_to_sleep = time_to_sleep
 
-        self.flag_kill_dida = {"value": False}
-        self.flag_kill_monitor = {"value": False}
-        self.flag_kill_mfw = {"value":False}
-        
         self.welcome_audio_path = None
 
     def run(self):
+        # 唤醒前就预先连接，欢迎语的合成不需要等待握手；fork出来的main work flow会重新建立自己的连接
+        CONNECTIONS.prewarm()
         while True:
             self.key_word_stt = multiprocessing.Process(target=self.__kw_detector, kwargs={"text":self.key_word_text})
             self.key_word_stt.start()
@@ -859,37 +1064,35 @@ class VoiceAwakeBackend(multiprocessing.Process):
                 self.key_word_text["text"] = ""
                 
                 while True:
-                    # 如果STT模块给出的结果里含有唤醒词，那么就激活后面的Main Work Flow，同时激活Monitor和Dida。
-                    # If the result of STT module contains the wake up word, then activate the main work flow, monitor and dida.
-                    self.main_work_flow = multiprocessing.Process(target=self.create_main_work_flow, kwargs={"text":self.text_main_work_flow})
+                    # 如果STT模块给出的结果里含有唤醒词，那么就激活后面的Main Work Flow，并等待用户说话。
+                    # If the result of STT module contains the wake up word, then activate the main work flow and wait for the user's speech.
+                    self.speech_detected.clear()
+                    self.main_work_flow = multiprocessing.Process(target=self.create_main_work_flow, kwargs={"speech_detected":self.speech_detected})
                     self.main_work_flow.start()
 
-                    self.monitor = self.Monitor(self.text_main_work_flow, self.flag_kill_dida, self.flag_kill_monitor)
-                    self.dida = self.Dida(self.flag_kill_dida, self.flag_kill_monitor, self.flag_kill_mfw, self.main_work_flow, self.time_to_sleep)
-                    self.monitor.start()
-                    self.dida.start()
-
-                    self.monitor.join()
-                    self.dida.join()
+                    # 在time_to_sleep秒内说了话，就等这一轮对话结束，然后开始下一轮；否则由调度器终止main work flow，进入休眠。
+                    fell_asleep = threading.Event()
+                    sleep_deadline = get_scheduler().call_later(self.time_to_sleep, self._fall_asleep, self.main_work_flow, fell_asleep)
                     self.main_work_flow.join()
-
-                    # go to sleep
-                    if self.flag_kill_dida['value'] and self.flag_kill_mfw['value'] and self.flag_kill_mfw['value']:
-                        self.flag_kill_dida["value"] = False
-                        self.flag_kill_monitor["value"] = False
-                        self.flag_kill_mfw["value"] = False
-                        self.text_main_work_flow["text"] = None
+                    sleep_deadline.cancel()
+                    if fell_asleep.is_set() or not self.speech_detected.is_set():
                         LOGGER.info(f"Be silent over {self.time_to_sleep}s, turn to sleep mode.")
                         break
-                    else:
-                        self.flag_kill_dida["value"] = False
-                        self.flag_kill_monitor["value"] = False
-                        self.flag_kill_mfw["value"] = False
-                        self.text_main_work_flow["text"] = None
             else:
                 time.sleep(0.01)
     
-    def create_main_work_flow(self, text):
+    def _fall_asleep(self, main_work_flow, fell_asleep):
+        # 在调度器线程中执行：到期时用户还没有说话，终止main work flow
+        if self.speech_detected.is_set():
+            return
+        fell_asleep.set()
+        if main_work_flow.is_alive():
+            main_work_flow.terminate()
+
+    def create_main_work_flow(self, speech_detected):
+        text = TurnState(text=None)
+        # STT给出结果时通知主进程，主进程由此判断用户在time_to_sleep秒内是否说了话
+        text.subscribe(lambda key, value: speech_detected.set() if key == 'text' and value else None)
         self.backend = ContextMonitorBackend(text=text)
         self.backend.start()
         self.backend.join()
@@ -906,7 +1109,8 @@ class VoiceAwakeBackend(multiprocessing.Process):
 
     def __play_welcome_audio(self):
         if self.welcome_audio_path is None:
-            self.welcome_audio_path = tts("诶！")
+            # 欢迎语音只合成一次，并保存在内存中，不落盘。
+            self.welcome_audio_path = tts("诶！", in_memory=True)
         # 使用音频需要在一个新的进程里播放，否则其他进程将无法使用音频设备。
         play_audio = multiprocessing.Process(target=self.__play_audio, args=(self.welcome_audio_path,))
         play_audio.daemon=True
@@ -914,17 +1118,14 @@ class VoiceAwakeBackend(multiprocessing.Process):
         play_audio.join()
 
     def __play_audio(self, audio_path):
-        mixer.init()
-        mixer.music.load(audio_path)
-        mixer.music.play()
-        while mixer.music.get_busy():
-            time.sleep(0.001)
-        
-        mixer.music.unload()
-        mixer.quit()  
+        engine = get_playback_engine()
+        engine.play(audio_path).wait()
+        # wait()返回时最后的数据只是交给了声卡，close()会等声卡把缓冲区中的音频播放完，避免子进程退出时截断这段很短的提示音
+        engine.close()
 
     def __kw_detector(self, text):
-        stt = STT(zijie_stt_gradio, text)
+        # 唤醒词很短，说完后约400毫秒就结束录音
+        stt = STT(zijie_stt_gradio, text, endpoint="aggressive")
         stt.start()
         stt.join()
 
@@ -937,6 +1138,7 @@ if __name__ == "__main__":
     # main_thread = PureEnglishChatBackend(input_type="zh")
     # main_thread = PureEnglishChatBackend()
     # main_thread = Backend4AliTTSSpeaker()
+    # main_thread = Session()
     main_thread = Backend4AliRSTTAliTTSSpeaker()
     main_thread.start()
     main_thread.join()
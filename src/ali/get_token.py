@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import requests
 import json
 import argparse
 import sys
 
+sys.path.append(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+from connections import CONNECTIONS
+
 def get_token(access_key_id, access_key_secret):
     """
     Request a token from Alibaba Cloud NLS service using AccessKey ID and Secret.
@@ -30,7 +36,7 @@ def get_token(access_key_id, access_key_secret):
     }
     
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
+        response = CONNECTIONS.post(url, headers=headers, data=json.dumps(payload))
         response.raise_for_status()  # Raise an exception for HTTP errors
         
         data = response.json()
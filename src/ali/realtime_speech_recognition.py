@@ -31,6 +31,8 @@ class SpeechRecognizer:
         self.complete_transcript = ""
 
         self.text:dict = kwargs.get("stt_text", None)
+        # 收到中间结果时的回调，参数为中间结果的文本，用于提前启动后续的处理
+        self.on_partial = kwargs.get("on_partial", None)
         
     def generate_message_id(self):
         """Generate a unique message ID."""
@@ -109,6 +111,8 @@ class SpeechRecognizer:
                     elif name == "TranscriptionResultChanged":
                         result = data.get("payload", {}).get("result", "")
                         print(f"Intermediate result: {result}")
+                        if self.on_partial is not None:
+                            self.on_partial(result)
 
                     elif name == "SentenceEnd":
                         result = data.get("payload", {}).get("result", "")
@@ -19,7 +19,9 @@ import dashscope
 import threading
 import queue
 import time
+from typing import Optional
 from dashscope.audio.tts_v2 import *
+from tts_cache import TTSCache
 
 
 from http import HTTPStatus
@@ -57,21 +59,32 @@ def get_logger():
     return logger
 
 LOGGER = get_logger()
+# AliTTSSpeaker共享的语音合成缓存（只缓存在内存中）
+ALI_TTS_CACHE = TTSCache()
 
 class Callback(ResultCallback):
     _player = None
     _stream = None
 
+    def __init__(self):
+        super().__init__()
+        # 当前合成任务收到的音频，合成结束后可以写入缓存
+        self.audio = bytearray()
+
+    def _open_stream(self):
+        if self._stream is None:
+            self._player = pyaudio.PyAudio()
+            self._stream = self._player.open(
+                format=pyaudio.paInt16,
+                channels=1,
+                rate=22050,
+                output=True,
+                frames_per_buffer=1024,
+            )
+
     def on_open(self):
         LOGGER.info("websocket is open.")
-        self._player = pyaudio.PyAudio()
-        self._stream = self._player.open(
-            format=pyaudio.paInt16,
-            channels=1,
-            rate=22050,
-            output=True,
-            frames_per_buffer=1024,
-        )
+        self._open_stream()
 
     def on_complete(self):
         LOGGER.info("speech synthesis task complete successfully.")
@@ -82,15 +95,24 @@ class Callback(ResultCallback):
     def on_close(self):
         LOGGER.info("websocket is closed.")
         # stop player
-        self._stream.stop_stream()
-        self._stream.close()
-        self._player.terminate()
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._player.terminate()
+            self._stream = None
+            self._player = None
 
     def on_event(self, message):
         LOGGER.info(f"recv speech synthsis message {message}")
 
     def on_data(self, data: bytes) -> None:
         LOGGER.info(f"audio result length: {len(data)}")
+        self.audio.extend(data)
+        self.play(data)
+
+    def play(self, data: bytes) -> None:
+        '''播放PCM数据，缓存命中时也通过这里直接播放。'''
+        self._open_stream()
         # Write data in smaller chunks to prevent underruns
         chunk_size = 1024
         for i in range(0, len(data), chunk_size):
@@ -112,6 +134,52 @@ class AliTTSSpeaker(threading.Thread):
         self.callback = Callback()
         self.synthesizer = None  # Initialize as None
         self.running = True
+        # 语音合成缓存，传入cache=None可以关闭
+        self.cache: Optional[TTSCache] = kwargs.get("cache", ALI_TTS_CACHE)
+        # 当前合成任务中已经发送的文本
+        self._task_texts = []
+
+    @staticmethod
+    def cache_key(text: str) -> str:
+        return TTSCache.make_key(text, voice, encoding="pcm", rate=22050, model=model)
+
+    def _speak(self, content: str) -> None:
+        '''
+        合成并播放一段文本。
+        ----
+        流式合成的音频与输入文本之间没有一一对应关系，所以只有当一次合成任务只包含一段文本时（比如默认回复、问候语），才把音频写入缓存；
+        缓存命中且当前没有正在进行的合成任务时，直接播放缓存的音频，不访问网络，这样也不会打乱播放顺序。
+        '''
+        if self.cache is not None and not self._task_texts:
+            cached = self.cache.get(self.cache_key(content))
+            if cached is not None:
+                LOGGER.info(f"TTS cache hit: {content}")
+                self.callback.play(cached)
+                return
+
+        if not self._task_texts:
+            self.callback.audio = bytearray()
+        self._task_texts.append(content)
+        # Try to reconnect if connection is lost
+        try:
+            self.synthesizer.streaming_call(content)
+        except Exception as e:
+            LOGGER.error(f"TTS connection error: {str(e)}")
+            if "synthesizer has not been started" in str(e) or "socket is already closed" in str(e):
+                LOGGER.info("Attempting to reconnect TTS service...")
+                if self.connect():
+                    # Try again with the reconnected service
+                    self.synthesizer.streaming_call(content)
+
+    def _complete(self) -> None:
+        '''结束当前的合成任务，只包含一段文本的任务写入缓存。'''
+        if not self._task_texts:
+            return
+        self.synthesizer.streaming_complete()
+        print('TTS Request completed. RequestId:', self.synthesizer.get_last_request_id())
+        if self.cache is not None and len(self._task_texts) == 1 and self.callback.audio:
+            self.cache.put(self.cache_key(self._task_texts[0]), bytes(self.callback.audio))
+        self._task_texts = []
     
     def connect(self):
         """Explicitly establish the TTS connection"""
@@ -149,23 +217,13 @@ class AliTTSSpeaker(threading.Thread):
                 
                 if message["type"] == "end":
                     # End of message stream
-                    self.synthesizer.streaming_complete()
-                    print('TTS Request completed. RequestId:', self.synthesizer.get_last_request_id())
+                    self._complete()
                 elif message["type"] == "message":
                     # Process a text chunk
                     content = message["content"]
                     if content:
                         print(f"TTS processing: {content}")
-                        # Try to reconnect if connection is lost
-                        try:
-                            self.synthesizer.streaming_call(content)
-                        except Exception as e:
-                            LOGGER.error(f"TTS connection error: {str(e)}")
-                            if "synthesizer has not been started" in str(e) or "socket is already closed" in str(e):
-                                LOGGER.info("Attempting to reconnect TTS service...")
-                                if self.connect():
-                                    # Try again with the reconnected service
-                                    self.synthesizer.streaming_call(content)
+                        self._speak(content)
                 
                 self.text_queue.task_done()
                 
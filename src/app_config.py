@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from dataclasses import dataclass, field, fields
+from typing import Any, Dict, Optional
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+def get_logger():
+    # 日志收集器
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+
+    # Avoid passing messages to the root logger
+    logger.propagate = False
+
+    # If the logger already has handlers, avoid adding duplicate ones
+    if not logger.hasHandlers():
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s')
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    return logger
+
+LOGGER = get_logger()
+
+
+class ConfigError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class AppConfig:
+    '''config.json解析后的配置，字段与README中的说明一一对应，未列出的键保存在extra中。'''
+    model_name: Optional[str] = None
+    llm_url: Optional[str] = None
+
+    zijie_tts_app_id: Optional[str] = None
+    zijie_tts_access_token: Optional[str] = None
+    zijie_stt_appid: Optional[str] = None
+    zijie_stt_token: Optional[str] = None
+    zijie_stt_cluster: Optional[str] = None
+
+    ALIBABA_APPKEY: Optional[str] = None
+    ALIBABA_TOKEN: Optional[str] = None
+    ALI_TTSSPEAKER: Optional[str] = None
+
+    context_checking_access_key_id: Optional[str] = None
+    context_checking_access_key_secret: Optional[str] = None
+    machine_translation_key_id: Optional[str] = None
+    machine_translation_secret_key: Optional[str] = None
+
+    tts_cache_dir: Optional[str] = None
+
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, raw: Dict[str, Any]) -> "AppConfig":
+        names = {f.name for f in fields(cls)} - {"extra"}
+        known = {}
+        for key, value in raw.items():
+            if key not in names:
+                continue
+            # 数字、布尔值这类标量和以前同步到环境变量时一样转换为字符串，只有对象和数组是写错了
+            if isinstance(value, (dict, list)):
+                raise ConfigError(f"config key '{key}' must be a string, got {type(value).__name__}")
+            known[key] = value if value is None or isinstance(value, str) else str(value)
+        extra = {key: value for key, value in raw.items() if key not in names}
+        return cls(**known, extra=extra)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self.extra:
+            return self.extra[key]
+        value = getattr(self, key, None) if key != "extra" else None
+        return default if value is None else value
+
+    def require(self, *keys: str) -> "AppConfig":
+        '''检查必填的配置项，缺失时一次性列出所有缺失的键。'''
+        missing = [key for key in keys if self.get(key) in (None, "")]
+        if missing:
+            raise ConfigError(f"missing required config keys: {', '.join(missing)}")
+        return self
+
+    def items(self):
+        for f in fields(self):
+            if f.name != "extra" and getattr(self, f.name) is not None:
+                yield f.name, getattr(self, f.name)
+        yield from self.extra.items()
+
+
+class ConfigStore:
+    '''
+    进程内共享的配置：只解析一次，之后通过文件的修改时间（mtime）检测变化并重新加载，不需要重启进程。
+    ----
+    - check_interval: 两次检查mtime之间的最短间隔（秒），避免每次读取配置都访问文件系统。
+    - 为了兼容仍然从环境变量读取密钥的模块（zijie_tts、ali_tts等），每次（重新）加载后，配置会同步到os.environ。
+    '''
+    def __init__(self, path: str = CONFIG_PATH, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._config: Optional[AppConfig] = None
+        self._mtime: Optional[float] = None
+        self._last_check = 0.0
+
+    def get(self) -> AppConfig:
+        now = time.monotonic()
+        with self._lock:
+            if self._config is not None and now - self._last_check < self.check_interval:
+                return self._config
+            self._last_check = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                if self._config is None:
+                    LOGGER.warning(f"Config file not found at {self.path}")
+                    self._config = AppConfig()
+                return self._config
+            if mtime != self._mtime:
+                self._load(mtime)
+            return self._config
+
+    def require(self, *keys: str) -> AppConfig:
+        try:
+            return self.get().require(*keys)
+        except ConfigError as e:
+            raise ConfigError(f"{e} (in {self.path})") from None
+
+    def _load(self, mtime: float) -> None:
+        try:
+            with open(self.path, 'r') as f:
+                config = AppConfig.from_dict(json.load(f))
+        except (ValueError, ConfigError) as e:
+            # 文件正在被编辑时可能是不完整的json，保留旧的配置。
+            if self._config is None:
+                raise ConfigError(f"Error loading config from {self.path}: {e}") from e
+            LOGGER.error(f"Error reloading config from {self.path}, keep using the old one: {e}")
+            return
+        reloaded = self._config is not None
+        self._config = config
+        self._mtime = mtime
+        for key, value in config.items():
+            os.environ[key] = str(value)
+        LOGGER.info(f"{'Reloaded' if reloaded else 'Loaded'} config from {self.path}")
+
+
+CONFIG = ConfigStore()
+
+def get_config() -> AppConfig:
+    return CONFIG.get()
@@ -0,0 +1,157 @@
+import uuid
+import logging
+import threading
+
+from typing import Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from zijie_tts import read_audio, remove_audio
+from remote_gateway import (
+    DEFAULT_SESSION, SESSION_HEADER, AUDIO_WAIT_TIMEOUT, FRAME_END, STREAM_MIMETYPE,
+    RemoteGateway, RemoteSession, SessionLimitError, UploadStream, audio_frames, encode_frame,
+)
+
+def get_logger():
+    # 日志收集器
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+
+    # Avoid passing messages to the root logger
+    logger.propagate = False
+
+    # If the logger already has handlers, avoid adding duplicate ones
+    if not logger.hasHandlers():
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s')
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    return logger
+
+LOGGER = get_logger()
+
+
+def create_asgi_app(gateway: RemoteGateway) -> Starlette:
+    '''
+    RemoteGateway的ASGI版本：路由和返回值与Flask版本完全相同，会话状态也是同一份（gateway的RemoteSession）。
+    ----
+    等待音频的GET /audio、/audio/stream只占用一个协程，不占用线程，几百个空闲的开发板不会耗尽服务器的线程；
+    读取音频文件、迭代流式合成的音频这类阻塞操作放到线程池中。
+    '''
+    def _session(request: Request, create: bool = False) -> Optional[RemoteSession]:
+        session_id = request.path_params.get("session_id") or request.headers.get(SESSION_HEADER) or request.query_params.get("session") or DEFAULT_SESSION
+        return gateway.request_session(session_id, create)
+
+    async def create_session(request: Request):
+        try:
+            session = gateway.request_session(uuid.uuid4().hex, create=True)
+        except SessionLimitError:
+            return Response('Too many sessions', status_code=503)
+        return JSONResponse({"session_id": session.session_id}, status_code=201)
+
+    async def upload(request: Request):
+        try:
+            session = _session(request, create=True)
+        except SessionLimitError:
+            return Response('Too many sessions', status_code=503)
+        session.uploads.put(await request.body())
+        return Response('Audio data received', status_code=200)
+
+    async def upload_stream(request: Request):
+        try:
+            session = _session(request, create=True)
+        except SessionLimitError:
+            return Response('Too many sessions', status_code=503)
+        upload = UploadStream(sample_rate=int(request.query_params.get("rate", 16000)))
+        # 在第一个数据块到达之前就交给RemoteSTT，识别与上传同时进行
+        session.uploads.put(upload)
+        try:
+            async for chunk in request.stream():
+                if chunk:
+                    upload.put(chunk)
+        except Exception as e:
+            upload.close(e)
+            raise
+        upload.close()
+        return Response('Audio data received', status_code=200)
+
+    async def heartbeat(request: Request):
+        session = _session(request)
+        if session is None:
+            return Response('Unknown session', status_code=404)
+        session.heartbeat()
+        LOGGER.debug(f"AsgiGateway: Heartbeat received for session {session.session_id}")
+        return Response('Heartbeat received', status_code=200)
+
+    async def audio(request: Request):
+        session = _session(request)
+        if session is None:
+            return Response('Unknown session', status_code=404)
+        result = await session.take_async(AUDIO_WAIT_TIMEOUT)
+        if result is None:
+            return Response('No audio available', status_code=404)
+        kind, audio = result
+        if kind == "audio":
+            try:
+                return Response(await run_in_threadpool(read_audio, audio), status_code=200)
+            finally:
+                remove_audio(audio)
+        # 响应发送给开发板之后，RemoteSpeaker才结束这一轮；204不能带响应体（Flask版本的'END'也会被丢弃）
+        return Response(status_code=204, background=BackgroundTask(session.final_request_received.set))
+
+    async def audio_stream(request: Request):
+        session = _session(request)
+        if session is None:
+            return Response('Unknown session', status_code=404)
+        return StreamingResponse(_stream_turn(session), media_type=STREAM_MIMETYPE)
+
+    async def _stream_turn(session: RemoteSession):
+        while True:
+            result = await session.take_async(AUDIO_WAIT_TIMEOUT)
+            if result is None:
+                LOGGER.warning(f"AsgiGateway: no audio for session {session.session_id}, closing stream")
+                return
+            kind, audio = result
+            if kind == "end":
+                yield encode_frame(FRAME_END)
+                # 生成器在END帧写出之后才会继续运行到这里
+                session.final_request_received.set()
+                return
+            try:
+                async for frame in iterate_in_threadpool(audio_frames(audio)):
+                    yield frame
+            finally:
+                remove_audio(audio)
+
+    routes = [Route("/sessions", create_session, methods=['POST'])]
+    for prefix in ("", "/sessions/{session_id}"):
+        routes += [
+            Route(f"{prefix}/upload", upload, methods=['POST']),
+            Route(f"{prefix}/upload/stream", upload_stream, methods=['POST']),
+            Route(f"{prefix}/audio", audio, methods=['GET']),
+            Route(f"{prefix}/audio/stream", audio_stream, methods=['GET']),
+            Route(f"{prefix}/heartbeat", heartbeat, methods=['POST', 'GET']),
+        ]
+    return Starlette(routes=routes)
+
+
+def serve(gateway: RemoteGateway, host: str, port: int, ready: Optional[threading.Event] = None) -> None:
+    '''在当前线程中用uvicorn运行ASGI网关（阻塞）。'''
+    config = uvicorn.Config(create_asgi_app(gateway), host=host, port=port, log_level="warning", timeout_keep_alive=AUDIO_WAIT_TIMEOUT)
+    server = uvicorn.Server(config)
+    if ready is not None:
+        _startup = server.startup
+
+        async def startup(*args, **kwargs):
+            await _startup(*args, **kwargs)
+            ready.set()
+        server.startup = startup
+    server.run()
@@ -0,0 +1,386 @@
+import asyncio
+import logging
+import functools
+import threading
+import concurrent.futures
+
+from typing import AsyncIterator, Callable, Iterable, Optional, Union
+
+from AsyncAudioChat import END, TTS_MAX_WORKERS, LLM, TTS, MT, Speaker, InputProcess, CONFIG, get_config
+from zijie_tts import remove_audio
+from playback import get_playback_engine
+from signals import TurnState
+from language_id import get_translation_router
+
+def get_logger():
+    # 日志收集器
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+
+    # Avoid passing messages to the root logger
+    logger.propagate = False
+
+    # If the logger already has handlers, avoid adding duplicate ones
+    if not logger.hasHandlers():
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s')
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    return logger
+
+LOGGER = get_logger()
+
+# 同步迭代器结束的标记，StopIteration不能穿过Future
+_EXHAUSTED = object()
+
+
+class AsyncRuntime:
+    '''
+    进程内共享的asyncio运行时：一个后台线程运行事件循环，所有会话的所有阶段都是这个循环上的task。
+    Ollama、dashscope、pygame等阻塞的SDK在一个小的线程池中运行，不会阻塞事件循环。
+    '''
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    def start(self) -> "AsyncRuntime":
+        with self._lock:
+            if self._loop is not None:
+                return self
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="async-runtime")
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(self._executor)
+            ready = threading.Event()
+
+            def _run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=_run, name="async-runtime-loop", daemon=True)
+            self._thread.start()
+            ready.wait()
+            self._loop = loop
+        return self
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self.start()._loop
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        '''在任意线程中把协程提交到事件循环上运行。'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run_blocking(self, func: Callable, *args, **kwargs):
+        '''在线程池中运行阻塞的函数。'''
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def iterate(self, iterator: Union[Iterable, AsyncIterator]) -> AsyncIterator:
+        '''异步迭代器直接在事件循环上迭代；同步迭代器每次在线程池中取一个元素，两次取值之间不占用线程。'''
+        if hasattr(iterator, "__aiter__"):
+            async for item in iterator:
+                yield item
+            return
+        iterator = iter(iterator)
+        while True:
+            item = await self.run_blocking(next, iterator, _EXHAUSTED)
+            if item is _EXHAUSTED:
+                return
+            yield item
+
+    def close(self) -> None:
+        with self._lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._executor.shutdown(wait=False)
+            self._loop.close()
+            self._loop = None
+
+
+_RUNTIME: Optional[AsyncRuntime] = None
+_RUNTIME_LOCK = threading.Lock()
+
+def get_runtime() -> AsyncRuntime:
+    '''进程内共享的AsyncRuntime，线程池大小由config.json中的async_runtime_workers配置。'''
+    global _RUNTIME
+    with _RUNTIME_LOCK:
+        if _RUNTIME is None:
+            _RUNTIME = AsyncRuntime(max_workers=int(get_config().get("async_runtime_workers", 8)))
+        return _RUNTIME
+
+
+class QueueWriter:
+    '''
+    asyncio.Queue在线程池线程中的写入端，接口与queue.Queue.put相同，可以作为text_queue传给原有的阶段。
+    队列满时阻塞调用的线程，下游处理不过来时上游自然放慢。
+    '''
+    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+        self.queue = queue
+        self.loop = loop
+
+    def put(self, item, block=True, timeout=None):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            # 在事件循环线程中不能阻塞等待自己
+            self.queue.put_nowait(item)
+            return
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result(timeout if block else 0)
+
+
+def _uses_default_run2(llm: LLM) -> bool:
+    '''LLM没有重写_run2时，分句直接在事件循环上完成；重写了的子类（例如前端的LLM）在线程池中运行它自己的_run2。'''
+    return type(llm)._run2 is LLM._run2 and type(llm)._LLM__run2_ollama is LLM._LLM__run2_ollama
+
+
+class AsyncPipeline:
+    '''
+    asyncio版本的一轮对话：STT -> InputProcess -> LLM -> TTS -> Speaker。
+    ----
+    每个阶段是事件循环上的一个task，阶段之间用有界的asyncio.Queue（queue_size）连接，下游处理不过来时上游等待，不会无限堆积。
+    各阶段沿用原来的约定，原有的子类可以直接使用：
+    - stt_api: 返回用户输入的文本；协程函数（例如zijie_stt.zijie_stt_streaming_async）直接在事件循环上运行，普通函数在线程池中运行。
+    - llm_cls: LLM或其子类，_run返回迭代器（同步或异步），推理结束时放入END。
+    - tts_cls: TTS或其子类，_run把一句话转换成音频，最多tts_workers句同时合成，音频按原始顺序交给Speaker。
+    - speaker: 默认通过进程共享的播放引擎播放；也可以传入一个persistent=True的Speaker线程（例如RemoteSpeaker），音频会转交给它。
+    - translate_to: 设置后，STT的结果先经过MT.main_async翻译成这个语言（已经是目标语言的输入会跳过翻译）。
+    同一个AsyncRuntime上可以同时运行任意多个AsyncPipeline，线程数只取决于线程池的大小
+    （同步的STT和录音迭代器在线程池中运行，同时进行中的识别各占用其中一个线程，线程池满时后来的识别排队等待）。
+    '''
+    def __init__(
+            self,
+            stt_api: Callable,
+            history=None,
+            llm_cls=LLM,
+            tts_cls=TTS,
+            speaker: Optional[Speaker] = None,
+            queue_size: int = 8,
+            translate_to: Optional[str] = None,
+            runtime: Optional[AsyncRuntime] = None,
+            **kwargs
+    ):
+        self.stt_api = stt_api
+        self.history = history
+        self.llm_cls = llm_cls
+        self.speaker = speaker
+        self.queue_size = queue_size
+        self.translate_to = translate_to
+        self.runtime = runtime or get_runtime()
+        self.text = TurnState(text=None)
+        self.llm: Optional[LLM] = None
+        self._tasks = []
+        # 已经向speaker转交了这一轮的音频，但还没有转交END
+        self._speaker_turn_open = False
+
+        _args = CONFIG.require('model_name', 'llm_url')
+        self._ollama_model_name = _args.model_name
+        self._ollama_base_url = _args.llm_url
+        self.segmenter = kwargs.get("segmenter", None)
+
+        tts_kwargs = {"in_memory": kwargs.get("in_memory_audio", True), "streaming": kwargs.get("streaming_tts", False)}
+        if kwargs.get("voice_type"):
+            tts_kwargs["voice_type"] = kwargs["voice_type"]
+        # 只使用TTS的_run，不启动它的线程
+        self.tts = tts_cls(None, None, max_workers=kwargs.get("tts_workers", TTS_MAX_WORKERS), **tts_kwargs)
+
+    def start(self) -> concurrent.futures.Future:
+        '''在任意线程中启动这一轮对话，返回的Future的结果与run()相同。'''
+        return self.runtime.submit(self.run())
+
+    def cancel(self) -> None:
+        '''取消这一轮对话：停止LLM推理，并取消所有阶段的task。'''
+        if self.llm is not None:
+            self.llm.cancel()
+        for task in self._tasks:
+            self.runtime.loop.call_soon_threadsafe(task.cancel)
+
+    async def run(self):
+        '''运行一轮对话，返回(用户输入, 回复)，没有识别到输入时返回None。'''
+        self.text['text'] = await self._stt()
+        if not self.text['text']:
+            return None
+        user_input = self.text['text']
+        InputProcess(self.text, self.history).run()
+
+        loop = asyncio.get_running_loop()
+        text_queue = asyncio.Queue(maxsize=self.queue_size)
+        audio_queue = asyncio.Queue(maxsize=self.queue_size)
+        llm_kwargs = {"ollama_model_name": self._ollama_model_name, "ollama_base_url": self._ollama_base_url}
+        if self.segmenter is not None:
+            llm_kwargs["segmenter"] = self.segmenter
+        self.llm = self.llm_cls(self.text, QueueWriter(text_queue, loop), **llm_kwargs)
+
+        self._tasks = [
+            asyncio.ensure_future(self._llm_stage(text_queue)),
+            asyncio.ensure_future(self._tts_stage(text_queue, audio_queue)),
+            asyncio.ensure_future(self._speaker_stage(audio_queue)),
+        ]
+        try:
+            await asyncio.gather(*self._tasks)
+        except BaseException:
+            self.llm.cancel()
+            for task in self._tasks:
+                task.cancel()
+            # 转交给persistent Speaker的这一轮还没有结束时补上END，否则它不会设置turn_finished，下一轮的音频也会接在这一轮后面
+            if self.speaker is not None and self._speaker_turn_open:
+                self.speaker.audio_queue.put(END)
+                self._speaker_turn_open = False
+            raise
+        return user_input, getattr(self.llm, "response", "")
+
+    async def _stt(self) -> str:
+        if asyncio.iscoroutinefunction(self.stt_api):
+            text = await self.stt_api()
+        else:
+            text = await self.runtime.run_blocking(self.stt_api)
+        if text and self.translate_to:
+            source = get_translation_router(self.translate_to).source_language(text)
+            if source is not None:
+                text = await MT.main_async(text, source, self.translate_to)
+        return text
+
+    async def _llm_stage(self, text_queue: asyncio.Queue) -> None:
+        llm = self.llm
+        llm.query = llm.text['text']
+        iterator = await self.runtime.run_blocking(llm._run, llm.query, *llm.args_for_run, **llm.kwargs_for_run)
+        if not _uses_default_run2(llm):
+            await self.runtime.run_blocking(llm._run2, iterator, *llm.args_for_run, **llm.kwargs_for_run)
+            return
+
+        # 与LLM.__run2_ollama相同：分句后放入text_queue，结束时放入END
+        llm.segmenter.reset()
+        sentences = []
+        try:
+            async for response_token in self.runtime.iterate(iterator):
+                if llm.cancel_event.is_set():
+                    LOGGER.debug("AsyncPipeline: generation cancelled.")
+                    if hasattr(iterator, "close"):
+                        await self.runtime.run_blocking(iterator.close)
+                    break
+                for sentence in llm.segmenter.feed(response_token.content):
+                    await text_queue.put(sentence)
+                    sentences.append(sentence)
+            else:
+                last_sentence = llm.segmenter.flush()
+                if last_sentence:
+                    await text_queue.put(last_sentence)
+                    sentences.append(last_sentence)
+        finally:
+            llm.response = "".join(sentences)
+        # 取消时也放入END，让下游阶段结束这一轮
+        await text_queue.put(END)
+
+    async def _tts_stage(self, text_queue: asyncio.Queue, audio_queue: asyncio.Queue) -> None:
+        slots = asyncio.Semaphore(self.tts.max_workers)
+
+        async def _synthesize(sentence):
+            async with slots:
+                return await self.runtime.run_blocking(self.tts._run, sentence)
+
+        # 按提交顺序保存合成任务，由_collect按顺序取出结果
+        pending = asyncio.Queue(maxsize=self.queue_size)
+        collector = asyncio.ensure_future(self._collect(pending, audio_queue))
+        try:
+            while True:
+                sentence = await text_queue.get()
+                if sentence is END:
+                    await pending.put(END)
+                    break
+                await pending.put(asyncio.ensure_future(_synthesize(sentence)))
+            await collector
+        finally:
+            collector.cancel()
+
+    async def _collect(self, pending: asyncio.Queue, audio_queue: asyncio.Queue) -> None:
+        while True:
+            future = await pending.get()
+            if future is END:
+                await audio_queue.put(END)
+                break
+            try:
+                audio = await future
+            except Exception as e:
+                LOGGER.error("AsyncPipeline: Error in synthesis: {}".format(e))
+                continue
+            # 合成失败的句子直接跳过，避免None被当作END。
+            if audio is not None:
+                await audio_queue.put(audio)
+
+    async def _speaker_stage(self, audio_queue: asyncio.Queue) -> None:
+        if self.speaker is not None:
+            return await self._forward_to_speaker(audio_queue)
+        engine = get_playback_engine()
+        last_handle = None
+        while True:
+            audio = await audio_queue.get()
+            if audio is END:
+                if last_handle is not None:
+                    await self.runtime.run_blocking(last_handle.wait)
+                break
+            last_handle = await self.runtime.run_blocking(engine.play, audio)
+            remove_audio(audio)
+
+    async def _forward_to_speaker(self, audio_queue: asyncio.Queue) -> None:
+        '''把音频转交给一个persistent的Speaker线程，并等待它播放完这一轮。'''
+        self.speaker.turn_finished.clear()
+        if not self.speaker.is_alive():
+            self.speaker.start()
+        self._speaker_turn_open = True
+        while True:
+            audio = await audio_queue.get()
+            self.speaker.audio_queue.put(audio)
+            if audio is END:
+                self._speaker_turn_open = False
+                break
+        await self.runtime.run_blocking(self.speaker.turn_finished.wait)
+
+
+class AsyncSession:
+    '''
+    Session的asyncio版本：在同一个AsyncRuntime上一轮接一轮地运行AsyncPipeline，并维护对话历史。
+    每个AsyncSession只占用事件循环上的几个task，一个进程可以同时运行很多个会话。
+    参数与AsyncPipeline相同，max_turns为None时一直运行，直到调用stop()。
+    '''
+    def __init__(self, stt_api: Callable, history=None, max_turns: Optional[int] = None, runtime: Optional[AsyncRuntime] = None, **kwargs):
+        self.stt_api = stt_api
+        self.history = list(history) if history else []
+        self.max_turns = max_turns
+        self.runtime = runtime or get_runtime()
+        self.kwargs = kwargs
+        self.pipeline: Optional[AsyncPipeline] = None
+        self._stopped = False
+
+    def start(self) -> concurrent.futures.Future:
+        return self.runtime.submit(self.run())
+
+    def stop(self) -> None:
+        '''当前这一轮对话结束后停止。'''
+        self._stopped = True
+
+    async def run(self) -> None:
+        turns = 0
+        while not self._stopped and (self.max_turns is None or turns < self.max_turns):
+            try:
+                await self.run_turn()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                LOGGER.error("AsyncSession: Error in turn: {}".format(e))
+            turns += 1
+
+    async def run_turn(self):
+        # 每轮对话都重新创建AsyncPipeline，config.json中修改的模型在下一轮对话生效
+        self.pipeline = AsyncPipeline(self.stt_api, self.history, runtime=self.runtime, **self.kwargs)
+        result = await self.pipeline.run()
+        if result is not None:
+            self.history.append(result)
+        return result
@@ -0,0 +1,150 @@
+import os
+import logging
+import threading
+
+from urllib.parse import urlparse
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Tuple
+
+import requests
+import websocket
+from requests.adapters import HTTPAdapter
+
+# 启动时预先建立连接的云服务地址：字节跳动语音合成、阿里云NLS的token服务。
+# 只包含通过CONNECTIONS.session()请求的host；内容审核和机器翻译走阿里云SDK自己的连接，预热这里的Session没有作用。
+PREWARM_URLS = (
+    "https://openspeech.bytedance.com",
+    "https://nls-meta.cn-shanghai.aliyuncs.com",
+)
+
+def get_logger():
+    # 日志收集器
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    
+    # Avoid passing messages to the root logger
+    logger.propagate = False
+    
+    # If the logger already has handlers, avoid adding duplicate ones
+    if not logger.hasHandlers():
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s')
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    return logger
+
+LOGGER = get_logger()
+
+
+class ConnectionManager:
+    '''
+    进程内共享的连接管理器。
+    ----
+    - HTTP：每个host一个requests.Session，连接保持keep-alive，后续的请求复用已经建立好的TCP+TLS连接。
+    - WebSocket：空闲的连接按url保存，下次请求直接复用。
+    - SDK client（AcsClient、alimt client等）：按key缓存，只创建一次。
+    '''
+    def __init__(self, pool_maxsize: int = 8, max_idle_websockets: int = 4):
+        self.pool_maxsize = pool_maxsize
+        self.max_idle_websockets = max_idle_websockets
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, requests.Session] = {}
+        self._clients: Dict[Hashable, Any] = {}
+        self._idle_websockets: Dict[str, List[websocket.WebSocket]] = {}
+        self._prewarmed = False
+
+    def session(self, url: str) -> requests.Session:
+        '''返回url所在host的Session，同一个host的请求共用一个连接池。'''
+        parsed = urlparse(url)
+        key = f"{parsed.scheme}://{parsed.netloc}"
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount(key, adapter)
+                self._sessions[key] = session
+            return session
+
+    def post(self, url: str, *args, **kwargs) -> requests.Response:
+        return self.session(url).post(url, *args, **kwargs)
+
+    def client(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        '''按key缓存SDK client，第一次使用时调用factory创建。'''
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = factory()
+            return self._clients[key]
+
+    def acquire_websocket(self, url: str, header: List[str], timeout: float = 30) -> Tuple[websocket.WebSocket, bool]:
+        '''
+        获取一个WebSocket连接，优先复用空闲的连接。
+        返回(ws, reused)，reused为True时，调用方在连接已失效的情况下应当使用新连接重试一次。
+        '''
+        with self._lock:
+            idle = self._idle_websockets.get(url, [])
+            while idle:
+                ws = idle.pop()
+                if ws.connected:
+                    ws.settimeout(timeout)
+                    return ws, True
+        return websocket.create_connection(url, header=header, timeout=timeout), False
+
+    def release_websocket(self, url: str, ws: websocket.WebSocket) -> None:
+        '''把用完的连接放回连接池，超过上限的连接直接关闭。'''
+        with self._lock:
+            idle = self._idle_websockets.setdefault(url, [])
+            if ws.connected and len(idle) < self.max_idle_websockets:
+                idle.append(ws)
+                return
+        ws.close()
+
+    def prewarm(self, urls: Iterable[str] = PREWARM_URLS, background: bool = True) -> None:
+        '''预先建立到各个云服务的连接，只在第一次调用时生效。'''
+        with self._lock:
+            if self._prewarmed:
+                return
+            self._prewarmed = True
+
+        def _connect(url):
+            try:
+                self.session(url).head(url, timeout=5)
+                LOGGER.debug(f"Pre-connected to {url}")
+            except requests.RequestException as e:
+                LOGGER.warning(f"Failed to pre-connect to {url}: {e}")
+
+        for url in urls:
+            if background:
+                threading.Thread(target=_connect, args=(url,), daemon=True).start()
+            else:
+                _connect(url)
+
+    def reset(self) -> None:
+        '''
+        丢弃所有连接和client，但不关闭它们。
+        fork出来的子进程继承了父进程的socket，两个进程共用同一条TLS连接会把它弄坏；
+        子进程不能关闭这些连接（会影响父进程），只能丢弃后重新建立。
+        '''
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._clients = {}
+        self._idle_websockets = {}
+        self._prewarmed = False
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            for idle in self._idle_websockets.values():
+                for ws in idle:
+                    ws.close()
+            self._sessions.clear()
+            self._idle_websockets.clear()
+            self._clients.clear()
+
+
+CONNECTIONS = ConnectionManager()
+# 子进程（例如VoiceAwakeBackend的main work flow）使用自己的连接
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=CONNECTIONS.reset)
@@ -13,7 +13,7 @@ from typing import Generator
 sys.path.append(
     os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 )
-from AsyncAudioChat import Backend,LLM,STT,LOGGER,END,ContextMonitorBackend,ContextMonitor,PREPARED_TEXT,PureEnglishChatBackend #,lingji_stt_gradio_va
+from AsyncAudioChat import Backend,LLM,STT,LOGGER,END,ContextMonitorBackend,ContextMonitor,PREPARED_TEXT,PureEnglishChatBackend,GatedQueue #,lingji_stt_gradio_va
 from zijie_stt import zijie_stt_gradio
 class STT(STT):
     def __init__(self, stt_api, text, *args, **kwargs):
@@ -33,48 +33,33 @@ class LLM(LLM):
         self.response_for_web_display:multiprocessing.Queue = kwargs_for_run['response_for_web_display']
         
     def __run2_ollama(self, llm_iterator, *args, **kwargs):
-        old_total_response = ""
-        current_total_response = ""
-        
+        self.segmenter.reset()
+        # 推测执行时text_queue是审核的闸门，显示的token也要等审核通过，不合规的回复不会出现在页面上
+        web_display = self.text_queue.link(self.response_for_web_display) if isinstance(self.text_queue, GatedQueue) else self.response_for_web_display
         for response_token in llm_iterator:
+            if self.cancel_event.is_set():
+                LOGGER.debug("LLM: generation cancelled.")
+                # 与AsyncAudioChat.LLM相同：关闭迭代器，不再往text_queue中放入内容；页面只需要结束这一轮的显示
+                if hasattr(llm_iterator, "close"):
+                    llm_iterator.close()
+                web_display.put(END)
+                return
             response_token = response_token.content
 
             # 解决前端无法实时获取token的问题。
-            self.response_for_web_display.put(response_token)
-            
-            # 每次拿到reponse时，使用新的response去掉old_total_response，得到response_delta，这个就是在当前时间点得到的response。
-            current_total_response += response_token
-            response_delta = self.__remove_first_match(current_total_response, old_total_response)
-
-            # 我们对response_delta进行这样的操作，从左到右，判断其是否有有‘，。！？’等符号，如果有的话，就从左到右，从开头到这个符号为止，截取这段文本，然后把这段文本放入到text队列中，以及拼接到old_total_response对象右侧。如果没有，则不做操作。
-            while response_delta:
-                # 找到第一个标点符号的位置
-                ## i for i in xxx, 叫做生成器表达式，使用圆括号包裹生成器表达式，表示这是一个generator，而使用[]或{}的话，则表示是一个列表或集合表达式，
-                ## 前者不会把for表达式执行完，然后返回结果，而是返回一个generator对象，只有在遍历这个对象（比如使用next方法）的时候才会执行for表达式，然后返回结果。
-                ## 而列表或集合表达式会立即执行for表达式，然后返回结果。
-                ## 返回generator的方式称为惰性计算，只有在需要的时候才把值放到内存中。每次迭代时，生成器都会返回一个值，然后记住当前位置，下次遍历这个生成器时，则会从之前记住的位置的下一个位置开始便利。
-                ## 不把英文的'.'算入截断标点符号中，因为大模型生成的文本中，标题会用到'.'，比如‘6.’
-                punctuation_index = next((i for i, char in enumerate(response_delta) if char in [',' , '，', '。', '！', '？', '!', '?']), -1)
-                if punctuation_index != -1:                          # 如果生成器表达式不是空的，即找的到第一个标点符号
-                    text = response_delta[:punctuation_index + 1]    # 截取这段文本
-                    old_total_response += text                  # 拼接到old_total_response对象右侧
-                    self.text_queue.put(text)               # 把这段文本放入到text队列中
-                    # LOGGER.info("LLM: new sentence: {}".format(old_total_response))
-                    
-                    # 如果response_delta中存在不止一个符号，那么我们在做完第一个符号对应的工作后，把response_delta更新为去掉第一段文本的剩下文本，然后进行同样的操作。
-                    response_delta = response_delta[punctuation_index + 1:]
-                
-                # 如果response_delta没有‘，。！？’等符号了，则不做操作。
-                if punctuation_index==-1:
-                    break
-        
+            web_display.put(response_token)
+
+            for sentence in self.segmenter.feed(response_token):
+                self.text_queue.put(sentence)               # 把这段文本放入到text队列中
+
         # 最后一个句子可能会没有标点符号，所以需要特殊处理。
-        if response_delta:  # 如果最后一个句子确实没有标点。
-            self.text_queue.put(response_delta)
+        last_sentence = self.segmenter.flush()
+        if last_sentence:
+            self.text_queue.put(last_sentence)
         
         # 生成完成后，往队列中放入一个END结束标识符。
         self.text_queue.put(END)    
-        self.response_for_web_display.put(END) 
+        web_display.put(END) 
 
 class Backend(PureEnglishChatBackend):
     def __init__(self, *args, **kwargs):
@@ -181,9 +166,10 @@ class Chatbot:
                 return []
 
             try:
-                user_text = self.stt_for_web_display.get_nowait()
+                # 有数据时立即返回；超时只是为了定期检查后端进程是否还活着
+                user_text = self.stt_for_web_display.get(timeout=0.5)
             except queue.Empty:
-                time.sleep(0.01)
+                pass
                 # LOGGER.error("No data received from the stt.")
             finally:
                 if user_text:
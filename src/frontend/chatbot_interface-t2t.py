@@ -10,16 +10,19 @@ sys.path.append(
     os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 )
 from AsyncAudioChat import LLM
+from app_config import ConfigStore
+
+# 文字对话界面使用自己的配置文件（src/frontend/config.json），修改后不需要重启
+FRONTEND_CONFIG = ConfigStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json'))
 
 def backend(*args, **kwargs):
     '''后端对话实现'''
     text_queue = queue.Queue()
     text = {"text": kwargs["user_input"]}
 
-    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')) as F:
-        _args = json.load(F)
-        ollama_model_name = _args['model_name']
-        ollama_base_url = _args['llm_url']
+    _args = FRONTEND_CONFIG.require('model_name', 'llm_url')
+    ollama_model_name = _args.model_name
+    ollama_base_url = _args.llm_url
 
     llm_thread = LLM(text=text, text_queue=text_queue, ollama_model_name=ollama_model_name, ollama_base_url=ollama_base_url)
     llm_thread.start()
@@ -0,0 +1,72 @@
+import re
+import threading
+
+# 中日韩统一表意文字（含扩展A区和兼容区）
+CJK_PATTERN = re.compile(r"[㐀-䶿一-鿿豈-﫿]")
+LATIN_PATTERN = re.compile(r"[A-Za-z]")
+
+ZH = "zh"
+EN = "en"
+MIXED = "mixed"
+UNKNOWN = "unknown"
+
+
+def detect_language(text: str) -> str:
+    '''
+    根据字符类别统计判断文本的语言：只有汉字为zh，只有拉丁字母为en，两者都有为mixed，都没有（数字、标点等）为unknown。
+    只做两次正则扫描，一句话的耗时在微秒级别。
+    '''
+    if not text:
+        return UNKNOWN
+    has_cjk = CJK_PATTERN.search(text) is not None
+    has_latin = LATIN_PATTERN.search(text) is not None
+    if has_cjk and has_latin:
+        return MIXED
+    if has_cjk:
+        return ZH
+    if has_latin:
+        return EN
+    return UNKNOWN
+
+
+class TranslationRouter:
+    '''
+    判断一句话是否需要翻译成目标语言，并统计跳过了多少次机器翻译。
+    ----
+    - 目标语言为en时，zh和mixed需要翻译；目标语言为zh时，en和mixed需要翻译。
+    - mixed的文本使用auto作为源语言，由翻译服务自行识别。
+    '''
+    def __init__(self, target_language: str = EN):
+        self.target_language = target_language
+        self._lock = threading.Lock()
+        self.translated = 0
+        self.skipped = 0
+
+    def source_language(self, text: str):
+        '''返回翻译时使用的源语言，不需要翻译时返回None。'''
+        language = detect_language(text)
+        if language in (self.target_language, UNKNOWN):
+            source = None
+        else:
+            source = "auto" if language == MIXED else language
+        with self._lock:
+            if source is None:
+                self.skipped += 1
+            else:
+                self.translated += 1
+        return source
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"translated": self.translated, "skipped": self.skipped}
+
+
+_ROUTERS = {}
+_ROUTERS_LOCK = threading.Lock()
+
+def get_translation_router(target_language: str = EN) -> TranslationRouter:
+    '''进程内共享的TranslationRouter，每个目标语言一个，计数在多轮对话之间累计。'''
+    with _ROUTERS_LOCK:
+        if target_language not in _ROUTERS:
+            _ROUTERS[target_language] = TranslationRouter(target_language)
+        return _ROUTERS[target_language]
@@ -0,0 +1,208 @@
+import os
+import time
+import logging
+import threading
+import unicodedata
+
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_BLOCKLIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'moderation_blocklist.txt')
+
+def get_logger():
+    # 日志收集器
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+
+    # Avoid passing messages to the root logger
+    logger.propagate = False
+
+    # If the logger already has handlers, avoid adding duplicate ones
+    if not logger.hasHandlers():
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s')
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    return logger
+
+LOGGER = get_logger()
+
+
+def normalize(text: str) -> str:
+    '''统一全角/半角和大小写，并去掉空白和标点，使"你好！"和"你好"得到相同的结果。'''
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] not in ("P", "Z", "C", "S"))
+
+
+class AhoCorasick:
+    '''
+    多模式串匹配（Aho-Corasick自动机），一次扫描就能找出文本中出现的所有模式串，耗时与模式串的数量无关。
+    '''
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Tuple[str, ...]] = [()]
+        self.patterns = []
+        for pattern in patterns:
+            if pattern:
+                self._add(pattern)
+                self.patterns.append(pattern)
+        self._build()
+
+    def _add(self, pattern: str) -> None:
+        state = 0
+        for ch in pattern:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        self._output[state] += (pattern,)
+
+    def _build(self) -> None:
+        # 广度优先计算失配指针，并把失配状态的输出合并进来
+        todo = deque(self._goto[0].values())
+        while todo:
+            state = todo.popleft()
+            for ch, next_state in self._goto[state].items():
+                todo.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def search(self, text: str) -> Optional[str]:
+        '''返回文本中第一个出现的模式串，没有则返回None。'''
+        state = 0
+        for ch in text:
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            if self._output[state]:
+                return self._output[state][0]
+        return None
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+
+class VerdictCache:
+    '''审核结果的缓存：LRU，条目数有上限，每个结果在ttl秒后过期。'''
+    def __init__(self, max_items: int = 1024, ttl: float = 600):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[str, Tuple[float, bool]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[bool]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, verdict = item
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return verdict
+
+    def put(self, key: str, verdict: bool) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, verdict)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class Moderator:
+    '''
+    分层的内容审核，返回True表示内容合规。
+    ----
+    1. 本地黑名单（Aho-Corasick）：命中则直接判定为不合规，不需要请求云端。
+    2. 审核结果缓存：以归一化后的文本为key，相同的输入（例如"你好"）在ttl内只请求一次云端。
+    3. 以上都无法判断时，才调用remote_check请求云端审核，并缓存结果。
+    归一化后为空的文本（只有emoji、符号或标点）无法在本地判断，也不缓存，总是请求云端审核。
+    '''
+    def __init__(self, blocklist: Iterable[str] = (), remote_check: Optional[Callable[[str], bool]] = None, cache: Optional[VerdictCache] = None):
+        self.matcher = AhoCorasick(normalize(word) for word in blocklist)
+        self.remote_check = remote_check
+        self.cache = cache if cache is not None else VerdictCache()
+        self._lock = threading.Lock()
+        self.local_rejects = 0
+        self.cache_hits = 0
+        self.remote_calls = 0
+
+    def check(self, text: str, remote_check: Optional[Callable[[str], bool]] = None) -> bool:
+        key = normalize(text)
+        if key:
+            word = self.matcher.search(key)
+            if word is not None:
+                LOGGER.debug(f"Moderator: blocked locally by '{word}'")
+                with self._lock:
+                    self.local_rejects += 1
+                return False
+            verdict = self.cache.get(key)
+            if verdict is not None:
+                with self._lock:
+                    self.cache_hits += 1
+                return verdict
+        remote_check = remote_check or self.remote_check
+        if remote_check is None:
+            return True
+        with self._lock:
+            self.remote_calls += 1
+        verdict = bool(remote_check(text))
+        if key:
+            self.cache.put(key, verdict)
+        return verdict
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "local_rejects": self.local_rejects,
+                "cache_hits": self.cache_hits,
+                "remote_calls": self.remote_calls,
+                "cached_verdicts": len(self.cache),
+                "blocklist_size": len(self.matcher),
+            }
+
+
+def load_blocklist(path: str = DEFAULT_BLOCKLIST_PATH) -> List[str]:
+    '''黑名单文件每行一个词，忽略空行和以#开头的注释行。'''
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    except OSError:
+        LOGGER.warning(f"Blocklist not found at {path}")
+        return []
+
+
+_MODERATOR: Optional[Moderator] = None
+_MODERATOR_LOCK = threading.Lock()
+
+def get_moderator() -> Moderator:
+    '''
+    进程内共享的Moderator，第一次使用时创建。
+    config.json中可以通过moderation_blocklist指定黑名单文件，通过moderation_cache_ttl、moderation_cache_size调整缓存。
+    '''
+    global _MODERATOR
+    from app_config import get_config
+
+    with _MODERATOR_LOCK:
+        if _MODERATOR is None:
+            config = get_config()
+            cache = VerdictCache(
+                max_items=int(config.get("moderation_cache_size", 1024)),
+                ttl=float(config.get("moderation_cache_ttl", 600)),
+            )
+            _MODERATOR = Moderator(load_blocklist(config.get("moderation_blocklist", DEFAULT_BLOCKLIST_PATH)), cache=cache)
+        return _MODERATOR
@@ -0,0 +1,288 @@
+import io
+import os
+import wave
+import queue
+import logging
+import threading
+
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+import numpy as np
+import pyaudio
+
+from zijie_tts import StreamingAudio
+
+def get_logger():
+    # 日志收集器
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+
+    # Avoid passing messages to the root logger
+    logger.propagate = False
+
+    # If the logger already has handlers, avoid adding duplicate ones
+    if not logger.hasHandlers():
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s')
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    return logger
+
+LOGGER = get_logger()
+
+
+class PlaybackHandle:
+    '''一段音频的播放状态，最后一个采样被送入声卡后，done被设置（此时声卡的缓冲区中可能还有未播放完的数据，退出进程前应调用PlaybackEngine.close()）。'''
+    def __init__(self):
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.done.wait(timeout)
+
+
+class PCMRingBuffer:
+    '''
+    固定容量的PCM环形缓冲区。
+    ----
+    写入端在缓冲区满时阻塞等待；读取端（声卡回调）从不阻塞，数据不足时补静音。
+    mark()记录当前写入位置，读取端越过该位置时设置对应的PlaybackHandle。
+    close()之后写入的数据被丢弃，阻塞中的写入端和所有未完成的PlaybackHandle都被唤醒。
+    '''
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._read_pos = 0
+        self._size = 0
+        self._written = 0
+        self._consumed = 0
+        self._marks: Deque[Tuple[int, PlaybackHandle]] = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def __len__(self) -> int:
+        with self._cond:
+            return self._size
+
+    def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            with self._cond:
+                while self._size == self.capacity and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                n = min(len(view), self.capacity - self._size)
+                start = (self._read_pos + self._size) % self.capacity
+                first = min(n, self.capacity - start)
+                self._buffer[start:start + first] = view[:first]
+                self._buffer[:n - first] = view[first:n]
+                self._size += n
+                self._written += n
+            view = view[n:]
+
+    def mark(self, handle: PlaybackHandle) -> None:
+        with self._cond:
+            if self._closed or self._consumed >= self._written:
+                handle.done.set()
+            else:
+                self._marks.append((self._written, handle))
+
+    def read(self, n: int) -> bytes:
+        with self._cond:
+            available = min(n, self._size)
+            first = min(available, self.capacity - self._read_pos)
+            out = bytes(self._buffer[self._read_pos:self._read_pos + first]) + bytes(self._buffer[:available - first])
+            self._read_pos = (self._read_pos + available) % self.capacity
+            self._size -= available
+            self._consumed += available
+            while self._marks and self._marks[0][0] <= self._consumed:
+                self._marks.popleft()[1].done.set()
+            if available:
+                self._cond.notify_all()
+        if available < n:
+            out += bytes(n - available)
+        return out
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            while self._marks:
+                self._marks.popleft()[1].done.set()
+            self._cond.notify_all()
+
+
+class PlaybackEngine:
+    '''
+    事件驱动的无缝播放引擎。
+    ----
+    整个进程只打开一个输出流，声卡通过回调从环形缓冲区中拉取PCM数据；
+    play()把音频解码成统一格式的PCM后排队，由一个写入线程依次写入缓冲区，所以相邻的音频之间没有间隙。
+    播放完成通过PlaybackHandle（threading.Event）通知，不需要轮询。
+    没有音频要播放时输出流暂停（回调返回paComplete），不会一直向声卡写入静音；写入线程在写入下一段音频之前重新启动输出流。
+    '''
+    def __init__(self, sample_rate: int = 24000, channels: int = 1, frames_per_buffer: int = 1024, buffer_seconds: float = 2.0):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = 2  # 16bit
+        self.frames_per_buffer = frames_per_buffer
+        self._frame_bytes = self.channels * self.sample_width
+        self._ring = PCMRingBuffer(int(sample_rate * buffer_seconds) * self._frame_bytes)
+        self._clips: queue.Queue = queue.Queue()
+        self._last_handle: Optional[PlaybackHandle] = None
+        self._lock = threading.Lock()
+        # _idle: 写入线程没有要写入的音频；_paused: 输出流已经停止（或者还没有启动）。两者由_state_lock保护，声卡回调也会读写
+        self._state_lock = threading.Lock()
+        self._idle = True
+        self._paused = True
+        self._player = None
+        self._stream = None
+        self._writer = None
+
+    def start(self) -> "PlaybackEngine":
+        with self._lock:
+            if self._stream is not None:
+                return self
+            # close()之后重新启动时，之前的环形缓冲区已经关闭
+            self._ring = PCMRingBuffer(self._ring.capacity)
+            self._player = pyaudio.PyAudio()
+            self._stream = self._player.open(
+                format=pyaudio.paInt16,
+                channels=self.channels,
+                rate=self.sample_rate,
+                output=True,
+                frames_per_buffer=self.frames_per_buffer,
+                stream_callback=self._callback,
+                start=False,
+            )
+            self._paused = True
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+        return self
+
+    def play(self, audio) -> PlaybackHandle:
+        '''
+        把一段音频排到播放队列末尾，立即返回PlaybackHandle。
+        audio可以是wav文件路径、wav字节数据、io.BytesIO或者StreamingAudio。文件在这里就被读取，调用方随后可以删除它。
+        '''
+        self.start()
+        handle = PlaybackHandle()
+        source = audio if isinstance(audio, StreamingAudio) else self._decode(audio)
+        with self._lock:
+            self._last_handle = handle
+        self._clips.put((source, handle))
+        return handle
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        '''等待目前已经排队的所有音频播放完毕。'''
+        with self._lock:
+            handle = self._last_handle
+        return handle is None or handle.wait(timeout)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._stream is None:
+                return
+            # 唤醒阻塞在环形缓冲区上的写入线程，让它读到None后退出
+            self._ring.close()
+            self._clips.put(None)
+            self._stream.stop_stream()
+            self._stream.close()
+            self._player.terminate()
+            self._stream = None
+            self._player = None
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        with self._state_lock:
+            data = self._ring.read(frame_count * self._frame_bytes)
+            if self._idle and not len(self._ring):
+                # 缓冲区中的数据都已经交给声卡，这一块播放完后输出流停止
+                self._paused = True
+                return data, pyaudio.paComplete
+        return data, pyaudio.paContinue
+
+    def _resume(self) -> None:
+        with self._state_lock:
+            self._idle = False
+            paused = self._paused
+            self._paused = False
+        if paused:
+            with self._lock:
+                if self._stream is not None:
+                    # 回调返回paComplete之后，需要先stop_stream()才能再次start_stream()
+                    self._stream.stop_stream()
+                    self._stream.start_stream()
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._clips.get()
+            if item is None:
+                break
+            source, handle = item
+            self._resume()
+            try:
+                if isinstance(source, StreamingAudio):
+                    # 流式音频：数据块到达一个写入一个
+                    for chunk in source:
+                        self._ring.write(self._convert(chunk, source.sample_rate, source.channels, source.sample_width))
+                    if source.error is not None:
+                        handle.error = source.error
+                else:
+                    self._ring.write(source)
+            except Exception as e:
+                LOGGER.error(f"PlaybackEngine: failed to play clip: {e}")
+                handle.error = e
+            self._ring.mark(handle)
+            if self._clips.empty():
+                # 没有排队的音频了，缓冲区播放完后暂停输出流；之后放入的音频在写入前会重新启动它
+                with self._state_lock:
+                    self._idle = True
+
+    def _decode(self, audio) -> bytes:
+        if isinstance(audio, io.BytesIO):
+            data = audio.getvalue()
+        elif isinstance(audio, (bytes, bytearray)):
+            data = bytes(audio)
+        else:
+            with open(audio, "rb") as f:
+                data = f.read()
+        with wave.open(io.BytesIO(data), "rb") as wf:
+            rate, channels, width = wf.getframerate(), wf.getnchannels(), wf.getsampwidth()
+            pcm = wf.readframes(wf.getnframes())
+        return self._convert(pcm, rate, channels, width)
+
+    def _convert(self, pcm: bytes, rate: int, channels: int, width: int) -> bytes:
+        '''把PCM转换为引擎的格式（16bit，引擎的声道数和采样率）。'''
+        if rate == self.sample_rate and channels == self.channels and width == self.sample_width:
+            return pcm
+        if width == 1:
+            samples = (np.frombuffer(pcm, dtype=np.uint8).astype(np.float32) - 128) * 256
+        elif width == 2:
+            samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+        elif width == 4:
+            samples = np.frombuffer(pcm, dtype=np.int32).astype(np.float32) / 65536
+        else:
+            raise ValueError(f"unsupported sample width: {width}")
+        samples = samples[:len(samples) // channels * channels].reshape(-1, channels)
+        if channels != self.channels:
+            samples = np.repeat(samples.mean(axis=1, keepdims=True), self.channels, axis=1)
+        if rate != self.sample_rate and len(samples):
+            n = int(round(len(samples) * self.sample_rate / rate))
+            positions = np.linspace(0, len(samples) - 1, n)
+            samples = np.stack([np.interp(positions, np.arange(len(samples)), samples[:, c]) for c in range(self.channels)], axis=1)
+        return np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+
+
+_ENGINE: Optional[PlaybackEngine] = None
+_ENGINE_LOCK = threading.Lock()
+
+def get_playback_engine() -> PlaybackEngine:
+    '''进程内共享的播放引擎，第一次使用时打开输出流。'''
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = PlaybackEngine(sample_rate=int(os.environ.get("playback_sample_rate", 24000)))
+        return _ENGINE
@@ -0,0 +1,484 @@
+import time
+import uuid
+import queue
+import wave
+import struct
+import logging
+import threading
+
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+from flask import Flask, Response, request, after_this_request
+from zijie_tts import StreamingAudio, read_audio, remove_audio
+from zijie_stt import read_wav_info
+from app_config import get_config
+from signals import TurnState
+from scheduler import Deadline, get_scheduler
+
+def get_logger():
+    # 日志收集器
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+
+    # Avoid passing messages to the root logger
+    logger.propagate = False
+
+    # If the logger already has handlers, avoid adding duplicate ones
+    if not logger.hasHandlers():
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s')
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    return logger
+
+LOGGER = get_logger()
+
+# 没有指定会话的请求（旧固件的/upload、/audio、/heartbeat）都属于这个会话
+DEFAULT_SESSION = "default"
+# 开发板也可以通过这个请求头或者?session=参数指定会话
+SESSION_HEADER = "X-Session-Id"
+# GET /audio最多等待多少秒
+AUDIO_WAIT_TIMEOUT = 300
+# 同时存在的会话数上限，以及由请求创建、没有对话流水线使用的会话空闲多少秒后被关闭（要大于AUDIO_WAIT_TIMEOUT）
+MAX_SESSIONS = 64
+SESSION_IDLE_TIMEOUT = 600
+
+
+class SessionLimitError(RuntimeError):
+    '''会话数已经达到上限，不能再创建新的会话。'''
+
+# 流式接口（GET /audio/stream）的帧格式：1字节类型 + 4字节大端长度 + 数据
+FRAME_HEADER = struct.Struct(">BI")
+FRAME_END = 0x00     # 这一轮的音频结束，数据为空，代替轮询接口的204 END
+FRAME_WAV = 0x01     # 一段完整的wav音频
+FRAME_FORMAT = 0x02  # 接下来的PCM帧的格式：采样率（4字节）、声道数（2字节）、采样位宽（2字节，单位字节）
+FRAME_PCM = 0x03     # 一段PCM数据，流式合成时合成出一块就发送一块
+PCM_FORMAT = struct.Struct(">IHH")
+STREAM_MIMETYPE = "application/x-audiochat-frames"
+
+# 流式上传时每次从请求中读取的字节数：16kHz 16bit单声道PCM的100毫秒
+UPLOAD_CHUNK_SIZE = 3200
+# 判断上传的是WAV还是PCM之前，先攒够这么多字节（一个标准的WAV头是44字节）
+_UPLOAD_HEAD_SIZE = 44
+_UPLOAD_END = object()
+
+
+def encode_frame(frame_type: int, payload: bytes = b"") -> bytes:
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+
+def read_frames(stream: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    '''解析流式接口的响应，依次返回(帧类型, 数据)，读到FRAME_END或者连接关闭时结束。供客户端和测试使用。'''
+    while True:
+        header = stream.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return
+        frame_type, length = FRAME_HEADER.unpack(header)
+        payload = stream.read(length) if length else b""
+        yield frame_type, payload
+        if frame_type == FRAME_END:
+            return
+
+
+def audio_frames(audio) -> Iterator[bytes]:
+    '''把一段音频编码成帧：流式合成的音频逐块发送PCM，其余的音频作为一个完整的wav发送。'''
+    if isinstance(audio, StreamingAudio):
+        yield encode_frame(FRAME_FORMAT, PCM_FORMAT.pack(audio.sample_rate, audio.channels, audio.sample_width))
+        for chunk in audio:
+            yield encode_frame(FRAME_PCM, chunk)
+        if audio.error is not None:
+            LOGGER.error(f"RemoteGateway: streaming synthesis failed: {audio.error}")
+        return
+    yield encode_frame(FRAME_WAV, read_audio(audio))
+
+
+class UploadStream:
+    '''
+    流式上传的音频：HTTP处理函数一边接收一边put，RemoteSTT一边迭代一边识别，数据只保存在内存中。
+    ----
+    - format: 第一个数据块以RIFF开头时为"wav"（sample_rate取自WAV头），否则为"raw"（sample_rate取自请求的rate参数）。
+    - ready: 格式确定之后被设置，识别之前需要等待它。
+    - 迭代时阻塞等待新的数据块，直到上传结束（close）；上传中断时迭代抛出异常。
+    '''
+    def __init__(self, sample_rate: int = 16000):
+        self.format: Optional[str] = None
+        self.sample_rate = sample_rate
+        self.error: Optional[BaseException] = None
+        self.ready = threading.Event()
+        self._chunks: queue.Queue = queue.Queue()
+        self._head = bytearray()
+
+    def put(self, chunk: bytes) -> None:
+        if self.format is not None:
+            self._chunks.put(chunk)
+            return
+        self._head.extend(chunk)
+        if len(self._head) >= _UPLOAD_HEAD_SIZE:
+            self._detect_format()
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        '''上传结束（或失败）时调用。'''
+        if self.format is None:
+            self._detect_format()
+        self.error = error
+        self._chunks.put(_UPLOAD_END)
+
+    def _detect_format(self) -> None:
+        head = bytes(self._head)
+        if head[:4] == b'RIFF':
+            self.format = "wav"
+            try:
+                self.sample_rate = read_wav_info(head)[2]
+            except (wave.Error, struct.error):
+                # 头部不完整（例如前面有很长的LIST块），每一包的大小按默认的采样率计算
+                pass
+        else:
+            self.format = "raw"
+        if head:
+            self._chunks.put(head)
+        self._head.clear()
+        self.ready.set()
+
+    def __iter__(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is _UPLOAD_END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield chunk
+
+    def read(self) -> bytes:
+        '''等待上传结束，返回完整的音频数据。'''
+        return b"".join(self)
+
+
+class RemoteSession:
+    '''
+    一个开发板对应的会话状态，与具体的HTTP服务器无关。
+    ----
+    - uploads: 开发板上传的音频数据（bytes，流式上传时为UploadStream），RemoteSTT阻塞等待。
+    - offer()/wait_taken(): RemoteSpeaker交出一段音频，并等待开发板取走；offer(None)表示这一轮的音频结束。
+    - take(): HTTP处理函数取走当前的音频，没有音频时最多等待timeout秒。
+    '''
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.uploads: queue.Queue = queue.Queue()
+        # current_audio保存在TurnState中，开发板取走音频时唤醒wait_taken，不需要轮询
+        self.state = TurnState(current_audio=None, end_of_audio=False, terminated=False)
+        self.audio_ready = threading.Event()
+        self.final_request_received = threading.Event()
+        self.last_heartbeat = time.time()
+        # 最后一次收到这个会话的请求（包括心跳）的时间，用来判断会话是否空闲
+        self.last_active = self.last_heartbeat
+        # 被RemoteSTT/RemoteSpeaker使用的会话不会因为空闲被关闭，由RemoteSpeaker的心跳超时关闭
+        self.pinned = False
+        self._lock = threading.Lock()
+
+    @property
+    def current_audio(self):
+        return self.state['current_audio']
+
+    @property
+    def end_of_audio(self) -> bool:
+        return self.state['end_of_audio']
+
+    def heartbeat(self) -> None:
+        self.last_heartbeat = self.last_active = time.time()
+
+    def touch(self) -> None:
+        self.last_active = time.time()
+
+    def new_turn(self) -> None:
+        '''开始新的一轮：清除上一轮的结束标记。'''
+        with self._lock:
+            self.state.update(current_audio=None, end_of_audio=False, terminated=False)
+            self.audio_ready.clear()
+            self.final_request_received.clear()
+
+    def offer(self, audio) -> None:
+        with self._lock:
+            self.state['current_audio'] = audio
+            if audio is None:
+                self.state['end_of_audio'] = True
+            self.audio_ready.set()
+
+    def wait_taken(self, timeout: Optional[float] = None) -> bool:
+        '''等待开发板取走当前的音频，或者会话被终止。'''
+        return self.state.wait_for(lambda state: not state['current_audio'] or state['terminated'], timeout)
+
+    def take(self, timeout: float = AUDIO_WAIT_TIMEOUT, read: bool = True):
+        '''
+        返回("audio", 音频数据)、("end", None)或者None（等待超时）。
+        read为True时，音频在这里被读入内存并删除，调用方只需要把它发送给开发板；
+        为False时返回音频对象本身（例如还在合成中的StreamingAudio），由调用方发送并调用remove_audio。
+        两种情况下音频都立即被取走，RemoteSpeaker随即交出下一段音频。
+        '''
+        if not self.audio_ready.wait(timeout=timeout):
+            return None
+        return self._take_now(read)
+
+    async def take_async(self, timeout: float = AUDIO_WAIT_TIMEOUT):
+        '''take(read=False)的协程版本：等待期间只占用一个协程，音频由调用方读取（可能阻塞，应放到线程池中）。'''
+        if not await self.state.wait_for_async(lambda state: state['current_audio'] or state['end_of_audio'] or state['terminated'], timeout):
+            return None
+        return self._take_now(read=False)
+
+    def _take_now(self, read: bool):
+        with self._lock:
+            audio = self.state['current_audio']
+            if audio:
+                if read:
+                    audio = read_audio(audio)
+                    remove_audio(self.state['current_audio'])
+                self.audio_ready.clear()
+                self.state['current_audio'] = None
+                return "audio", audio
+            if self.state['end_of_audio']:
+                return "end", None
+        return None
+
+    def terminate(self) -> None:
+        '''终止会话，唤醒正在等待的wait_taken。'''
+        self.state['terminated'] = True
+
+
+class RemoteGateway:
+    '''
+    多个开发板共用的HTTP网关：路由只在创建时注册一次，请求按会话ID转交给对应会话的RemoteSTT/RemoteSpeaker。
+    ----
+    - /sessions/<session_id>/upload、/sessions/<session_id>/audio、/sessions/<session_id>/heartbeat: 指定会话的接口。
+    - /upload、/audio、/heartbeat: 旧固件使用的接口，会话ID取自X-Session-Id请求头或?session=参数，都没有时属于DEFAULT_SESSION。
+    - /upload/stream、/sessions/<session_id>/upload/stream: 流式上传（可以是chunked请求），音频一边到达一边识别；PCM的采样率由?rate=指定。
+    - /audio/stream、/sessions/<session_id>/audio/stream: 流式接口，一个响应推送一整轮的音频，帧格式见encode_frame；/audio仍然保留给旧固件。
+    - POST /sessions: 为新的开发板分配一个会话ID。
+    会话由POST /sessions、上传音频或者session()创建；on_session注册的回调在新会话创建时被调用（参数为RemoteSession），可以用来为它启动一条对话流水线。
+    GET /audio、/audio/stream、/heartbeat只查找已有的会话，会话不存在时返回404。
+    - max_sessions: 同时存在的会话数上限，达到上限时创建会话的请求返回503。
+    - idle_timeout: 由请求创建、没有被session()取用的会话，超过这么多秒没有收到请求时被关闭；超时由共享的DeadlineScheduler触发。
+    server为"asgi"（默认）时用uvicorn运行asgi_gateway中的ASGI应用，等待音频的开发板只占用一个协程；
+    为"flask"时用Flask的开发服务器运行，每个等待中的请求占用一个线程。两者的路由和返回值相同。
+    '''
+    def __init__(self, app: Optional[Flask] = None, host: str = '0.0.0.0', port: int = 5000, server: str = "asgi",
+                 max_sessions: int = MAX_SESSIONS, idle_timeout: float = SESSION_IDLE_TIMEOUT):
+        if server not in ("asgi", "flask"):
+            raise ValueError(f"unknown server: {server}")
+        self.app = app or Flask(__name__)
+        self.host = host
+        self.port = port
+        self.server = server
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions: Dict[str, RemoteSession] = {}
+        self._idle_deadlines: Dict[str, Deadline] = {}
+        self._callbacks: List[Callable[[RemoteSession], None]] = []
+        self._lock = threading.Lock()
+        self._server_thread: Optional[threading.Thread] = None
+        self._register_routes()
+
+    def _register_routes(self) -> None:
+        for prefix, name in (("", ""), ("/sessions/<session_id>", "session_")):
+            self.app.add_url_rule(f"{prefix}/upload", view_func=self._upload, methods=['POST'], endpoint=f"{name}upload")
+            self.app.add_url_rule(f"{prefix}/upload/stream", view_func=self._upload_stream, methods=['POST'], endpoint=f"{name}upload_stream")
+            self.app.add_url_rule(f"{prefix}/audio", view_func=self._audio, methods=['GET'], endpoint=f"{name}audio")
+            self.app.add_url_rule(f"{prefix}/audio/stream", view_func=self._audio_stream, methods=['GET'], endpoint=f"{name}audio_stream")
+            self.app.add_url_rule(f"{prefix}/heartbeat", view_func=self._heartbeat, methods=['POST', 'GET'], endpoint=f"{name}heartbeat")
+        self.app.add_url_rule("/sessions", view_func=self._create_session, methods=['POST'], endpoint="sessions")
+
+    def start(self) -> "RemoteGateway":
+        '''启动HTTP服务器，多次调用只会启动一次。'''
+        with self._lock:
+            if self._server_thread is None:
+                if self.server == "asgi":
+                    from asgi_gateway import serve
+                    target = lambda: serve(self, self.host, self.port)
+                else:
+                    target = lambda: self.app.run(host=self.host, port=self.port, debug=False, use_reloader=False, threaded=True)
+                self._server_thread = threading.Thread(target=target, daemon=True)
+                self._server_thread.start()
+                LOGGER.info(f"RemoteGateway: listening on {self.host}:{self.port} ({self.server})")
+        return self
+
+    def on_session(self, callback: Callable[[RemoteSession], None]) -> None:
+        self._callbacks.append(callback)
+
+    def session(self, session_id: str = DEFAULT_SESSION) -> RemoteSession:
+        '''返回会话，不存在时创建（会话数达到上限时抛出SessionLimitError）。取用的会话不会因为空闲被关闭。'''
+        return self._get_or_create(session_id, pin=True)
+
+    def find_session(self, session_id: str) -> Optional[RemoteSession]:
+        '''返回已有的会话，不存在时返回None。'''
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def _get_or_create(self, session_id: str, pin: bool) -> RemoteSession:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            created = session is None
+            if created:
+                if len(self._sessions) >= self.max_sessions:
+                    raise SessionLimitError(f"too many sessions: {len(self._sessions)}")
+                session = self._sessions[session_id] = RemoteSession(session_id)
+            if pin:
+                session.pinned = True
+                deadline = self._idle_deadlines.pop(session_id, None)
+                if deadline is not None:
+                    deadline.cancel()
+            elif created:
+                self._idle_deadlines[session_id] = get_scheduler().call_later(self.idle_timeout, self._check_idle, session)
+        if created:
+            LOGGER.debug(f"RemoteGateway: new session {session_id}")
+            for callback in list(self._callbacks):
+                callback(session)
+        return session
+
+    def _check_idle(self, session: RemoteSession) -> None:
+        # 在调度线程中运行；期间收到的请求只更新last_active，到期时再决定关闭还是重新注册
+        with self._lock:
+            if self._sessions.get(session.session_id) is not session or session.pinned:
+                return
+            remaining = session.last_active + self.idle_timeout - time.time()
+            if remaining > 0:
+                self._idle_deadlines[session.session_id] = get_scheduler().call_later(remaining, self._check_idle, session)
+                return
+        LOGGER.info(f"RemoteGateway: session {session.session_id} idle for {self.idle_timeout}s, closing")
+        self.close_session(session.session_id, session)
+
+    def close_session(self, session_id: str, session: Optional[RemoteSession] = None) -> None:
+        '''关闭并终止会话；指定session时，只有当前的会话仍然是它才关闭（同一个ID可能已经创建了新的会话）。'''
+        with self._lock:
+            if session is not None and self._sessions.get(session_id) is not session:
+                return
+            session = self._sessions.pop(session_id, None)
+            deadline = self._idle_deadlines.pop(session_id, None)
+        if deadline is not None:
+            deadline.cancel()
+        if session is not None:
+            session.terminate()
+
+    def sessions(self) -> List[str]:
+        with self._lock:
+            return list(self._sessions)
+
+    def request_session(self, session_id: str, create: bool) -> Optional[RemoteSession]:
+        '''
+        HTTP处理函数使用的会话：create为True时不存在就创建（达到上限时抛出SessionLimitError），为False时只查找，不存在时返回None。
+        找到的会话记录一次活动。
+        '''
+        session = self._get_or_create(session_id, pin=False) if create else self.find_session(session_id)
+        if session is not None:
+            session.touch()
+        return session
+
+    def _session_for_request(self, session_id: Optional[str], create: bool = False) -> Optional[RemoteSession]:
+        return self.request_session(session_id or request.headers.get(SESSION_HEADER) or request.args.get("session") or DEFAULT_SESSION, create)
+
+    def _create_session(self):
+        try:
+            session = self.request_session(uuid.uuid4().hex, create=True)
+        except SessionLimitError:
+            return 'Too many sessions', 503
+        return {"session_id": session.session_id}, 201
+
+    def _upload(self, session_id: Optional[str] = None):
+        try:
+            session = self._session_for_request(session_id, create=True)
+        except SessionLimitError:
+            return 'Too many sessions', 503
+        session.uploads.put(request.data)
+        return 'Audio data received', 200
+
+    def _upload_stream(self, session_id: Optional[str] = None):
+        try:
+            session = self._session_for_request(session_id, create=True)
+        except SessionLimitError:
+            return 'Too many sessions', 503
+        upload = UploadStream(sample_rate=int(request.args.get("rate", 16000)))
+        # 在第一个数据块到达之前就交给RemoteSTT，识别与上传同时进行
+        session.uploads.put(upload)
+        try:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                upload.put(chunk)
+        except Exception as e:
+            upload.close(e)
+            raise
+        upload.close()
+        return 'Audio data received', 200
+
+    def _heartbeat(self, session_id: Optional[str] = None):
+        """Endpoint to receive heartbeat from client"""
+        session = self._session_for_request(session_id)
+        if session is None:
+            return 'Unknown session', 404
+        session.heartbeat()
+        LOGGER.debug(f"RemoteGateway: Heartbeat received for session {session.session_id}")
+        return 'Heartbeat received', 200
+
+    def _audio(self, session_id: Optional[str] = None):
+        session = self._session_for_request(session_id)
+        if session is None:
+            return 'Unknown session', 404
+        result = session.take()
+        if result is None:
+            return 'No audio available', 404
+        kind, audio_data = result
+        if kind == "audio":
+            return audio_data, 200
+
+        @after_this_request
+        def set_final_received(response):
+            # 响应发送给开发板之后，RemoteSpeaker才结束这一轮
+            session.final_request_received.set()
+            return response
+        return 'END', 204
+
+    def _audio_stream(self, session_id: Optional[str] = None):
+        '''
+        流式接口：一个chunked响应中依次推送这一轮的所有音频，TTS合成出一段就推送一段（流式合成时合成出一块就推送一块），
+        最后以FRAME_END结束。等待下一段音频超过AUDIO_WAIT_TIMEOUT秒时，响应直接结束，开发板可以重新连接。
+        '''
+        session = self._session_for_request(session_id)
+        if session is None:
+            return 'Unknown session', 404
+        return Response(self.stream_turn(session), mimetype=STREAM_MIMETYPE)
+
+    @staticmethod
+    def stream_turn(session: RemoteSession) -> Iterator[bytes]:
+        while True:
+            result = session.take(read=False)
+            if result is None:
+                LOGGER.warning(f"RemoteGateway: no audio for session {session.session_id}, closing stream")
+                return
+            kind, audio = result
+            if kind == "end":
+                yield encode_frame(FRAME_END)
+                # 生成器在END帧写出之后才会继续运行到这里
+                session.final_request_received.set()
+                return
+            try:
+                yield from audio_frames(audio)
+            finally:
+                remove_audio(audio)
+
+
+_GATEWAY: Optional[RemoteGateway] = None
+_GATEWAY_LOCK = threading.Lock()
+
+def get_gateway() -> RemoteGateway:
+    '''
+    进程内共享的RemoteGateway，端口由config.json中的remote_port配置，默认5000；服务器由remote_server配置（asgi或flask），默认asgi；
+    会话数上限和空闲超时由remote_max_sessions、remote_session_idle_timeout配置。
+    '''
+    global _GATEWAY
+    with _GATEWAY_LOCK:
+        if _GATEWAY is None:
+            config = get_config()
+            _GATEWAY = RemoteGateway(port=int(config.get("remote_port", 5000)), server=config.get("remote_server", "asgi"),
+                                     max_sessions=int(config.get("remote_max_sessions", MAX_SESSIONS)),
+                                     idle_timeout=float(config.get("remote_session_idle_timeout", SESSION_IDLE_TIMEOUT)))
+        return _GATEWAY
@@ -0,0 +1,167 @@
+import os
+import math
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+from typing import Callable, List, Optional, Tuple
+
+from app_config import get_config
+
+def get_logger():
+    # 日志收集器
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+
+    # Avoid passing messages to the root logger
+    logger.propagate = False
+
+    # If the logger already has handlers, avoid adding duplicate ones
+    if not logger.hasHandlers():
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s')
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    return logger
+
+LOGGER = get_logger()
+
+
+class Deadline:
+    '''call_later/call_at返回的句柄，到期之前可以cancel()。'''
+    __slots__ = ("when", "callback", "args", "cancelled", "_in_heap", "_scheduler")
+
+    def __init__(self, when: float, callback: Callable, args: tuple, scheduler: "DeadlineScheduler"):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._in_heap = True
+        self._scheduler = scheduler
+
+    def cancel(self) -> None:
+        self._scheduler._cancel(self)
+
+
+class DeadlineScheduler:
+    '''
+    进程内共享的超时调度器：所有的超时（心跳超时、静默休眠、一轮对话的超时等）都注册到同一个最小堆中，由一个线程负责触发，
+    线程数与会话数无关。
+    ----
+    - call_later(delay, callback, *args) / call_at(when, callback, *args): 注册一个超时，when为time.monotonic()的时间，返回Deadline。
+    - resolution: 超时精度（秒）。调度线程只在resolution的整数倍时刻醒来，同一个时间片内到期的超时一起触发，
+      超时最多推迟resolution秒。精度越低，大量会话同时存在时唤醒的次数越少。
+    回调在调度线程中依次执行，不能阻塞；耗时的操作应交给其他线程。回调抛出的异常只记录日志。
+    '''
+    def __init__(self, resolution: float = 0.01):
+        if resolution <= 0:
+            raise ValueError(f"resolution must be positive: {resolution}")
+        self.resolution = resolution
+        self._heap: List[Tuple[float, int, Deadline]] = []
+        self._counter = itertools.count()
+        self._cancelled = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="DeadlineScheduler", daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Deadline:
+        return self.call_at(time.monotonic() + max(0.0, delay), callback, *args)
+
+    def call_at(self, when: float, callback: Callable, *args) -> Deadline:
+        deadline = Deadline(when, callback, args, self)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("DeadlineScheduler is closed")
+            heapq.heappush(self._heap, (when, next(self._counter), deadline))
+            # 只有新的超时比原来最早的超时还早时，才需要唤醒调度线程重新计算等待时间
+            if self._heap[0][2] is deadline:
+                self._cond.notify()
+        return deadline
+
+    def pending(self) -> int:
+        '''尚未到期、也没有取消的超时数。'''
+        with self._cond:
+            return len(self._heap) - self._cancelled
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._heap.clear()
+            self._cancelled = 0
+            self._cond.notify()
+        self._thread.join()
+
+    def _cancel(self, deadline: Deadline) -> None:
+        with self._cond:
+            if deadline.cancelled:
+                return
+            deadline.cancelled = True
+            if not deadline._in_heap:
+                return
+            self._cancelled += 1
+            # 取消的超时留在堆中，到期时跳过；取消得太多时重建一次堆，避免堆无限增长
+            if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+                heap = []
+                for entry in self._heap:
+                    if entry[2].cancelled:
+                        entry[2]._in_heap = False
+                    else:
+                        heap.append(entry)
+                heapq.heapify(heap)
+                self._heap = heap
+                self._cancelled = 0
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    timeout = None
+                    if self._heap:
+                        # 醒来的时刻对齐到resolution的整数倍，相近的超时合并为一次唤醒
+                        when = self._heap[0][0]
+                        timeout = max(math.ceil(when / self.resolution) * self.resolution, when) - now
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+                due = []
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    deadline = heapq.heappop(self._heap)[2]
+                    deadline._in_heap = False
+                    if deadline.cancelled:
+                        self._cancelled -= 1
+                    else:
+                        due.append(deadline)
+            for deadline in due:
+                with self._cond:
+                    # 在同一批中先到期的回调可能取消了后面的超时；触发之后再cancel()不起作用
+                    if deadline.cancelled:
+                        continue
+                    deadline.cancelled = True
+                try:
+                    deadline.callback(*deadline.args)
+                except Exception as e:
+                    LOGGER.error(f"DeadlineScheduler: callback {deadline.callback} failed: {e}")
+
+
+_SCHEDULER: Optional[DeadlineScheduler] = None
+_SCHEDULER_PID: Optional[int] = None
+_SCHEDULER_LOCK = threading.Lock()
+
+def get_scheduler() -> DeadlineScheduler:
+    '''进程内共享的DeadlineScheduler，精度由config.json中的scheduler_resolution_ms配置，默认10毫秒。'''
+    global _SCHEDULER, _SCHEDULER_PID
+    with _SCHEDULER_LOCK:
+        # fork出来的子进程（例如VoiceAwakeBackend的main work flow）没有父进程的调度线程，需要重新创建
+        if _SCHEDULER is None or _SCHEDULER_PID != os.getpid():
+            _SCHEDULER = DeadlineScheduler(resolution=float(get_config().get("scheduler_resolution_ms", 10)) / 1000)
+            _SCHEDULER_PID = os.getpid()
+        return _SCHEDULER
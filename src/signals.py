@@ -0,0 +1,115 @@
+import asyncio
+import threading
+
+from collections import deque
+from typing import Callable, List, Optional, Union
+
+
+class TurnState(dict):
+    '''
+    一轮对话中各个阶段共享的状态，用法与原来的{"text": None}字典相同，但写入时会唤醒等待的线程，不需要轮询。
+    ----
+    - state['text'] = ...: 写入后唤醒所有wait_for的线程，并依次调用subscribe注册的回调（参数为key和value）。
+    - wait_for(predicate, timeout): predicate为key时，等待这个key的值不为None；为函数时，等待predicate(state)为真。
+      返回最后一次判断的结果，超时时为假值。
+    - wait_for_async(predicate, timeout): wait_for的协程版本，等待期间只占用一个协程，不占用线程，可以在任意事件循环中使用。
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+        self._callbacks: List[Callable] = []
+        self._async_waiters = set()
+
+    def __setitem__(self, key, value):
+        with self._cond:
+            super().__setitem__(key, value)
+            self._cond.notify_all()
+            waiters = list(self._async_waiters)
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                # 等待者所在的事件循环已经关闭
+                pass
+        for callback in list(self._callbacks):
+            callback(key, value)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def subscribe(self, callback: Callable) -> None:
+        self._callbacks.append(callback)
+
+    def wait_for(self, predicate: Union[str, Callable], timeout: Optional[float] = None):
+        predicate = _as_predicate(predicate)
+        with self._cond:
+            return self._cond.wait_for(lambda: predicate(self), timeout)
+
+    async def wait_for_async(self, predicate: Union[str, Callable], timeout: Optional[float] = None):
+        predicate = _as_predicate(predicate)
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self._cond:
+                result = predicate(self)
+                if result:
+                    return result
+                waiter = (loop, loop.create_future())
+                self._async_waiters.add(waiter)
+            try:
+                remaining = None if deadline is None else deadline - loop.time()
+                if remaining is not None and remaining <= 0:
+                    return result
+                await asyncio.wait_for(waiter[1], remaining)
+            except asyncio.TimeoutError:
+                with self._cond:
+                    return predicate(self)
+            finally:
+                with self._cond:
+                    self._async_waiters.discard(waiter)
+
+    def __reduce__(self):
+        # 跨进程传递时只传递数据，锁和回调只在当前进程中有效
+        return (self.__class__, (dict(self),))
+
+
+def _as_predicate(predicate: Union[str, Callable]) -> Callable:
+    if isinstance(predicate, str):
+        key = predicate
+        return lambda state: state.get(key) is not None
+    return predicate
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class SignalDeque(deque):
+    '''
+    放入元素时唤醒等待线程的deque，用于代替`while len(dq) == 0: time.sleep(...)`。
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    def append(self, item):
+        with self._cond:
+            super().append(item)
+            self._cond.notify()
+
+    def extend(self, items):
+        with self._cond:
+            super().extend(items)
+            self._cond.notify_all()
+
+    def wait_popleft(self, timeout: Optional[float] = None):
+        '''阻塞直到有元素可取，超时时抛出IndexError。'''
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(self) > 0, timeout):
+                raise IndexError("wait_popleft timed out")
+            return self.popleft()
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),))
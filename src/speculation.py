@@ -0,0 +1,144 @@
+import time
+import logging
+import threading
+
+from typing import Callable, Optional, Tuple
+
+from moderation import normalize
+from scheduler import Deadline, get_scheduler
+
+def get_logger():
+    # 日志收集器
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+
+    # Avoid passing messages to the root logger
+    logger.propagate = False
+
+    # If the logger already has handlers, avoid adding duplicate ones
+    if not logger.hasHandlers():
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s')
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    return logger
+
+LOGGER = get_logger()
+
+
+class SpeculationStats:
+    '''推测执行的统计：命中率，以及命中时LLM提前启动的总时长。'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = 0
+        self.restarts = 0
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.0
+
+    def record(self, **counts) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def hit_rate(self) -> float:
+        with self._lock:
+            total = self.hits + self.misses
+            return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        hit_rate = self.hit_rate
+        with self._lock:
+            return {
+                "started": self.started,
+                "restarts": self.restarts,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": hit_rate,
+                "time_saved": self.time_saved,
+            }
+
+# 进程内累计的统计
+SPECULATION_STATS = SpeculationStats()
+
+
+class PartialTranscriptSpeculator:
+    '''
+    根据实时语音识别的中间结果提前启动LLM。
+    ----
+    - on_partial: 每收到一个中间结果调用一次。中间结果在stable_ms内没有再变化，就认为它是稳定的，调用start(text)启动一次推测执行；
+      之后出现了不同的稳定结果，则取消当前的推测执行并重新启动。
+    - resolve: 收到最终结果时调用。最终结果与推测所用的文本一致（忽略标点、空白和大小写）时，打开闸门并返回推测执行的LLM线程；
+      否则取消推测执行并返回None，由调用方按正常流程处理。
+    start(text)需要返回(llm, gate)：llm有cancel()方法，gate有open()和discard()方法（例如GatedQueue）。
+    稳定的判断由进程共享的调度器（scheduler.get_scheduler()）计时，start在调度器线程中被调用，不应阻塞。
+    '''
+    def __init__(self, start: Callable[[str], Tuple[object, object]], stable_ms: int = 300, stats: SpeculationStats = SPECULATION_STATS):
+        self.start = start
+        self.stable_s = stable_ms / 1000
+        self.stats = stats
+        self._lock = threading.Lock()
+        self.scheduler = get_scheduler()
+        self._timer: Optional[Deadline] = None
+        self._current = None  # (文本, llm, gate, 启动时间)
+        self._closed = False
+
+    def on_partial(self, text: str) -> None:
+        if not text:
+            return
+        with self._lock:
+            if self._closed:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = self.scheduler.call_later(self.stable_s, self._on_stable, text)
+
+    def _on_stable(self, text: str) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            if self._current is not None:
+                if normalize(self._current[0]) == normalize(text):
+                    return
+                self._cancel_current()
+                self.stats.record(restarts=1)
+            LOGGER.debug(f"Speculator: start llm on partial transcript '{text}'")
+            llm, gate = self.start(text)
+            self._current = (text, llm, gate, time.monotonic())
+            self.stats.record(started=1)
+
+    def resolve(self, final_text: str):
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+            if self._current is None:
+                return None
+            text, llm, gate, started_at = self._current
+            if normalize(text) == normalize(final_text or ""):
+                gate.open()
+                saved = time.monotonic() - started_at
+                self.stats.record(hits=1, time_saved=saved)
+                LOGGER.debug(f"Speculator: hit, llm started {saved * 1000:.0f} ms early, {self.stats.stats()}")
+                return llm
+            self._cancel_current()
+            self.stats.record(misses=1)
+            LOGGER.debug(f"Speculator: miss, '{text}' != '{final_text}', {self.stats.stats()}")
+            return None
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self._cancel_current()
+
+    def _cancel_current(self) -> None:
+        if self._current is not None:
+            _, llm, gate, _ = self._current
+            llm.cancel()
+            gate.discard()
+            self._current = None
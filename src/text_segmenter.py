@@ -0,0 +1,65 @@
+from typing import Iterable, List, Optional
+
+# 不把英文的'.'算入截断标点符号中，因为大模型生成的文本中，标题会用到'.'，比如'6.'
+DEFAULT_DELIMITERS = frozenset([',', '，', '。', '！', '？', '!', '?'])
+
+
+class SentenceSegmenter:
+    '''
+    流式分句器：把LLM逐个吐出的token切分成句子。
+    ----
+    每次`feed`只扫描新到的token，已经扫描过的文本不会再被扫描或拼接，所以每个token的开销与回复总长度无关。
+    - delimiters: 截断符号集合。
+    - min_chars: 句子的最短长度，遇到截断符号但长度不足时，继续累积到下一个截断符号。
+    - max_chars: 句子的最大长度，长时间没有截断符号时强制截断，None表示不限制。
+    '''
+    def __init__(
+            self,
+            delimiters: Iterable[str] = DEFAULT_DELIMITERS,
+            min_chars: int = 1,
+            max_chars: Optional[int] = None,
+    ):
+        if max_chars is not None and max_chars < max(min_chars, 1):
+            raise ValueError("max_chars must be >= min_chars")
+        self.delimiters = frozenset(delimiters)
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.reset()
+
+    def reset(self) -> None:
+        '''清空尚未输出的文本，以便复用于下一次对话。'''
+        self._parts: List[str] = []
+        self._length = 0
+
+    def feed(self, token: str) -> List[str]:
+        '''输入一个新token，返回因此而完整的句子（可能为空列表）。'''
+        sentences = []
+        start = 0
+        for i, char in enumerate(token):
+            if char in self.delimiters:
+                self._append(token[start:i + 1])
+                start = i + 1
+                if self._length >= self.min_chars:
+                    sentences.append(self._pop())
+            elif self.max_chars is not None and self._length + (i + 1 - start) >= self.max_chars:
+                self._append(token[start:i + 1])
+                start = i + 1
+                sentences.append(self._pop())
+        if start < len(token):
+            self._append(token[start:])
+        return sentences
+
+    def flush(self) -> Optional[str]:
+        '''LLM推理结束时调用，最后一个句子可能会没有标点符号，返回剩余的文本。'''
+        if not self._length:
+            return None
+        return self._pop()
+
+    def _append(self, text: str) -> None:
+        self._parts.append(text)
+        self._length += len(text)
+
+    def _pop(self) -> str:
+        sentence = ''.join(self._parts)
+        self.reset()
+        return sentence
@@ -0,0 +1,185 @@
+import json
+import logging
+import threading
+
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from alibabacloud_tea_util import models as util_models
+from alibabacloud_tea_openapi import models as open_api_models
+from alibabacloud_alimt20181012 import models as alimt_20181012_models
+from alibabacloud_alimt20181012.client import Client as alimt20181012Client
+
+from app_config import CONFIG, AppConfig
+from connections import CONNECTIONS
+
+MT_ENDPOINT = 'mt.cn-hangzhou.aliyuncs.com'
+
+def get_logger():
+    # 日志收集器
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+
+    # Avoid passing messages to the root logger
+    logger.propagate = False
+
+    # If the logger already has handlers, avoid adding duplicate ones
+    if not logger.hasHandlers():
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(pathname)s:%(lineno)d - %(message)s')
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    return logger
+
+LOGGER = get_logger()
+
+
+def create_client(args: AppConfig) -> alimt20181012Client:
+    # 工程代码泄露可能会导致 AccessKey 泄露，并威胁账号下所有资源的安全性。以下代码示例仅供参考。
+    # 建议使用更安全的 STS 方式，更多鉴权访问方式请参见：https://help.aliyun.com/document_detail/378659.html。
+    config = open_api_models.Config(
+        access_key_id=args.machine_translation_key_id,
+        access_key_secret=args.machine_translation_secret_key
+    )
+    # Endpoint 请参考 https://api.aliyun.com/product/alimt
+    config.endpoint = MT_ENDPOINT
+    return alimt20181012Client(config)
+
+
+class TranslationService:
+    '''
+    阿里云机器翻译服务。
+    ----
+    - 进程内只创建一个client（按AccessKey缓存在CONNECTIONS中）。
+    - 翻译结果缓存在LRU中，key为(源语言, 目标语言, 文本)。
+    - 提供同步、异步（*_async）以及批量翻译（一次请求翻译多段文本）的接口。
+    - 翻译失败时返回原文，并且不缓存失败的结果。
+    '''
+    def __init__(self, max_items: int = 512, scene: str = 'general', format_type: str = 'text'):
+        self.max_items = max_items
+        self.scene = scene
+        self.format_type = format_type
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def client(self) -> alimt20181012Client:
+        args = CONFIG.require('machine_translation_key_id', 'machine_translation_secret_key')
+        # 以AccessKey作为key，配置文件中的AccessKey修改后会创建新的client
+        return CONNECTIONS.client(("alimt", args.machine_translation_key_id), lambda: create_client(args))
+
+    def translate(self, text: str, source: str = 'zh', target: str = 'en') -> str:
+        cached = self._get((source, target, text))
+        if cached is not None:
+            return cached
+        try:
+            result = self.client().translate_general_with_options(self._request(text, source, target), util_models.RuntimeOptions())
+        except Exception as error:
+            LOGGER.error(f"TranslationService: failed to translate '{text}': {error}")
+            return text
+        return self._put((source, target, text), result.body.data.translated)
+
+    async def translate_async(self, text: str, source: str = 'zh', target: str = 'en') -> str:
+        cached = self._get((source, target, text))
+        if cached is not None:
+            return cached
+        try:
+            result = await self.client().translate_general_with_options_async(self._request(text, source, target), util_models.RuntimeOptions())
+        except Exception as error:
+            LOGGER.error(f"TranslationService: failed to translate '{text}': {error}")
+            return text
+        return self._put((source, target, text), result.body.data.translated)
+
+    def translate_batch(self, texts: Sequence[str], source: str = 'zh', target: str = 'en') -> List[str]:
+        '''批量翻译，已经缓存的文本不再请求，其余文本在一次GetBatchTranslate请求中完成。'''
+        results, missing = self._split_cached(texts, source, target)
+        if missing:
+            try:
+                response = self.client().get_batch_translate_with_options(self._batch_request(missing, source, target), util_models.RuntimeOptions())
+                self._merge_batch(response, texts, missing, results, source, target)
+            except Exception as error:
+                LOGGER.error(f"TranslationService: failed to translate a batch of {len(missing)}: {error}")
+        return [text if result is None else result for text, result in zip(texts, results)]
+
+    async def translate_batch_async(self, texts: Sequence[str], source: str = 'zh', target: str = 'en') -> List[str]:
+        results, missing = self._split_cached(texts, source, target)
+        if missing:
+            try:
+                response = await self.client().get_batch_translate_with_options_async(self._batch_request(missing, source, target), util_models.RuntimeOptions())
+                self._merge_batch(response, texts, missing, results, source, target)
+            except Exception as error:
+                LOGGER.error(f"TranslationService: failed to translate a batch of {len(missing)}: {error}")
+        return [text if result is None else result for text, result in zip(texts, results)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "items": len(self._cache)}
+
+    def _request(self, text: str, source: str, target: str) -> alimt_20181012_models.TranslateGeneralRequest:
+        return alimt_20181012_models.TranslateGeneralRequest(
+            format_type=self.format_type,
+            source_language=source,
+            target_language=target,
+            source_text=text,
+            scene=self.scene
+        )
+
+    def _batch_request(self, missing: Dict[int, str], source: str, target: str) -> alimt_20181012_models.GetBatchTranslateRequest:
+        return alimt_20181012_models.GetBatchTranslateRequest(
+            format_type=self.format_type,
+            source_language=source,
+            target_language=target,
+            # source_text是{"序号": "文本"}形式的json，结果通过index对应回原文
+            source_text=json.dumps({str(index): text for index, text in missing.items()}, ensure_ascii=False),
+            scene=self.scene,
+            api_type='translate_standard'
+        )
+
+    def _split_cached(self, texts: Sequence[str], source: str, target: str):
+        results: List[Optional[str]] = []
+        missing: Dict[int, str] = {}
+        for index, text in enumerate(texts):
+            cached = self._get((source, target, text))
+            results.append(cached)
+            if cached is None:
+                missing[index] = text
+        return results, missing
+
+    def _merge_batch(self, response, texts, missing, results, source, target) -> None:
+        for item in response.body.translated_list or []:
+            index = int(item.get('index', -1))
+            if index in missing and str(item.get('code')) == '200':
+                results[index] = self._put((source, target, texts[index]), item['translated'])
+
+    def _get(self, key: Tuple[str, str, str]) -> Optional[str]:
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _put(self, key: Tuple[str, str, str], value: str) -> str:
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_items:
+                self._cache.popitem(last=False)
+        return value
+
+
+_SERVICE: Optional[TranslationService] = None
+_SERVICE_LOCK = threading.Lock()
+
+def get_translation_service() -> TranslationService:
+    '''进程内共享的翻译服务。'''
+    global _SERVICE
+    with _SERVICE_LOCK:
+        if _SERVICE is None:
+            _SERVICE = TranslationService()
+        return _SERVICE
@@ -0,0 +1,205 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+
+class TTSCache:
+    '''
+    语音合成结果的缓存，以合成参数的哈希作为key（content-addressed）。
+    ----
+    - 内存层：容量有限的LRU，按条目数和字节数限制大小。
+    - 磁盘层（可选）：disk_dir不为空时启用，超过max_disk_bytes时按最近使用时间淘汰。
+    - 并发的相同请求只会合成一次（single-flight），其余请求等待并共享结果。
+    '''
+    def __init__(
+            self,
+            max_items: int = 256,
+            max_memory_bytes: int = 64 * 1024 * 1024,
+            disk_dir: Optional[str] = None,
+            max_disk_bytes: int = 512 * 1024 * 1024,
+    ):
+        self.max_items = max_items
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._inflight: Dict[str, threading.Event] = {}
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+
+        self._disk_bytes = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(os.path.getsize(path) for path in self._disk_files())
+
+    @staticmethod
+    def make_key(text: str, voice_type: str, speed_ratio: float = 1.0, volume_ratio: float = 1.0, pitch_ratio: float = 1.0, encoding: str = "wav", **extra) -> str:
+        '''根据文本和所有影响音频内容的参数生成key，extra用于区分采样率、模型等其它参数。'''
+        params = [text, voice_type, float(speed_ratio), float(volume_ratio), float(pitch_ratio), encoding, sorted(extra.items())]
+        return hashlib.sha256(json.dumps(params, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        '''先查内存层，再查磁盘层，命中磁盘层的数据会被放回内存层。'''
+        data = self._lookup(key)
+        if data is None:
+            with self._lock:
+                self.misses += 1
+        return data
+
+    def _lookup(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return data
+        data = self._read_disk(key)
+        if data is None:
+            return None
+        with self._lock:
+            self.hits += 1
+            self.disk_hits += 1
+            self._put_memory(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if not data:
+            return
+        with self._lock:
+            self._put_memory(key, data)
+        self._write_disk(key, data)
+
+    def get_or_synthesize(self, key: str, synthesize: Callable[[], Optional[bytes]]) -> Optional[bytes]:
+        '''
+        命中缓存则直接返回，否则调用synthesize合成并写入缓存。
+        同一个key同时只会有一个线程在合成，其他线程等待它的结果。
+        '''
+        while True:
+            data = self._lookup(key)
+            if data is not None:
+                return data
+            with self._lock:
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    self.misses += 1
+                    break
+                self.coalesced += 1
+            # 另一个线程正在合成，等待后重新查缓存；如果它合成失败，则由当前线程重试。
+            event.wait()
+        try:
+            data = synthesize()
+            if data:
+                self.put(key, data)
+            return data
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "coalesced": self.coalesced,
+                "memory_items": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def clear(self) -> None:
+        '''只清空内存层，磁盘层保留。'''
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while len(self._memory) > self.max_items or self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + ".audio")
+
+    def _disk_files(self):
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".audio"):
+                yield os.path.join(self.disk_dir, name)
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # 更新修改时间，作为最近使用时间，供淘汰时参考。
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, data: bytes) -> None:
+        if not self.disk_dir or len(data) > self.max_disk_bytes:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        # 先写临时文件再重命名，进程崩溃时不会留下写了一半的缓存文件。
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            self._disk_bytes += len(data)
+            if self._disk_bytes <= self.max_disk_bytes:
+                return
+        self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        files = []
+        for path in self._disk_files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
@@ -0,0 +1,127 @@
+from collections import deque
+from typing import Deque, List, Optional
+
+import numpy as np
+
+# 说话结束后，持续多长时间（毫秒）的静音判定为这句话结束
+ENDPOINT_MS = {
+    "conservative": 1200,
+    "normal": 700,
+    "aggressive": 400,
+}
+
+
+class VoiceActivityDetector:
+    '''
+    基于能量和过零率的语音活动检测（VAD），用于判断用户何时开始说话、何时说完。
+    ----
+    - 每个数据块被切分成frame_ms长的帧，帧的能量（dB）和过零率用numpy一次性计算。
+    - 噪声基底自适应：非语音帧的能量会更新噪声基底，能量高出基底margin_db的帧判定为语音；
+      能量略低、但过零率高的帧（清辅音）在说话过程中也算作语音。
+    - 平滑（hangover）：连续onset_ms的语音才算开始说话，连续endpoint_ms的非语音才算说完，避免被短暂的噪声或停顿误触发。
+    - 预录（pre-roll）：开始说话之前的pre_roll_ms音频会被保留，开始说话时一起返回，不会切掉第一个字。
+    ----
+    endpoint: "conservative"、"normal"或"aggressive"（约400毫秒静音即结束），endpoint_ms优先于endpoint。
+    min_level: 平均振幅低于这个值的帧一定不是语音，防止在非常安静的环境中把底噪当成语音。
+    '''
+    def __init__(
+            self,
+            sample_rate: int = 16000,
+            frame_ms: int = 20,
+            endpoint: str = "normal",
+            endpoint_ms: Optional[int] = None,
+            onset_ms: int = 60,
+            pre_roll_ms: int = 300,
+            margin_db: float = 10.0,
+            zcr_threshold: float = 0.25,
+            min_level: float = 100,
+            noise_adapt: float = 0.05,
+    ):
+        self.sample_rate = sample_rate
+        self.frame_len = int(sample_rate * frame_ms / 1000)
+        self.frame_ms = frame_ms
+        self.endpoint_frames = max(1, int((endpoint_ms if endpoint_ms is not None else ENDPOINT_MS[endpoint]) / frame_ms))
+        self.onset_frames = max(1, int(onset_ms / frame_ms))
+        self.pre_roll_bytes = int(sample_rate * pre_roll_ms / 1000) * 2
+        self.margin_db = margin_db
+        self.zcr_threshold = zcr_threshold
+        self.min_level = min_level
+        self.noise_adapt = noise_adapt
+        self.reset()
+
+    def reset(self) -> None:
+        self.noise_floor_db: Optional[float] = None
+        self.in_speech = False
+        self.ended = False
+        self._speech_run = 0
+        self._silence_run = 0
+        self._remainder = np.zeros(0, dtype=np.int16)
+        self._pre_roll: Deque[bytes] = deque()
+        self._pre_roll_size = 0
+
+    def frame_features(self, samples: np.ndarray):
+        '''返回每一帧的能量（dB）、平均振幅以及过零率，samples的长度必须是帧长的整数倍。'''
+        frames = samples.reshape(-1, self.frame_len).astype(np.float32)
+        energy_db = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-6)
+        level = np.mean(np.abs(frames), axis=1)
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+        return energy_db, level, zcr
+
+    def process(self, chunk: bytes) -> List[bytes]:
+        '''
+        输入一块16bit单声道PCM，返回属于这句话的音频：开始说话时返回预录的音频和当前块，说话过程中返回当前块，其余情况返回空列表。
+        说完之后ended为True，需要reset()才能检测下一句话。
+        '''
+        if self.ended:
+            return []
+        samples = np.concatenate([self._remainder, np.frombuffer(chunk, dtype=np.int16)])
+        usable = len(samples) - len(samples) % self.frame_len
+        self._remainder = samples[usable:]
+        was_in_speech = self.in_speech
+        if usable:
+            for energy_db, level, zcr in zip(*self.frame_features(samples[:usable])):
+                self._update(float(energy_db), float(level), float(zcr))
+                if self.ended:
+                    break
+
+        if self.in_speech or self.ended:
+            if was_in_speech:
+                return [chunk]
+            # 这一块里开始说话：先返回预录的音频
+            out = list(self._pre_roll) + [chunk]
+            self._pre_roll.clear()
+            self._pre_roll_size = 0
+            return out
+
+        self._pre_roll.append(chunk)
+        self._pre_roll_size += len(chunk)
+        while self._pre_roll and self._pre_roll_size - len(self._pre_roll[0]) >= self.pre_roll_bytes:
+            self._pre_roll_size -= len(self._pre_roll.popleft())
+        return []
+
+    def _update(self, energy_db: float, level: float, zcr: float) -> None:
+        if self.noise_floor_db is None:
+            self.noise_floor_db = energy_db
+        voiced = level >= self.min_level and energy_db > self.noise_floor_db + self.margin_db
+        unvoiced = level >= self.min_level and energy_db > self.noise_floor_db + self.margin_db / 2 and zcr > self.zcr_threshold
+        is_speech = voiced or (self.in_speech and unvoiced)
+
+        if not self.in_speech:
+            if is_speech:
+                self._speech_run += 1
+                if self._speech_run >= self.onset_frames:
+                    self.in_speech = True
+                    self._silence_run = 0
+            else:
+                self._speech_run = 0
+                # 噪声基底：能量下降时快速跟随，上升时缓慢跟随
+                rate = 0.5 if energy_db < self.noise_floor_db else self.noise_adapt
+                self.noise_floor_db += rate * (energy_db - self.noise_floor_db)
+        elif is_speech:
+            self._silence_run = 0
+        else:
+            self._silence_run += 1
+            if self._silence_run >= self.endpoint_frames:
+                self.in_speech = False
+                self.ended = True
@@ -16,15 +16,18 @@ import logging
 import os
 import uuid
 import wave
+import struct
+import threading
 from enum import Enum
 from hashlib import sha256
-from io import BytesIO
-from typing import List
+from typing import AsyncIterator, Iterable, List, Optional, Union
 from urllib.parse import urlparse
 import time
 import websockets
 import numpy as np
 
+from vad import VoiceActivityDetector
+
 PROTOCOL_VERSION = 0b0001
 DEFAULT_HEADER_SIZE = 0b0001
 
@@ -151,12 +154,34 @@ def parse_response(res):
     return result
 
 
-def read_wav_info(data: bytes = None):
-    with BytesIO(data) as _f:
-        wave_fp = wave.open(_f, 'rb')
-        nchannels, sampwidth, framerate, nframes = wave_fp.getparams()[:4]
-        wave_bytes = wave_fp.readframes(nframes)
-    return nchannels, sampwidth, framerate, nframes, len(wave_bytes)
+def read_wav_info(data: Union[bytes, memoryview] = None):
+    """
+    只解析WAV的头部（fmt和data块的头），不解码、也不复制音频数据。
+    返回 (声道数, 采样宽度, 采样率, 帧数, 音频数据的字节数)。
+    """
+    view = memoryview(data)
+    if len(view) < 12 or bytes(view[0:4]) != b'RIFF' or bytes(view[8:12]) != b'WAVE':
+        raise wave.Error("file does not start with RIFF id")
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset:offset + 4])
+        chunk_size = int.from_bytes(view[offset + 4:offset + 8], 'little')
+        body = offset + 8
+        if chunk_id == b'fmt ':
+            _, nchannels, framerate, _, block_align, bits = struct.unpack_from('<HHIIHH', view, body)
+            sampwidth = (bits + 7) // 8
+            fmt = (nchannels, sampwidth, framerate, block_align or nchannels * sampwidth)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise wave.Error("data chunk before fmt chunk")
+            nchannels, sampwidth, framerate, block_align = fmt
+            # 流式生成的WAV，data块的长度可能是占位值，以实际的数据长度为准
+            data_len = min(chunk_size, len(view) - body)
+            return nchannels, sampwidth, framerate, data_len // block_align, data_len
+        # 块的长度为奇数时有一个填充字节
+        offset = body + chunk_size + (chunk_size & 1)
+    raise wave.Error("fmt chunk and/or data chunk missing")
 
 class AudioType(Enum):
     LOCAL = 1  # 使用本地音频文件
@@ -164,12 +189,17 @@ class AudioType(Enum):
 class AsrWsClient:
     def __init__(self, audio_path, cluster, **kwargs):
         """
+        :param audio_path: 音频文件的路径，或者内存中的音频（bytes、bytearray、memoryview），或者异步的字节流（async iterator）
         :param config: config
         """
         self.audio_path = audio_path
         self.cluster = cluster
         self.success_code = 1000  # success code, default is 1000
+        # 每个audio-only包的时长（毫秒）。录完再上传的整段音频默认一包发完，往返次数最少；
+        # 边录边传（stream_processor、zijie_stt_stream*）时传入200左右的小包，服务端更早开始识别，配合max_in_flight不会增加网络往返的次数。
         self.seg_duration = int(kwargs.get("seg_duration", 15000))
+        # 已经发送、还没有收到服务端响应的包的数量上限
+        self.max_in_flight = max(1, int(kwargs.get("max_in_flight", 8)))
         self.nbest = int(kwargs.get("nbest", 1))
         self.appid = kwargs.get("appid", "")
         self.token = kwargs.get("token", "")
@@ -221,13 +251,14 @@ class AsrWsClient:
         return req
 
     @staticmethod
-    def slice_data(data: bytes, chunk_size: int):
+    def slice_data(data: Union[bytes, memoryview], chunk_size: int):
         """
         slice data
         :param data: wav data
         :param chunk_size: the segment size in one request
-        :return: segment data, last flag
+        :return: segment data (memoryview, no copy), last flag
         """
+        data = memoryview(data)
         data_len = len(data)
         offset = 0
         while offset + chunk_size < data_len:
@@ -260,7 +291,7 @@ class AsrWsClient:
                                                                                               str(mac, 'utf-8'), auth_headers)
         return header_dicts
 
-    async def segment_data_processor(self, wav_data: bytes, segment_size: int):
+    def full_client_request(self) -> bytearray:
         reqid = str(uuid.uuid4())
         # 构建 full client request，并序列化压缩
         request_params = self.construct_request(reqid)
@@ -269,38 +300,118 @@ class AsrWsClient:
         full_client_request = bytearray(generate_full_default_header())
         full_client_request.extend((len(payload_bytes)).to_bytes(4, 'big'))  # payload size(4 bytes)
         full_client_request.extend(payload_bytes)  # payload
+        return full_client_request
+
+    @staticmethod
+    def audio_only_request(chunk: bytes, last: bool) -> bytearray:
+        # if no compression, comment this line
+        payload_bytes = gzip.compress(chunk)
+        audio_only_request = bytearray(generate_audio_default_header())
+        if last:
+            audio_only_request = bytearray(generate_last_audio_default_header())
+        audio_only_request.extend((len(payload_bytes)).to_bytes(4, 'big'))  # payload size(4 bytes)
+        audio_only_request.extend(payload_bytes)  # payload
+        return audio_only_request
+
+    def connect(self, full_client_request: bytearray):
         header = None
         if self.auth_method == "token":
             header = self.token_auth()
         elif self.auth_method == "signature":
             header = self.signature_auth(full_client_request)
-        async with websockets.connect(self.ws_url, extra_headers=header, max_size=1000000000) as ws:
+        return websockets.connect(self.ws_url, extra_headers=header, max_size=1000000000)
+
+    def is_error(self, result: dict) -> bool:
+        return 'payload_msg' in result and result['payload_msg']['code'] != self.success_code
+
+    async def segment_data_processor(self, wav_data: bytes, segment_size: int):
+        async def _segments():
+            for chunk, last in AsrWsClient.slice_data(wav_data, segment_size):
+                yield chunk, last
+        return await self.pipeline_processor(_segments())
+
+    async def stream_processor(self, frames: Union[Iterable[bytes], AsyncIterator[bytes]]):
+        """
+        流式识别：边录音边上传。
+        ----
+        frames是PCM数据块的同步或异步迭代器（例如microphone_frames()），数据块按seg_duration聚合成一个audio-only包发送，
+        迭代结束时发送最后一包，服务端随即返回完整的识别结果。同步迭代器在单独的线程中读取，不会阻塞事件循环。
+        要求format为raw（PCM），rate、bits、channel与录音参数一致；format为wav时，WAV头需要在第一个数据块中。
+        """
+        segment_size = int(self.rate * self.bits // 8 * self.channel * self.seg_duration / 1000)
+        return await self.pipeline_processor(stream_segments(frames, segment_size))
+
+    async def pipeline_processor(self, segments: AsyncIterator):
+        """
+        发送与接收并行的识别流程。
+        ----
+        发送协程不等待上一包的响应就发送下一包，已发送未响应的包最多max_in_flight个；
+        接收协程按顺序处理服务端的响应，每收到一个响应就允许再发送一包。
+        所以每一包不再需要一次完整的网络往返，总耗时约为 上传时间 + 一次往返。
+        segments是(数据, 是否最后一包)的异步迭代器，返回最后一个响应（出错时返回错误的响应）。
+        """
+        full_client_request = self.full_client_request()
+        async with self.connect(full_client_request) as ws:
             # 发送 full client request
             await ws.send(full_client_request)
-            res = await ws.recv()
-            result = parse_response(res)
-            if 'payload_msg' in result and result['payload_msg']['code'] != self.success_code:
+            result = parse_response(await ws.recv())
+            if self.is_error(result):
                 return result
-            for seq, (chunk, last) in enumerate(AsrWsClient.slice_data(wav_data, segment_size), 1):
-                # if no compression, comment this line
-                payload_bytes = gzip.compress(chunk)
-                audio_only_request = bytearray(generate_audio_default_header())
-                if last:
-                    audio_only_request = bytearray(generate_last_audio_default_header())
-                audio_only_request.extend((len(payload_bytes)).to_bytes(4, 'big'))  # payload size(4 bytes)
-                audio_only_request.extend(payload_bytes)  # payload
-                # 发送 audio-only client request
-                await ws.send(audio_only_request)
-                res = await ws.recv()
-                result = parse_response(res)
-                if 'payload_msg' in result and result['payload_msg']['code'] != self.success_code:
-                    return result
+
+            in_flight = asyncio.Semaphore(self.max_in_flight)
+            state = {"sent": 0, "done": False}
+            sender_finished = asyncio.Event()
+
+            async def _send():
+                try:
+                    async for chunk, last in segments:
+                        await in_flight.acquire()
+                        # 发送 audio-only client request
+                        await ws.send(AsrWsClient.audio_only_request(chunk, last))
+                        state["sent"] += 1
+                finally:
+                    sender_finished.set()
+
+            async def _receive():
+                received = 0
+                result = {}
+                while not (sender_finished.is_set() and received >= state["sent"]):
+                    recv = asyncio.ensure_future(ws.recv())
+                    finished = asyncio.ensure_future(sender_finished.wait())
+                    await asyncio.wait({recv, finished}, return_when=asyncio.FIRST_COMPLETED)
+                    finished.cancel()
+                    if not recv.done() and received >= state["sent"]:
+                        # 发送已经结束，并且所有的包都已经收到响应
+                        recv.cancel()
+                        break
+                    result = parse_response(await recv)
+                    received += 1
+                    in_flight.release()
+                    if self.is_error(result) or response_sequence(result) < 0:
+                        # 出错，或者已经收到最后一包（序号为负数）的识别结果
+                        break
+                return result
+
+            sender = asyncio.ensure_future(_send())
+            try:
+                result = await _receive()
+            finally:
+                if not sender.done():
+                    sender.cancel()
+            if sender.done() and not sender.cancelled() and sender.exception() is not None:
+                raise sender.exception()
         return result
 
     async def execute(self):
-        with open(self.audio_path, mode="rb") as _f:
-            data = _f.read()
-        audio_data = bytes(data)
+        audio = self.audio_path
+        if hasattr(audio, "__aiter__"):
+            # 异步字节流：总长度未知，按rate、bits、channel参数计算每一包的大小
+            return await self.stream_processor(audio)
+        if isinstance(audio, (bytes, bytearray, memoryview)):
+            audio_data = memoryview(audio)
+        else:
+            with open(audio, mode="rb") as _f:
+                audio_data = memoryview(_f.read())
         if self.format == "mp3":
             segment_size = self.mp3_seg_size
             return await self.segment_data_processor(audio_data, segment_size)
@@ -313,20 +424,87 @@ class AsrWsClient:
         return await self.segment_data_processor(audio_data, segment_size)
 
 
+def response_sequence(result: dict) -> int:
+    '''服务端响应的序号：ACK在头部之后，full response在payload的sequence字段中，最后一包的序号为负数。'''
+    if 'seq' in result:
+        return result['seq']
+    payload = result.get('payload_msg')
+    if isinstance(payload, dict):
+        return int(payload.get('sequence', 0))
+    return 0
+
+async def stream_segments(frames: Union[Iterable[bytes], AsyncIterator[bytes]], segment_size: int) -> AsyncIterator:
+    '''把PCM数据块聚合成segment_size大小的包，返回(数据, 是否最后一包)。'''
+    # 保留一个已经凑满的包：迭代结束前无法知道哪一包是最后一包
+    pending = None
+    buffer = bytearray()
+    async for frame in iterate_frames(frames):
+        buffer.extend(frame)
+        if len(buffer) < segment_size:
+            continue
+        if pending is not None:
+            yield pending, False
+        pending = bytes(buffer)
+        buffer.clear()
+    chunks = [chunk for chunk in (pending, bytes(buffer)) if chunk]
+    for index, chunk in enumerate(chunks):
+        yield chunk, index == len(chunks) - 1
+
+_FRAMES_END = object()
+
+async def iterate_frames(frames: Union[Iterable[bytes], AsyncIterator[bytes]]) -> AsyncIterator[bytes]:
+    '''
+    把同步迭代器（例如阻塞读取麦克风的生成器）转换成异步迭代器。
+    同步迭代器在事件循环的默认线程池中读取（在async_runtime中即AsyncRuntime的线程池），不额外创建线程；读取期间占用其中一个线程。
+    '''
+    if hasattr(frames, "__aiter__"):
+        async for frame in frames:
+            yield frame
+        return
+    loop = asyncio.get_running_loop()
+    frame_queue = asyncio.Queue()
+    stopped = threading.Event()
+
+    def _produce():
+        try:
+            for frame in frames:
+                # 调用方不再读取时（例如识别出错），尽快释放线程池中的线程
+                if stopped.is_set():
+                    break
+                loop.call_soon_threadsafe(frame_queue.put_nowait, frame)
+        except Exception as e:
+            loop.call_soon_threadsafe(frame_queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(frame_queue.put_nowait, _FRAMES_END)
+
+    producer = loop.run_in_executor(None, _produce)
+    try:
+        while True:
+            frame = await frame_queue.get()
+            if frame is _FRAMES_END:
+                break
+            if isinstance(frame, Exception):
+                raise frame
+            yield frame
+    finally:
+        stopped.set()
+    await producer
+
+
 def execute_one(audio_item, cluster, **kwargs):
     """
 
-    :param audio_item: {"id": xxx, "path": "xxx"}
+    :param audio_item: {"id": xxx, "path": "xxx"}，或者{"id": xxx, "data": 内存中的音频}
     :param cluster:集群名称
     :return:
     """
     assert 'id' in audio_item
-    assert 'path' in audio_item
+    assert 'path' in audio_item or 'data' in audio_item
     audio_id = audio_item['id']
-    audio_path = audio_item['path']
+    audio_path = audio_item.get('path')
     audio_type = AudioType.LOCAL
     asr_http_client = AsrWsClient(
-        audio_path=audio_path,
+        audio_path=audio_item['data'] if 'data' in audio_item else audio_path,
         cluster=cluster,
         audio_type=audio_type,
         **kwargs
@@ -355,14 +533,16 @@ def test_one():
     return result['result']['payload_msg']['result'][0]['text']
 
 def _zijie_stt_gradio(audio_path, audio_format='wav'):
+    '''audio_path可以是音频文件的路径，也可以是内存中的音频数据（bytes、memoryview）。'''
     # get from environment
     appid = os.environ.get("zijie_stt_appid")
     token = os.environ.get("zijie_stt_token")
     cluster = os.environ.get("zijie_stt_cluster")
+    audio_key = 'path' if isinstance(audio_path, (str, os.PathLike)) else 'data'
     result = execute_one(
         {
             'id': 1,
-            'path': audio_path
+            audio_key: audio_path
         },
         cluster=cluster,
         appid=appid,
@@ -370,97 +550,101 @@ def _zijie_stt_gradio(audio_path, audio_format='wav'):
         format=audio_format,
     )
     print(result)
+    return extract_text(result['result'])
+
+def extract_text(result: dict, default: str = "你说的什么？") -> str:
     try:
-        return result['result']['payload_msg']['result'][0]['text']
+        return result['payload_msg']['result'][0]['text']
     except:
-        return "你说的什么？"
+        return default
 
 
-def record_audio(audio_path, max_duration=15, silence_threshold=1500, silence_duration=1.2, sample_rate=16000, channels=1):
+def microphone_frames(max_duration=15, silence_threshold=None, silence_duration=None, sample_rate=16000, channels=1, chunk=1024, pre_roll: Optional[float] = 0.3, endpoint="normal"):
     """
-    录制音频。调用麦克风录制音频，并保存为wav格式。
-    检测用户停止说话后自动终止录音。
-    
-    Args:
-        audio_path (str): 保存音频文件的路径
-        max_duration (int): 最大录音时长（秒），默认30秒
-        silence_threshold (int): 静音检测阈值，越小越敏感，默认1000
-        silence_duration (float): 检测到静音多长时间后停止录音（秒），默认2秒
-        sample_rate (int): 采样率，默认16000Hz
-        channels (int): 声道数，默认1（单声道）
-    
-    Returns:
-        str: 录制完成的音频文件路径
+    调用麦克风录音，逐块返回16bit PCM数据，由VoiceActivityDetector检测到用户说完后结束。
+    ----
+    pre_roll: 开始说话之前保留的音频时长（秒），检测到声音时先返回这部分数据，既不会切掉第一个字，也不会把开头的长时间静音发送给ASR。
+    endpoint: 端点检测的模式，"aggressive"在约400毫秒的静音后就结束录音，参见vad.ENDPOINT_MS。
+    silence_threshold: 平均振幅的下限，低于它的声音一定不是语音；默认由VAD根据噪声基底自适应。
+    silence_duration: 指定时（秒）代替endpoint，检测到这么长的静音后结束录音。
     """
+    import pyaudio
+
+    sample_format = pyaudio.paInt16  # 16位深度
+    vad_kwargs = {"sample_rate": sample_rate, "endpoint": endpoint}
+    if silence_threshold is not None:
+        vad_kwargs["min_level"] = silence_threshold
+    if silence_duration is not None:
+        vad_kwargs["endpoint_ms"] = int(silence_duration * 1000)
+    vad_kwargs["pre_roll_ms"] = int((pre_roll if pre_roll is not None else max_duration) * 1000)
+    detector = VoiceActivityDetector(**vad_kwargs)
+
+    print("开始录音，请说话...")
+    print(f"将在检测到 {detector.endpoint_frames * detector.frame_ms / 1000} 秒静音后自动停止，或在 {max_duration} 秒后强制停止")
+
+    # 初始化PyAudio
+    p = pyaudio.PyAudio()
+
+    # 打开音频流
+    stream = p.open(format=sample_format,
+                    channels=channels,
+                    rate=sample_rate,
+                    frames_per_buffer=chunk,
+                    input=True)
+
+    start_time = time.time()
+
     try:
-        import pyaudio
-        import wave
-        import time
-        
-        # 配置参数
-        chunk = 1024  # 每个缓冲区的帧数
-        sample_format = pyaudio.paInt16  # 16位深度
-        
-        print("开始录音，请说话...")
-        print(f"将在检测到 {silence_duration} 秒静音后自动停止，或在 {max_duration} 秒后强制停止")
-        
-        # 初始化PyAudio
-        p = pyaudio.PyAudio()
-        
-        # 打开音频流
-        stream = p.open(format=sample_format,
-                        channels=channels,
-                        rate=sample_rate,
-                        frames_per_buffer=chunk,
-                        input=True)
-        
-        # 初始化帧列表和变量
-        frames = []
-        silent_chunks = 0
-        silent_threshold_chunks = int(silence_duration * sample_rate / chunk)
-        is_speaking = False
-        start_time = time.time()
-        
-        # 录制音频
         while True:
             # 检查是否超过最大录音时长
             if time.time() - start_time > max_duration:
                 print(f"已达到最大录音时长 {max_duration} 秒，停止录音")
                 break
-                
+
             # 读取音频数据
             data = stream.read(chunk, exception_on_overflow=False)
-            frames.append(data)
-            
-            # 计算音量
-            audio_data = np.frombuffer(data, dtype=np.int16)
-            volume = np.abs(audio_data).mean()
-            
-            # 检测是否有声音
-            if volume > silence_threshold:
-                silent_chunks = 0
-                if not is_speaking:
-                    is_speaking = True
-                    print("检测到声音，正在录音...")
-            else:
-                silent_chunks += 1
-                
-                # 如果已经开始说话，且静音持续时间超过阈值，则停止录音
-                if is_speaking and silent_chunks >= silent_threshold_chunks:
-                    print(f"检测到 {silence_duration} 秒静音，停止录音")
-                    break
-        
+
+            was_speaking = detector.in_speech
+            yield from detector.process(data)
+            if detector.in_speech and not was_speaking:
+                print("检测到声音，正在录音...")
+
+            # 已经开始说话，且静音持续时间超过端点检测的阈值，则停止录音
+            if detector.ended:
+                print("检测到说话结束，停止录音")
+                break
+    finally:
         # 停止并关闭音频流
         stream.stop_stream()
         stream.close()
         p.terminate()
-        
+
+
+def record_audio(audio_path, max_duration=15, silence_threshold=None, silence_duration=None, sample_rate=16000, channels=1, endpoint="normal"):
+    """
+    录制音频。调用麦克风录制音频，并保存为wav格式。
+    检测用户停止说话后自动终止录音。
+    
+    Args:
+        audio_path (str): 保存音频文件的路径
+        max_duration (int): 最大录音时长（秒），默认30秒
+        silence_threshold (int): 静音检测的振幅下限，默认根据环境噪声自适应
+        silence_duration (float): 检测到静音多长时间后停止录音（秒），默认由endpoint决定
+        sample_rate (int): 采样率，默认16000Hz
+        channels (int): 声道数，默认1（单声道）
+        endpoint (str): 端点检测的模式，"conservative"、"normal"或"aggressive"
+    
+    Returns:
+        str: 录制完成的音频文件路径
+    """
+    try:
+        frames = list(microphone_frames(max_duration, silence_threshold, silence_duration, sample_rate, channels, endpoint=endpoint))
         print("录音完成！")
         
         # 保存为WAV文件
         wf = wave.open(audio_path, 'wb')
         wf.setnchannels(channels)
-        wf.setsampwidth(p.get_sample_size(sample_format))
+        wf.setsampwidth(2)
         wf.setframerate(sample_rate)
         wf.writeframes(b''.join(frames))
         wf.close()
@@ -475,10 +659,54 @@ def record_audio(audio_path, max_duration=15, silence_threshold=1500, silence_du
         print(f"录音过程中出错: {str(e)}")
         return None
 
-def zijie_stt_gradio(*args, **kwargs):
-    audio_path = record_audio("test.wav")
+def zijie_stt_gradio(*args, endpoint="normal", **kwargs):
+    audio_path = record_audio("test.wav", endpoint=endpoint)
     return _zijie_stt_gradio(audio_path)
 
+def zijie_stt_streaming(*args, **kwargs):
+    """
+    边录音边识别：麦克风采集到的PCM数据直接作为audio-only包发送给ASR，不再先保存为test.wav。
+    用户停止说话时大部分音频已经识别完毕，只需要等待最后一包的识别结果。可以作为stt_api传给STT或Session。
+    """
+    return asyncio.run(zijie_stt_streaming_async(*args, **kwargs))
+
+async def zijie_stt_streaming_async(*args, seg_duration=200, sample_rate=16000, **kwargs):
+    """zijie_stt_streaming的协程版本，在已有的事件循环中运行（例如async_runtime），不需要每次调用都创建一个新的事件循环。"""
+    client = _streaming_client("raw", sample_rate, seg_duration)
+    try:
+        result = await client.stream_processor(microphone_frames(sample_rate=sample_rate, **kwargs))
+    except ImportError:
+        print("请安装必要的库: pip install pyaudio numpy")
+        return "你说的什么？"
+    print(result)
+    return extract_text(result)
+
+def zijie_stt_stream(frames, format="raw", sample_rate=16000, seg_duration=200):
+    """
+    识别一个数据块的迭代器，数据块一边到达一边发送给ASR，例如开发板流式上传的音频（remote_gateway.UploadStream）。
+    format为"raw"（PCM）或"wav"（WAV头在第一个数据块中）；sample_rate只用于计算每一包的大小。
+    上传中断（frames抛出异常）或者识别失败时，返回默认的"你说的什么？"，保证这一轮总能拿到文本。
+    """
+    client = _streaming_client(format, sample_rate, seg_duration)
+    try:
+        result = asyncio.run(client.stream_processor(frames))
+    except Exception as e:
+        print(f"流式识别过程中出错: {str(e)}")
+        return "你说的什么？"
+    print(result)
+    return extract_text(result)
+
+def _streaming_client(format, sample_rate, seg_duration) -> AsrWsClient:
+    return AsrWsClient(
+        audio_path=None,
+        cluster=os.environ.get("zijie_stt_cluster"),
+        appid=os.environ.get("zijie_stt_appid"),
+        token=os.environ.get("zijie_stt_token"),
+        format=format,
+        sample_rate=sample_rate,
+        seg_duration=seg_duration,
+    )
+
 if __name__ == '__main__':
     test_one()
     # record_audio("test.wav", duration=5)
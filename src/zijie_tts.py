@@ -1,20 +1,26 @@
+import io
 import os
+import gzip
 import uuid
 import json
-import time
+import wave
 import base64
 import random
 import string
+import time
 import pyaudio
 import logging
 import requests
+import websocket
 import traceback
 import threading
 
 from pathlib import Path
-from pygame import mixer
+from tts_cache import TTSCache
+from connections import CONNECTIONS
 from collections import deque
-from typing import Optional, List, Dict, Any, Union
+from signals import SignalDeque
+from typing import Optional, List, Dict, Any, Union, Iterator
 
 def get_logger(logger_name=__name__):
     # 日志收集器
@@ -43,27 +49,100 @@ def generate_random_filename(length=30, extension=".txt"):
     parent_path = '/'
     return parent_path + ''.join(random.choices(string.ascii_letters + string.digits, k=length)) + extension
 
-def tts(
-        text,
-        *args,
-        **kwargs
-):
+LOGGER = get_logger()
+
+class StreamingAudio:
+    '''
+    流式合成的音频：合成线程不断放入PCM数据块，播放端一边迭代一边播放，不需要等待整句合成完毕。
+    ----
+    迭代时会阻塞等待新的数据块，直到合成结束（close）。可以被多次迭代，每次都从头开始。
+    '''
+    def __init__(self, sample_rate: int = 24000, channels: int = 1, sample_width: int = 2):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.error: Optional[BaseException] = None
+        self._chunks: List[bytes] = []
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, chunk: bytes) -> None:
+        with self._cond:
+            self._chunks.append(chunk)
+            self._cond.notify_all()
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        '''合成结束（或失败）时调用。'''
+        with self._cond:
+            self.error = error
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def __iter__(self):
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self._chunks) and not self._closed:
+                    self._cond.wait()
+                if index >= len(self._chunks):
+                    return
+                chunk = self._chunks[index]
+            index += 1
+            yield chunk
+
+    def read_pcm(self) -> bytes:
+        '''等待合成结束，返回完整的PCM数据。'''
+        return b"".join(self)
+
+    def to_wav(self) -> bytes:
+        '''等待合成结束，返回带wav头的完整音频。'''
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wf:
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(self.sample_width)
+            wf.setframerate(self.sample_rate)
+            wf.writeframes(self.read_pcm())
+        return buffer.getvalue()
+
+def read_audio(audio) -> bytes:
+    '''读取tts()返回的音频，audio可以是音频文件路径、内存中的音频（io.BytesIO），或者流式合成的音频（StreamingAudio，会被转换成wav）。'''
+    if isinstance(audio, io.BytesIO):
+        return audio.getvalue()
+    if isinstance(audio, StreamingAudio):
+        return audio.to_wav()
+    with open(audio, "rb") as f:
+        return f.read()
+
+def remove_audio(audio) -> None:
+    '''播放或发送完毕后清理音频：删除临时文件，内存中的音频则不需要处理。'''
+    if isinstance(audio, (str, os.PathLike)) and os.path.exists(audio):
+        os.remove(audio)
+
+def build_request_json(text, operation, encoding, **kwargs) -> Dict[str, Any]:
+    '''构建火山引擎语音合成的请求体，HTTP（query）和WebSocket（submit）两种接口共用。'''
     # 填写平台申请的appid, access_token以及cluster
     appid = os.environ.get("zijie_tts_app_id")
-    access_token= os.environ.get("zijie_tts_access_token")
-
     cluster = "volcano_tts"
 
     voice_type = kwargs.get("voice_type")
     if not voice_type:
         voice_type="BV005_streaming"
-        
-    host = "openspeech.bytedance.com"
-    api_url = f"https://{host}/api/v1/tts"
 
-    header = {"Authorization": f"Bearer;{access_token}"}
+    audio = {
+        "voice_type": voice_type,
+        "encoding": encoding,
+        "speed_ratio": 1.0,
+        "volume_ratio": 1.0,
+        "pitch_ratio": 1.0,
+    }
+    if "rate" in kwargs:
+        audio["rate"] = kwargs["rate"]
 
-    request_json = {
+    return {
         "app": {
             "appid": appid,
             "token": "access_token",
@@ -72,52 +151,245 @@ def tts(
         "user": {
             "uid": "388808087185088"
         },
-        "audio": {
-            "voice_type": voice_type,
-            "encoding": "wav",
-            "speed_ratio": 1.0,
-            "volume_ratio": 1.0,
-            "pitch_ratio": 1.0,
-        },
+        "audio": audio,
         "request": {
             "reqid": str(uuid.uuid4()),
             "text": text,
             "text_type": "plain",
-            "operation": "query",
+            "operation": operation,
             "with_frontend": 1,
             "frontend_type": "unitTson"
 
         }
     }
 
+def tts(
+        text,
+        *args,
+        **kwargs
+):
+    '''
+    把text转换成语音。
+    ----
+    默认把音频保存为临时的wav文件，并返回文件路径；
+    如果in_memory=True，则直接返回内存中的音频（io.BytesIO），不经过文件系统；
+    如果streaming=True，则使用流式合成，立即返回StreamingAudio，音频数据块在合成过程中陆续到达。
+    '''
+    if kwargs.get("streaming"):
+        return tts_streaming(text, *args, **kwargs)
+
+    request_json = build_request_json(text, "query", "wav", **kwargs)
+    # 相同的句子（问候语、默认回复等）命中缓存时不需要访问网络，use_cache=False可以关闭缓存。
+    if kwargs.get("use_cache", True):
+        data = get_tts_cache().get_or_synthesize(cache_key(request_json), lambda: _synthesize(request_json))
+    else:
+        data = _synthesize(request_json)
+    if data is None:
+        return None
+
+    if kwargs.get("in_memory"):
+        return io.BytesIO(data)
+    file_to_save = generate_random_filename(extension=".wav")
+    file_to_save = os.path.join(os.path.dirname(__file__), file_to_save)
+    with open(file_to_save, "wb") as f:
+        f.write(data)
+    return file_to_save
+
+def _synthesize(request_json) -> Optional[bytes]:
+    '''调用HTTP接口（operation: query）合成整句语音，返回wav数据，失败时返回None。'''
+    access_token= os.environ.get("zijie_tts_access_token")
+        
+    host = "openspeech.bytedance.com"
+    api_url = f"https://{host}/api/v1/tts"
+
+    header = {"Authorization": f"Bearer;{access_token}"}
+
     try:
-        resp = requests.post(api_url, json.dumps(request_json), headers=header)
+        # 复用keep-alive连接，避免每个句子都进行一次TCP+TLS握手。
+        resp = CONNECTIONS.post(api_url, json.dumps(request_json), headers=header)
         # print(f"resp body: \n{resp.json()}")
         if "data" in resp.json():
-            data = resp.json()["data"]
-            file_to_save = generate_random_filename(extension=".wav")
-            file_to_save = os.path.join(os.path.dirname(__file__), file_to_save)
-            file_to_save = open(file_to_save, "wb")
-            file_to_save.write(base64.b64decode(data))
-            file_to_save.close()
-            file_to_save:str
-            return file_to_save.name
+            return base64.b64decode(resp.json()["data"])
     except Exception as e:
         traceback.print_exc()
 
+_TTS_CACHE: Optional[TTSCache] = None
+_TTS_CACHE_LOCK = threading.Lock()
+
+def get_tts_cache() -> TTSCache:
+    '''
+    进程内共享的语音合成缓存，在第一次使用时创建。
+    设置了环境变量tts_cache_dir（可以写在config.json中）时，启用磁盘缓存。
+    '''
+    global _TTS_CACHE
+    with _TTS_CACHE_LOCK:
+        if _TTS_CACHE is None:
+            _TTS_CACHE = TTSCache(disk_dir=os.environ.get("tts_cache_dir") or None)
+        return _TTS_CACHE
+
+def cache_key(request_json) -> str:
+    audio = request_json["audio"]
+    return TTSCache.make_key(
+        request_json["request"]["text"],
+        audio["voice_type"],
+        audio["speed_ratio"],
+        audio["volume_ratio"],
+        audio["pitch_ratio"],
+        audio["encoding"],
+        rate=audio.get("rate"),
+    )
+
+# 流式合成使用火山引擎的WebSocket二进制协议（operation: submit）。
+# header: version(4 bits)=1, header size(4 bits)=1, message type(4 bits)=full client request, flags(4 bits)=0,
+#         serialization(4 bits)=JSON, compression(4 bits)=gzip, reserved(8 bits)
+STREAMING_TTS_WS_URL = "wss://openspeech.bytedance.com/api/v1/tts/ws_binary"
+STREAMING_TTS_HEADER = bytes([0x11, 0x10, 0x11, 0x00])
+SERVER_AUDIO_ONLY_RESPONSE = 0b1011
+SERVER_FRONTEND_RESPONSE = 0b1100
+SERVER_ERROR_RESPONSE = 0b1111
+
+class StreamingTTSError(Exception):
+    pass
+
+def parse_streaming_response(res: bytes):
+    '''
+    解析服务端返回的二进制消息，返回(audio_chunk, is_last)。
+    没有音频的消息（ACK、前端信息）返回(None, False)，错误消息抛出StreamingTTSError。
+    '''
+    header_size = res[0] & 0x0f
+    message_type = res[1] >> 4
+    message_type_specific_flags = res[1] & 0x0f
+    message_compression = res[2] & 0x0f
+    payload = res[header_size * 4:]
+    if message_type == SERVER_AUDIO_ONLY_RESPONSE:
+        if message_type_specific_flags == 0:  # no sequence number as ACK
+            return None, False
+        sequence_number = int.from_bytes(payload[:4], "big", signed=True)
+        payload_size = int.from_bytes(payload[4:8], "big", signed=False)
+        return payload[8:8 + payload_size], sequence_number < 0
+    if message_type == SERVER_ERROR_RESPONSE:
+        code = int.from_bytes(payload[:4], "big", signed=False)
+        error_msg = payload[8:]
+        if message_compression == 1:
+            error_msg = gzip.decompress(error_msg)
+        raise StreamingTTSError(f"code: {code}, message: {str(error_msg, 'utf-8')}")
+    return None, False
+
+def tts_stream(text, *args, **kwargs) -> Iterator[bytes]:
+    '''
+    流式语音合成：一边合成一边返回PCM数据块（16bit, 单声道，采样率为rate，默认24000）。
+    ----
+    ws_url: 合成服务的地址，默认读取环境变量zijie_tts_ws_url，方便在本地使用替身服务（dev/mock_servers/zijie_tts_server.py）进行离线测试。
+    '''
+    access_token = os.environ.get("zijie_tts_access_token")
+    ws_url = kwargs.get("ws_url") or os.environ.get("zijie_tts_ws_url") or STREAMING_TTS_WS_URL
+    kwargs.setdefault("rate", 24000)
+
+    payload_bytes = gzip.compress(json.dumps(build_request_json(text, "submit", "pcm", **kwargs)).encode("utf-8"))
+    full_client_request = bytearray(STREAMING_TTS_HEADER)
+    full_client_request.extend(len(payload_bytes).to_bytes(4, "big"))
+    full_client_request.extend(payload_bytes)
+
+    header = [f"Authorization: Bearer; {access_token}"]
+    ws, first_response = _submit_streaming_request(ws_url, header, bytes(full_client_request), kwargs.get("timeout", 30))
+    finished = False
+    try:
+        res = first_response
+        while True:
+            chunk, is_last = parse_streaming_response(res)
+            if chunk:
+                yield chunk
+            if is_last:
+                finished = True
+                break
+            res = ws.recv()
+    finally:
+        # 只有完整结束的连接才放回连接池，中途退出的连接上可能还有未读完的数据。
+        if finished:
+            CONNECTIONS.release_websocket(ws_url, ws)
+        else:
+            ws.close()
+
+def _submit_streaming_request(ws_url, header, request: bytes, timeout):
+    '''发送合成请求并读取第一条响应。复用的连接如果已经被服务端关闭，则新建连接重试一次。'''
+    ws, reused = CONNECTIONS.acquire_websocket(ws_url, header, timeout=timeout)
+    try:
+        ws.send_binary(request)
+        return ws, ws.recv()
+    except (websocket.WebSocketException, OSError):
+        ws.close()
+        if not reused:
+            raise
+    ws = websocket.create_connection(ws_url, header=header, timeout=timeout)
+    ws.send_binary(request)
+    return ws, ws.recv()
+
+_STREAMING_INFLIGHT: Dict[str, StreamingAudio] = {}
+
+def tts_streaming(text, *args, **kwargs) -> StreamingAudio:
+    '''
+    在后台线程中进行流式合成，立即返回StreamingAudio，播放端可以在第一个数据块到达时就开始播放。
+    命中缓存时直接返回已经完整的StreamingAudio；相同句子正在合成时，返回同一个StreamingAudio。
+    '''
+    rate = kwargs.setdefault("rate", 24000)
+    use_cache = kwargs.get("use_cache", True)
+    key = cache_key(build_request_json(text, "submit", "pcm", **kwargs))
+    if use_cache:
+        cached = get_tts_cache().get(key)
+        if cached is not None:
+            audio = StreamingAudio(sample_rate=rate)
+            audio.put(cached)
+            audio.close()
+            return audio
+        with _TTS_CACHE_LOCK:
+            audio = _STREAMING_INFLIGHT.get(key)
+            if audio is not None:
+                return audio
+            audio = _STREAMING_INFLIGHT[key] = StreamingAudio(sample_rate=rate)
+    else:
+        audio = StreamingAudio(sample_rate=rate)
+
+    def _pump():
+        try:
+            for chunk in tts_stream(text, *args, **kwargs):
+                audio.put(chunk)
+        except Exception as e:
+            LOGGER.error(f"Streaming TTS failed: {e}")
+            audio.close(e)
+        else:
+            audio.close()
+            if use_cache:
+                get_tts_cache().put(key, audio.read_pcm())
+        finally:
+            if use_cache:
+                with _TTS_CACHE_LOCK:
+                    _STREAMING_INFLIGHT.pop(key, None)
+
+    threading.Thread(target=_pump, daemon=True).start()
+    return audio
+
+def _wait_popleft(queue_: Union[SignalDeque, deque]):
+    '''从队列左侧取出一个元素，队列为空时等待。SignalDeque在放入元素时唤醒等待的线程；普通的deque只能轮询。'''
+    if isinstance(queue_, SignalDeque):
+        return queue_.wait_popleft()
+    while len(queue_)==0:
+        time.sleep(0.01)
+    return queue_.popleft()
+
 class AudioProducer(threading.Thread):
     def __init__(self, text_queue, audio_queue, daemon=True):
-        '''不停地从text队列中拿出sentence，然后进行语音合成，放入到audio队列中，直到拿到None时停止，然后再往audio队列中放入一个None，表示合成完毕。'''
-        self.text_queue:deque = text_queue.value
-        self.audio_queue:deque = audio_queue.value
+        '''
+        不停地从text队列中拿出sentence，然后进行语音合成，放入到audio队列中，直到拿到None时停止，然后再往audio队列中放入一个None，表示合成完毕。
+        两个队列的value可以是deque或者signals.SignalDeque；使用SignalDeque时，放入元素会直接唤醒等待的线程，不需要轮询。
+        '''
+        self.text_queue:Union[SignalDeque, deque] = text_queue.value
+        self.audio_queue:Union[SignalDeque, deque] = audio_queue.value
         super().__init__(daemon=daemon)
     
     def run(self) -> None:
         while True:
-            # 这里得判断队列是否为空，如果为空，则等待，直到有新的句子进入队列
-            while len(self.text_queue)==0:
-                time.sleep(0.01)
-            sentence = self.text_queue.popleft()
+            # 队列为空时阻塞等待，直到有新的句子进入队列
+            sentence = _wait_popleft(self.text_queue)
             if sentence is None:
                 self.audio_queue.append(None)
                 break
@@ -126,29 +398,26 @@ class AudioProducer(threading.Thread):
 class AudioConsumer(threading.Thread):
     def __init__(self, audio_queue:deque, daemon=True):
         '''
-        不停地从audio队列中拿出audio，进行播放，直到拿到None时，停止运行。
+        不停地从audio队列中拿出audio，进行播放，直到拿到None时，停止运行。audio_queue.value可以是deque或者signals.SignalDeque。
         '''
         super().__init__(daemon=daemon)
-        self.audio_queue:deque = audio_queue.value
+        self.audio_queue:Union[SignalDeque, deque] = audio_queue.value
 
     def run(self):
-        # 使用mixer类进行播放         
-        mixer.init()
+        # 避免循环导入：playback依赖本模块的StreamingAudio
+        from playback import get_playback_engine
+
+        engine = get_playback_engine()
+        last_handle = None
         while True:
-            while len(self.audio_queue)==0:
-                time.sleep(0.01)
-            audio = self.audio_queue.popleft()
+            audio = _wait_popleft(self.audio_queue)
             if audio is None:
                 break
             
-            mixer.music.load(audio)
-            mixer.music.play()
-            while mixer.music.get_busy():
-                time.sleep(0.001)
-            
-            mixer.music.unload()
-            os.remove(audio)
-        mixer.quit()
+            last_handle = engine.play(audio)
+            remove_audio(audio)
+        if last_handle is not None:
+            last_handle.wait()
 
 if __name__ == '__main__':
     os.environ["zijie_tts_app_id"] = "3065693124"